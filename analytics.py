@@ -0,0 +1,231 @@
+from decimal import Decimal
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+import sqlalchemy.sql.expression as sase
+
+import constants
+import database
+import dimensions
+import preprocess
+
+# Column positions in a vehicle row as `preprocess.route_row` returns it
+COUNTRY, MAKE, MODEL = 0, 3, 4
+BUILD_YEAR_INT, AMOUNT_DAMAGE_NUM, FIRSTUSE_DATE = 37, 38, 39
+# Separator of the parts of a (country, make, model) group key, a character that doesn't occur in the data
+KEY_SEPARATOR = "\x1f"
+
+
+class ScoreboardEngine:
+    """
+    Compute the pistoncup scoreboard in one pass over the vehicle rows, without writing the normalized damage of every
+    row. Normalization is linear within a country, so the average normalized damage of a make/model is the normalized
+    average damage: (avg(damage) - min) / (max - min). That only needs, per country, the minimum and maximum damage of
+    all rows and, per country/make/model, the sum and count of the damage of the rows of the scoreboard year. Both are
+    aggregated per batch of rows with numpy and merged into small dictionaries.
+
+    The rows can be fed while they are ingested, with `add`, or read back from the database with `scan`.
+    """
+
+    def __init__(self, top: int = 10, filter_on_year: int = 2016, deduplicate: bool = True):
+        """
+        :param top: Number of make/models per country on the scoreboard, ties included
+        :param filter_on_year: Build year of the cars on the scoreboard
+        :param deduplicate: Skip rows with a primary key that was added before, like the database does on insert
+        """
+        self.top = top
+        self.filter_on_year = filter_on_year
+        self.deduplicate = deduplicate
+        self.nr_of_rows = 0
+        self._seen: Set[Tuple[str, str, str]] = set()
+        self._ranges: Dict[str, List[float]] = dict()
+        self._groups: Dict[str, List[float]] = dict()
+
+    def add(self, rows: List[List[Any]]) -> None:
+        """
+        Add a batch of vehicle rows as `preprocess.route_row` returns them. With deduplicate only the first row of
+        every primary key counts, so the result matches the table after an INSERT IGNORE of the same rows into an
+        empty table.
+
+        :param rows: Vehicle rows
+        :return: None
+        """
+        if self.deduplicate:
+            unique = list()
+            for row in rows:
+                key = (row[0], row[1], row[2])
+                if key not in self._seen:
+                    self._seen.add(key)
+                    unique.append(row)
+            rows = unique
+        if not rows:
+            return
+
+        columns = list(zip(*rows))
+        self.add_columns(columns[COUNTRY], columns[MAKE], columns[MODEL], columns[BUILD_YEAR_INT],
+                         columns[FIRSTUSE_DATE], columns[AMOUNT_DAMAGE_NUM])
+
+    def add_columns(self, countries: Sequence[str], makes: Sequence[Optional[str]], models: Sequence[Optional[str]],
+                    build_years: Sequence[Optional[int]], firstuse_dates: Sequence[Any],
+                    damages: Sequence[Optional[Decimal]]) -> None:
+        """
+        Add a batch of vehicles given as columns
+
+        :param countries: Country of every vehicle
+        :param makes: Make of every vehicle
+        :param models: Model of every vehicle
+        :param build_years: Typed build year of every vehicle, before sanitizing
+        :param firstuse_dates: Date of first use of every vehicle, the build year if the build year is out of range
+        :param damages: Amount damage of every vehicle, None if unknown
+        :return: None
+        """
+        self.nr_of_rows += len(countries)
+        damage = np.fromiter((np.nan if value is None else float(value) for value in damages), dtype=np.float64,
+                             count=len(damages))
+        has_damage = ~np.isnan(damage)
+        if not has_damage.any():
+            return
+
+        # Minimum and maximum damage per country, over all rows with a damage
+        country = np.asarray(countries, dtype=object)
+        codes, inverse = np.unique(country[has_damage], return_inverse=True)
+        minimum = np.full(len(codes), np.inf)
+        maximum = np.full(len(codes), -np.inf)
+        np.minimum.at(minimum, inverse, damage[has_damage])
+        np.maximum.at(maximum, inverse, damage[has_damage])
+        for code, low, high in zip(codes.tolist(), minimum.tolist(), maximum.tolist()):
+            dmg_range = self._ranges.setdefault(code, [low, high])
+            dmg_range[0] = min(dmg_range[0], low)
+            dmg_range[1] = max(dmg_range[1], high)
+
+        # Sum and count of the damage per country/make/model of the rows of the scoreboard year
+        year = np.fromiter((-1 if value is None else value for value in build_years), dtype=np.int64,
+                           count=len(build_years))
+        out_of_range = (year < constants.MIN_YEAR) | (year > constants.MAX_YEAR)
+        for position in np.flatnonzero(out_of_range & has_damage).tolist():
+            # Like `database.Vehicle.sanitize_build_year`, a year out of range is replaced by the year of first use
+            firstuse = firstuse_dates[position]
+            year[position] = -1 if firstuse is None else firstuse.year
+        # Grouped on the canonical spelling, like the dimension ids `database.Vehicle.create_topx` groups on
+        make = np.asarray(preprocess.map_distinct(partial(dimensions.canonical, "make"), makes), dtype=object)
+        model = np.asarray(preprocess.map_distinct(partial(dimensions.canonical, "model"), models), dtype=object)
+        selected = has_damage & (year == self.filter_on_year) & (make != "") & (make != None) & \
+            (model != "") & (model != None)
+        if not selected.any():
+            return
+
+        keys = country[selected] + KEY_SEPARATOR + make[selected] + KEY_SEPARATOR + model[selected]
+        groups, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse, weights=damage[selected])
+        counts = np.bincount(inverse)
+        for group, total, count in zip(groups.tolist(), sums.tolist(), counts.tolist()):
+            aggregate = self._groups.setdefault(group, [0.0, 0])
+            aggregate[0] += total
+            aggregate[1] += count
+
+    def scan(self, engine: Any, batch_size: int = constants.BULK_BATCH_SIZE) -> None:
+        """
+        Add all vehicles that are in the database, reading the table once in batches. The table is deduplicated
+        already, so deduplication is skipped.
+
+        :param engine: a Sqlalchemy engine object
+        :param batch_size: Number of rows per batch
+        :return: None
+        """
+        vehicles = database.Vehicle
+        stmt = sase.select([vehicles.country, vehicles.make, vehicles.model, vehicles.build_year_int,
+                            vehicles.firstuse_date, vehicles.amount_damage_num])
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(stmt)
+            while True:
+                batch = result.fetchmany(batch_size)
+                if not batch:
+                    break
+                self.add_columns(*zip(*batch))
+
+    def damage_ranges(self) -> Dict[str, Tuple[float, float]]:
+        """
+        The minimum and maximum damage per country, a maximum of 0 replaced by 1 like `database.Vehicle.damage_ranges`
+
+        :return: The minimum and maximum per country
+        """
+        return {country: (low, 1.0 if high == 0 else high) for country, (low, high) in self._ranges.items()}
+
+    def scoreboard(self) -> List[Dict[str, Any]]:
+        """
+        Rank the make/models of every country on their average normalized damage, highest first. Equal averages get
+        the same rank and the next rank is skipped, like the rank() window function.
+
+        :return: The pistoncup rows with a rank up to top
+        """
+        ranges = self.damage_ranges()
+        per_country: Dict[str, List[Tuple[str, str, float]]] = dict()
+        for group, (total, count) in self._groups.items():
+            country, make, model = group.split(KEY_SEPARATOR)
+            low, high = ranges[country]
+            # All damages of a country are normalized to 0 when they are the same, like in the database
+            per_country.setdefault(country, list()).append((make, model, (total / count - low) / ((high - low) or 1)))
+
+        rows = list()
+        for country, groups in sorted(per_country.items()):
+            averages = np.array([average for _, _, average in groups])
+            ranks = np.searchsorted(np.sort(-averages), -averages, side="left") + 1
+            for (make, model, average), rank in sorted(zip(groups, ranks.tolist()), key=lambda item: item[1]):
+                if rank <= self.top:
+                    rows.append({"country": country, "make": make, "model": model,
+                                 "amount_damage": f"{average:.13f}", "rnk": rank})
+        return rows
+
+    def write(self, session: Any) -> None:
+        """
+        Replace the pistoncup table with the scoreboard and the damagerange table with the damage ranges, so an
+        incremental run afterwards can carry on with `main.update_normalized_damage`
+
+        :param session: sqlalchemy session object to talk to the database
+        :return: None
+        """
+        pistoncup = database.PistonCup
+        damagerange = database.DamageRange
+
+        rows = self.scoreboard()
+        session.execute(pistoncup.wipe_slate())
+        if rows:
+            session.execute(sase.insert(pistoncup), rows)
+
+        ranges = self.damage_ranges()
+        if ranges:
+            session.execute(damagerange.forget(ranges.keys()))
+            session.execute(damagerange.record(), [
+                {"country": country, "min_dmg": Decimal(f"{low:.2f}"), "max_dmg": Decimal(f"{high:.2f}")}
+                for country, (low, high) in ranges.items()
+            ])
+
+
+def compare_scoreboards(expected: Iterable[Any], actual: Iterable[Dict[str, Any]], tolerance: float = 1e-6) -> \
+        List[str]:
+    """
+    Cross-check a scoreboard against the one of the sql path. The averages can differ slightly because the sql path
+    averages normalized damages that are rounded to 9 decimals.
+
+    :param expected: Rows with country, make, model, average damage and rank, like the rows of
+        `database.Vehicle.create_topx`
+    :param actual: Rows of `ScoreboardEngine.scoreboard`
+    :param tolerance: Largest allowed difference between two averages
+    :return: A message for every difference, empty if the scoreboards are the same
+    """
+    expected_rows = {(row[0], row[1], row[2]): (float(row[3]), int(row[4])) for row in expected}
+    actual_rows = {(row["country"], row["make"], row["model"]): (float(row["amount_damage"]), row["rnk"])
+                   for row in actual}
+
+    differences = list()
+    for key in sorted(set(expected_rows) | set(actual_rows)):
+        if key not in actual_rows:
+            differences.append(f"{key} missing, expected {expected_rows[key]}")
+        elif key not in expected_rows:
+            differences.append(f"{key} not expected, got {actual_rows[key]}")
+        else:
+            (expected_average, expected_rank), (average, rank) = expected_rows[key], actual_rows[key]
+            if abs(expected_average - average) > tolerance or expected_rank != rank:
+                differences.append(f"{key} expected {expected_rows[key]}, got {actual_rows[key]}")
+    return differences
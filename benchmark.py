@@ -0,0 +1,354 @@
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+import colcache
+import constants
+import database
+import main
+import metrics
+import preprocess
+
+STAGES = ("parse", "repair", "dedup", "load", "sanitize", "normalize", "scoreboard")
+BENCHMARK_RESULTS = "benchmark_results.json"
+BENCHMARK_BASELINE = "benchmark_baseline.json"
+# Modules of the commands that are timed by `measure_startup`, from the core to the whole pipeline
+STARTUP_MODULES = ("preprocess", "utils", "database", "scoreboard", "export", "main")
+# Packages that only the stages that need them should import
+HEAVY_MODULES = ("numpy", "pandas", "requests")
+# Import time in milliseconds that commands that don't ingest should stay under
+STARTUP_TARGET_MS = 100
+
+COUNTRIES = ["LPAE", "LPAT", "LPBE", "LPDE", "LPES", "LPFR", "LPIT", "LPNL", "LPSK"]
+MAKES = {
+    "BMW": ["3 SERIE", "5 SERIE", "X3"],
+    "TOYOTA": ["HILUX", "PRADO", "Camry,GL,"],
+    "NISSAN": ["Qashqai,SE,", "MICRA"],
+    "AUDI": ["A3", "A4", "Q5"],
+    "VOLKSWAGEN": ["GOLF", "POLO", "PASSAT"],
+}
+COLOURS = ["White", "Silver", "alpinweiss", "Dark Silver(K54)", "Black", ""]
+BODYTYPES = ["SEDAN", "SUV", "Kombi", "Hatchback", "4x4 pick up"]
+
+
+def generate_row(rnd: random.Random, nr: int) -> str:
+    """
+    Generate one csv line in the style of the part files, including their quirks:
+    - 1% of the colours end in a stray quote like `Pure White",sedan`, giving a short row
+    - 1% of the types end in a wheel size in inches like `Sport Line 16"`, giving a short row
+    - 1% of the rows are longer than 36 fields
+    - 3% of the rows repeat the primary key of an earlier row
+    - 2% of the build years are out of the MIN_YEAR - MAX_YEAR range
+
+    :param rnd: Seeded random generator, so the same seed gives the same file
+    :param nr: Number of the row in the file
+    :return: The csv line
+    """
+    # The primary key is derived from key, a duplicate reuses the key of an earlier row
+    key = rnd.randrange(nr) if nr and rnd.random() < 0.03 else nr
+    make = rnd.choice(list(MAKES))
+    build_year = rnd.randrange(1995, 2019)
+    firstuse = f"{build_year + rnd.randrange(2)}-{rnd.randrange(1, 13):02d}-{rnd.randrange(1, 29):02d}"
+    if rnd.random() < 0.02:
+        build_year = rnd.choice([0, 1000, 1899, 2099])
+    damage = "" if rnd.random() < 0.3 else f"{rnd.uniform(0, 5000):.5f}"
+
+    fields = [COUNTRIES[key % len(COUNTRIES)], str(key), f"{key % 99991}R{key % 7}", make, rnd.choice(MAKES[make]),
+              f"{rnd.choice(['1.6', '2.0', '2.7'])}L,{build_year},", "UNKNOWN", rnd.choice(COLOURS),
+              rnd.choice(BODYTYPES), rnd.choice(["DIESEL", "GASOLINE"]), "1995", "85", "1995", "116",
+              rnd.choice(["MANUAL", "AUTOMATIC"]), "5", "Other", "", "0", "Medium car", "5", "5",
+              str(rnd.randrange(200000)), str(rnd.randrange(20)), firstuse, str(build_year), damage,
+              rnd.choice(["Low", "Medium", "High"])] + [rnd.choice(["", "0", "1"]) for _ in range(8)]
+
+    quirk = rnd.random()
+    if quirk < 0.01:
+        fields[7] = 'Pure White",sedan'
+    elif quirk < 0.02:
+        fields[5] = 'Sport Line 16"'
+    elif quirk < 0.03:
+        fields += [""] * rnd.randrange(1, 6)
+    # The fields are written as they are, without escaping, just like the quirks appear in the part files
+    return ",".join(f'"{field}"' for field in fields) + "\n"
+
+
+def generate_vehicle_csv(path: str, nr_of_rows: int, seed: int = 0) -> None:
+    """
+    Write a synthetic part file with a header and nr_of_rows rows, see `generate_row`
+
+    :param path: Location of the csv file to write
+    :param nr_of_rows: Number of rows to generate
+    :param seed: Seed of the random generator
+    :return: None
+    """
+    rnd = random.Random(seed)
+    with open(path, "w") as f:
+        f.write(",".join(f'"{column}"' for column in database.Vehicle.__table__.columns.keys()[:36]) + "\n")
+        for nr in range(nr_of_rows):
+            f.write(generate_row(rnd, nr))
+
+
+def peak_rss_mb() -> float:
+    """
+    The peak resident memory of this process so far. This high-water mark can't be reset, so after a stage it is the
+    peak of that stage and of all the stages before it.
+
+    :return: Peak memory in MB
+    """
+    return metrics.peak_rss_bytes() / 1024 ** 2
+
+
+class StageTimer:
+    """
+    Add up the time spent per stage, over all chunks. Of the memory it remembers the peak of the process at the end of
+    every stage, which includes the stages before it, and how much every stage raised that peak, its own share.
+    """
+
+    def __init__(self):
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.peak_rss_mb = {stage: 0.0 for stage in STAGES}
+        self.peak_growth_mb = {stage: 0.0 for stage in STAGES}
+
+    def time(self, stage: str, function: Any, *args: Any, **kwargs: Any) -> Any:
+        peak_before = peak_rss_mb()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.seconds[stage] += time.perf_counter() - start
+        self.peak_rss_mb[stage] = peak_rss_mb()
+        self.peak_growth_mb[stage] += self.peak_rss_mb[stage] - peak_before
+        return result
+
+
+def iter_line_chunks(path: str, chunk_size: int) -> Iterator[List[str]]:
+    """
+    Read a csv file in chunks of chunk_size lines, skipping the header
+
+    :param path: Location of the csv file
+    :param chunk_size: Number of lines per chunk
+    :return: a generator yielding the lines of every chunk
+    """
+    with open(path, "r") as f:
+        next(f, None)
+        while True:
+            chunk = list(islice(f, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_timed_chunks(source: str, chunk_size: int, timer: StageTimer, column_cache: bool = False,
+                      tokenize: bool = True, outcomes: Optional[Counter] = None) -> \
+        Iterator[Tuple[List[List[str]], List[List[Any]]]]:
+    """
+    Parse and repair a part file in chunks of chunk_size lines and time both. With column_cache the chunks are read
+    from the column cache of the file instead, which is built first without timing it. Reading the cache is timed as
+    parse, it hands out rows that are repaired already.
+
+    :param source: Path to the csv file
+    :param chunk_size: Number of lines per chunk
+    :param timer: The timer of the run
+    :param column_cache: Read the chunks from the column cache, see `colcache.ColumnCache`
+    :param tokenize: Parse with the tokenizer, otherwise with the csv reader, see `preprocess.iter_rows_from_csv`
+    :param outcomes: Optional counter that gets the number of rows per outcome of the tokenizer
+    :return: a generator yielding the mater rows and vehicle rows of every chunk
+    """
+    if column_cache:
+        cache = colcache.ColumnCache(source)
+        for _ in cache.build(chunk_size):
+            pass
+        chunks = cache.iter_chunks(chunk_size)
+        while True:
+            chunk = timer.time("parse", next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    for chunk in iter_line_chunks(source, chunk_size):
+        rows = timer.time("parse", lambda: list(preprocess.iter_rows_from_csv(chunk, skip_header=False,
+                                                                              tokenize=tokenize, outcomes=outcomes)))
+        yield timer.time("repair", main.split_into_long_and_normal_lists, rows, list(), list())
+
+
+def run_benchmark(source: str, engine: Any, chunk_size: int = constants.CHUNK_SIZE,
+                  column_cache: bool = False, tokenize: bool = True) -> Dict[str, Any]:
+    """
+    Run the pipeline stages on a part file and time every stage. Parse, repair, dedup and load are done per chunk of
+    chunk_size lines, like the streaming mode of `main.stream_into_database`, and their times are added up.
+
+    :param source: Path to the csv file, see `generate_vehicle_csv`
+    :param engine: a Sqlalchemy engine object of an empty database
+    :param chunk_size: Number of lines per chunk
+    :param column_cache: Time a run that reads the parsed rows from the column cache, see `iter_timed_chunks`
+    :param tokenize: Parse with the tokenizer, otherwise with the csv reader as before
+    :return: Seconds, rows/sec, the peak memory of the process so far and the growth of that peak per stage, plus the
+        row counts, among which the number of rows the
+        tokenizer repaired and the number it couldn't repair
+    """
+    database.initialize_database(engine)
+    timer = StageTimer()
+    counts = {"rows": 0, "vehicles": 0, "mater": 0, "duplicates": 0}
+    deduplicators = main.table_deduplicators(engine)
+    outcomes = Counter()
+
+    for mater, vehicles in iter_timed_chunks(source, chunk_size, timer, column_cache, tokenize, outcomes):
+        counts["rows"] += len(mater) + len(vehicles)
+        for table, data_list in ((database.Vehicle, vehicles), (database.Mater, mater)):
+            unique = timer.time("dedup", deduplicators[table].drop_duplicates, data_list)
+            counts["duplicates"] += len(data_list) - len(unique)
+            counts[table.__tablename__] += timer.time("load", main.load_rows, unique, table, engine)
+    counts["repaired"] = outcomes[preprocess.TOKEN_REPAIRED]
+    counts["unrepaired"] = outcomes[preprocess.TOKEN_FALLBACK]
+
+    session = sessionmaker(bind=engine)()
+    try:
+        def sanitize() -> None:
+            session.execute(database.WeirdYears.save_weird_years(source_table=database.Vehicle))
+            session.execute(database.Vehicle.sanitize_build_year())
+            database.Vehicle.null_empty_string(session)
+            session.commit()
+
+        def normalize() -> None:
+            main.update_normalized_damage(session, force=True)
+            session.commit()
+
+        def scoreboard() -> None:
+            main.update_scoreboard(session)
+            session.commit()
+
+        timer.time("sanitize", sanitize)
+        timer.time("normalize", normalize)
+        timer.time("scoreboard", scoreboard)
+    finally:
+        session.close()
+
+    stages = {
+        stage: {
+            "seconds": round(timer.seconds[stage], 4),
+            "rows_per_sec": round(counts["rows"] / timer.seconds[stage]) if timer.seconds[stage] else None,
+            "peak_rss_mb": round(timer.peak_rss_mb[stage], 1),
+            "peak_growth_mb": round(timer.peak_growth_mb[stage], 1),
+        }
+        for stage in STAGES
+    }
+    return {"counts": counts, "stages": stages, "total_seconds": round(sum(timer.seconds.values()), 4)}
+
+
+def compare_with_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.25,
+                          min_seconds: float = 0.05) -> List[str]:
+    """
+    Find the stages that got slower than in the baseline. The times are compared per million rows, so a baseline made
+    with another number of rows can still be used. Differences below min_seconds per million rows are ignored as noise.
+
+    :param results: Results of `run_benchmark`
+    :param baseline: Stored results of an earlier run
+    :param tolerance: Fraction a stage may be slower than in the baseline
+    :param min_seconds: Smallest difference in seconds per million rows that counts as a regression
+    :return: A message for every stage that regressed
+    """
+    def per_million(run: Dict[str, Any], stage: str) -> float:
+        return run["stages"][stage]["seconds"] * 1000000 / run["counts"]["rows"]
+
+    regressions = list()
+    for stage in STAGES:
+        if stage not in baseline.get("stages", dict()):
+            continue
+        current, previous = per_million(results, stage), per_million(baseline, stage)
+        if current > previous * (1 + tolerance) and current - previous > min_seconds:
+            regressions.append(f"{stage}: {current:.2f} sec per million rows, baseline {previous:.2f} "
+                               f"(+{(current / previous - 1) * 100:.0f}%)")
+    return regressions
+
+
+def measure_startup(modules: Tuple[str, ...] = STARTUP_MODULES, repeats: int = 5) -> Dict[str, Dict[str, Any]]:
+    """
+    Time the import of every module in a fresh python process, as a command that uses it would start. The fastest of
+    the repeats is kept, the others are slowed down by whatever else the machine was doing.
+
+    :param modules: Names of the modules to import
+    :param repeats: Number of processes per module
+    :return: Per module the import time in milliseconds and the `HEAVY_MODULES` that it loaded
+    """
+    code = ("import json, sys, time; start = time.perf_counter(); import {module}; "
+            "print(json.dumps([(time.perf_counter() - start) * 1000, sorted(set({heavy}).intersection(sys.modules))]))")
+    startup = dict()
+    for module in modules:
+        timings = [json.loads(subprocess.run([sys.executable, "-c", code.format(module=module, heavy=HEAVY_MODULES)],
+                                             check=True, capture_output=True, text=True,
+                                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout)
+                   for _ in range(repeats)]
+        startup[module] = {"milliseconds": round(min(ms for ms, _ in timings), 1), "heavy_modules": timings[0][1]}
+    return startup
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic part files with SQLite")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of rows to generate")
+    parser.add_argument("--chunk-size", type=int, default=constants.CHUNK_SIZE, help="Number of lines per chunk")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the data generator")
+    parser.add_argument("--output", default=BENCHMARK_RESULTS, help="Where to write the results as json")
+    parser.add_argument("--baseline", default=BENCHMARK_BASELINE, help="Stored results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Fraction a stage may be slower")
+    parser.add_argument("--update-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--csv-reader", action="store_true", help="Parse with the csv reader instead of the tokenizer")
+    parser.add_argument("--column-cache", action="store_true",
+                        help="Read the parsed rows from the column cache, built before the clock starts")
+    parser.add_argument("--startup", action="store_true", help="Also time the imports of the commands")
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "vehicle.csv_bench")
+        print(f"Generating {arguments.rows} rows")
+        generate_vehicle_csv(source, arguments.rows, arguments.seed)
+        engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(workdir, 'benchmark.db')}")
+        results = run_benchmark(source, engine, arguments.chunk_size, arguments.column_cache,
+                                tokenize=not arguments.csv_reader)
+        engine.dispose()
+
+    results.update(
+        rows=arguments.rows, chunk_size=arguments.chunk_size, seed=arguments.seed, column_cache=arguments.column_cache,
+        tokenize=not arguments.csv_reader,
+        python=platform.python_version(), sqlite=sqlite3.sqlite_version, created_at=datetime.now().isoformat()
+    )
+    for stage, result in results["stages"].items():
+        print(f"{stage}: {result['seconds']:.2f} sec, {result['rows_per_sec'] or 0} rows/sec, "
+              f"peak memory of the process so far {result['peak_rss_mb']} MB, raised by {result['peak_growth_mb']} MB")
+    counts = results["counts"]
+    print(f"{counts['vehicles']} vehicle and {counts['mater']} mater rows, {counts['repaired']} rows repaired by the "
+          f"tokenizer, {counts['unrepaired']} left unrepaired")
+    if arguments.startup:
+        results["startup"] = measure_startup()
+        for module, result in results["startup"].items():
+            target = "" if module == "main" or result["milliseconds"] < STARTUP_TARGET_MS else \
+                f", over the target of {STARTUP_TARGET_MS} ms"
+            print(f"import {module}: {result['milliseconds']} ms, loads {', '.join(result['heavy_modules']) or 'no'} "
+                  f"heavy modules{target}")
+    with open(arguments.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if arguments.update_baseline:
+        with open(arguments.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Stored the results as baseline in {arguments.baseline}")
+    elif os.path.exists(arguments.baseline):
+        with open(arguments.baseline, "r") as f:
+            regressions = compare_with_baseline(results, json.load(f), arguments.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,308 @@
+from datetime import date
+from decimal import Decimal
+from itertools import zip_longest
+import json
+import os
+import shutil
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Type
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.sql.schema import Column
+from sqlalchemy.sql.sqltypes import Date, Integer, Numeric
+
+import constants
+import database
+import preprocess
+import utils
+
+# Bump when the layout of the cache files changes or when the parser and repairs give other rows, like when the
+# tokenizer replaced the csv reader, older caches are rebuilt then
+SCHEMA_VERSION = 2
+META_FILE = "meta.json"
+# Code of a missing string in a dictionary encoded column and the stored value of a missing number
+NULL_CODE = -1
+NULL_INT = np.iinfo(np.int64).min
+EPOCH = date(1970, 1, 1)
+# Type of the stored values per kind of column, see `column_kind`, before the codes of a text column are narrowed
+STORAGE_DTYPES = {"text": np.int32, "int": np.int64, "decimal": np.int64, "date": "datetime64[D]"}
+# The tables the rows of a part file are split into, in the order `preprocess.split_lines` returns them
+TABLES = (database.Mater, database.Vehicle)
+
+
+def column_kind(column: Column) -> str:
+    """
+    How a column is stored in the cache:
+    - text: int32 codes into a dictionary of the distinct strings, which is stored as utf-8 bytes plus offsets
+    - int: int64
+    - decimal: int64 of the value times 10 ** scale, so the value comes back exactly
+    - date: datetime64[D]
+
+    :param column: sqlalchemy Column object
+    :return: The kind of storage
+    """
+    if isinstance(column.type, Integer):
+        return "int"
+    elif isinstance(column.type, Numeric):
+        return "decimal"
+    elif isinstance(column.type, Date):
+        return "date"
+    return "text"
+
+
+class ColumnWriter:
+    """
+    Append the values of one column, chunk by chunk, to a raw binary file. Text columns are dictionary encoded, their
+    dictionary is written when the writer is closed. Most text columns have few distinct values, so their codes are
+    narrowed to the smallest integer type that fits at that point.
+    """
+
+    def __init__(self, path: str, column: Column):
+        self.path = path
+        self.name = column.name
+        self.kind = column_kind(column)
+        self.scale = column.type.scale if self.kind == "decimal" else None
+        self.index: Dict[str, int] = dict()
+        self.dtype = np.dtype(STORAGE_DTYPES[self.kind])
+        self._file: BinaryIO = open(f"{path}.values", "wb")
+
+    def encode(self, values: List[Any]) -> np.ndarray:
+        if self.kind == "text":
+            # Factorize the chunk first, so only its distinct values are looked up in the dictionary of the column
+            codes, distinct = pd.factorize(np.array(values, dtype=object))
+            index = self.index
+            mapping = np.fromiter((index.setdefault(value, len(index)) for value in distinct.tolist()),
+                                  dtype=np.int32, count=len(distinct))
+            # Missing values get code -1 from factorize, which picks the NULL_CODE at the end of the mapping
+            return np.append(mapping, np.int32(NULL_CODE))[codes]
+        elif self.kind == "int":
+            return np.fromiter((NULL_INT if value is None else value for value in values), dtype=np.int64,
+                               count=len(values))
+        elif self.kind == "decimal":
+            scaled = preprocess.map_distinct(
+                lambda value: NULL_INT if value is None else int(value.scaleb(self.scale)), values
+            )
+            return np.array(scaled, dtype=np.int64)
+        # Days since 1970-01-01 is how datetime64[D] is stored, NULL_INT is the same as NaT
+        days = preprocess.map_distinct(lambda value: NULL_INT if value is None else (value - EPOCH).days, values)
+        return np.array(days, dtype=np.int64).view("datetime64[D]")
+
+    def append(self, values: List[Any]) -> None:
+        self._file.write(self.encode(values).tobytes())
+
+    def close(self) -> None:
+        self._file.close()
+        if self.kind == "text":
+            dtype = next(np.dtype(dtype) for dtype in (np.int8, np.int16, np.int32)
+                         if len(self.index) <= np.iinfo(dtype).max)
+            if dtype != self.dtype:
+                np.fromfile(f"{self.path}.values", dtype=self.dtype).astype(dtype).tofile(f"{self.path}.values")
+                self.dtype = dtype
+            encoded = [value.encode("utf-8") for value in self.index]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            with open(f"{self.path}.dict", "wb") as f:
+                f.write(b"".join(encoded))
+            offsets.tofile(f"{self.path}.offsets")
+
+
+class ColumnCache:
+    """
+    The parsed and repaired rows of one part file, stored per column in a directory next to the file. The columns are
+    read back as read-only memory maps, so nothing is copied until the values are needed. Every cache records the
+    size and checksum of its part file and is only used while those still match.
+    """
+
+    def __init__(self, source: str, folder: Optional[str] = None):
+        """
+        :param source: Path to the csv file
+        :param folder: Directory to keep the caches in, by default COLUMN_CACHE_DIR in the directory of the csv file
+        """
+        self.source = source
+        if folder is None:
+            folder = os.path.join(os.path.dirname(source), constants.COLUMN_CACHE_DIR)
+        self.directory = os.path.join(folder, os.path.basename(source))
+        self._meta: Optional[Dict[str, Any]] = None
+        self._dictionaries: Dict[Tuple[str, str], List[Optional[str]]] = dict()
+
+    def read_meta(self) -> Optional[Dict[str, Any]]:
+        path = os.path.join(self.directory, META_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def is_valid(self) -> bool:
+        """
+        Check that the cache is complete, of the current schema version and made from the current part file
+
+        :return: Boolean indicating whether the cache can be used
+        """
+        meta = self.read_meta()
+        if meta is None or meta["schema_version"] != SCHEMA_VERSION:
+            return False
+        if (meta["size"], meta["checksum"]) != (os.path.getsize(self.source), utils.file_checksum(self.source)):
+            return False
+        self._meta = meta
+        return True
+
+    @property
+    def meta(self) -> Dict[str, Any]:
+        if self._meta is None:
+            self._meta = self.read_meta()
+        return self._meta
+
+    def nr_of_rows(self, table: Type[database.declarative_base]) -> int:
+        return self.meta["tables"][table.__tablename__]
+
+    def column(self, table: Type[database.declarative_base], name: str) -> np.ndarray:
+        """
+        Memory map of the stored values of a column: the dictionary codes of a text column, the scaled integers of a
+        decimal column, see `column_kind` and `ColumnWriter`
+
+        :param table: sqlalchemy declarativeMeta class, Vehicle or Mater
+        :param name: Name of the column
+        :return: A read-only array with a value for every row
+        """
+        dtype = np.dtype(self.meta["dtypes"][table.__tablename__][name])
+        nr_of_rows = self.nr_of_rows(table)
+        if nr_of_rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, f"{table.__tablename__}.{name}.values"), dtype=dtype, mode="r",
+                         shape=(nr_of_rows,))
+
+    def dictionary(self, table: Type[database.declarative_base], name: str) -> List[Optional[str]]:
+        """
+        The distinct strings of a text column, in the order of their codes, followed by None for the NULL_CODE
+
+        :param table: sqlalchemy declarativeMeta class, Vehicle or Mater
+        :param name: Name of the column
+        :return: The strings per code
+        """
+        key = (table.__tablename__, name)
+        if key not in self._dictionaries:
+            path = os.path.join(self.directory, f"{table.__tablename__}.{name}")
+            with open(f"{path}.dict", "rb") as f:
+                data = f.read()
+            offsets = np.fromfile(f"{path}.offsets", dtype=np.int64).tolist()
+            self._dictionaries[key] = [data[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+            self._dictionaries[key].append(None)
+        return self._dictionaries[key]
+
+    def decode(self, table: Type[database.declarative_base], name: str, start: int, end: int) -> List[Any]:
+        """
+        The values of a column for the rows from start to end, as the repair steps of `preprocess` produce them
+
+        :param table: sqlalchemy declarativeMeta class, Vehicle or Mater
+        :param name: Name of the column
+        :param start: Position of the first row
+        :param end: Position after the last row
+        :return: The values as python objects, None for a missing value
+        """
+        column = table.__table__.columns[name]
+        kind = column_kind(column)
+        values = self.column(table, name)[start:end]
+        if kind == "text":
+            return list(map(self.dictionary(table, name).__getitem__, values.tolist()))
+        elif kind == "int":
+            return [None if value == NULL_INT else value for value in values.tolist()]
+        elif kind == "decimal":
+            scale = column.type.scale
+            return preprocess.map_distinct(
+                lambda value: None if value == NULL_INT else Decimal(value).scaleb(-scale), values.tolist()
+            )
+        return values.astype(object).tolist()
+
+    def iter_rows(self, table: Type[database.declarative_base], chunk_size: int) -> Iterator[List[List[Any]]]:
+        """
+        Read the rows of one table back in chunks of chunk_size rows
+
+        :param table: sqlalchemy declarativeMeta class, Vehicle or Mater
+        :param chunk_size: Number of rows per chunk
+        :return: a generator yielding the rows of every chunk
+        """
+        names = [column.name for column in database.parsed_columns(table)]
+        nr_of_rows = self.nr_of_rows(table)
+        for start in range(0, nr_of_rows, chunk_size):
+            end = min(start + chunk_size, nr_of_rows)
+            with preprocess.paused_gc():
+                columns = [self.decode(table, name, start, end) for name in names]
+                yield list(map(list, zip(*columns)))
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[Tuple[List[List[str]], List[List[Any]]]]:
+        """
+        Read the rows back like `preprocess.iter_split_chunks` hands them out, with up to chunk_size rows per table per
+        chunk. The rows of every table keep their order, so the first row of every primary key still wins on insert.
+
+        :param chunk_size: Number of rows per table per chunk
+        :return: a generator yielding the mater rows and vehicle rows of every chunk
+        """
+        for mater, vehicles in zip_longest(*(self.iter_rows(table, chunk_size) for table in TABLES),
+                                           fillvalue=list()):
+            yield mater, vehicles
+
+    def build(self, chunk_size: int) -> Iterator[Tuple[List[List[str]], List[List[Any]]]]:
+        """
+        Parse and repair the part file with `preprocess.iter_split_chunks` and store the rows while handing them out,
+        so building the cache doesn't take a pass of its own. The cache is written to a temporary directory that
+        replaces the old cache only when it is complete.
+
+        :param chunk_size: Number of lines per chunk
+        :return: a generator yielding the mater rows and vehicle rows of every chunk
+        """
+        # The checksum is taken before parsing, a file that changes meanwhile is found out on the next run
+        size, checksum = os.path.getsize(self.source), utils.file_checksum(self.source)
+        building = self.directory + ".tmp"
+        shutil.rmtree(building, ignore_errors=True)
+        os.makedirs(building)
+
+        writers = {
+            table: [ColumnWriter(os.path.join(building, f"{table.__tablename__}.{column.name}"), column)
+                    for column in database.parsed_columns(table)]
+            for table in TABLES
+        }
+        nr_of_rows = {table.__tablename__: 0 for table in TABLES}
+        try:
+            with open(self.source, "r") as f:
+                for chunk in preprocess.iter_split_chunks(f, chunk_size):
+                    with preprocess.paused_gc():
+                        for table, rows in zip(TABLES, chunk):
+                            nr_of_rows[table.__tablename__] += len(rows)
+                            columns = list(zip(*rows))
+                            for nr, writer in enumerate(writers[table]):
+                                writer.append(list(columns[nr]) if columns else list())
+                    yield chunk
+        finally:
+            for table_writers in writers.values():
+                for writer in table_writers:
+                    writer.close()
+
+        meta = {"schema_version": SCHEMA_VERSION, "source": os.path.basename(self.source), "size": size,
+                "checksum": checksum, "tables": nr_of_rows,
+                "dtypes": {table.__tablename__: {writer.name: writer.dtype.str
+                                                 for writer in writers[table]} for table in TABLES}}
+        with open(os.path.join(building, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.replace(building, self.directory)
+        self._meta = meta
+        self._dictionaries.clear()
+        print(f"Stored the parsed rows of {self.source} in column cache {self.directory}")
+
+
+def iter_split_chunks(source: str, chunk_size: int, folder: Optional[str] = None) -> \
+        Iterator[Tuple[List[List[str]], List[List[Any]]]]:
+    """
+    Hand out the repaired rows of a part file in chunks, from its column cache if that is up to date and by parsing
+    the csv file otherwise, building the cache on the way
+
+    :param source: Path to the csv file
+    :param chunk_size: Number of rows per chunk
+    :param folder: Directory to keep the caches in, see `ColumnCache`
+    :return: a generator yielding the mater rows and vehicle rows of every chunk
+    """
+    cache = ColumnCache(source, folder)
+    if cache.is_valid():
+        print(f"Reading the parsed rows of {source} from column cache {cache.directory}")
+        return cache.iter_chunks(chunk_size)
+    return cache.build(chunk_size)
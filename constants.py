@@ -18,6 +18,100 @@ CONFIG = {
     "database": "ACT"
 }
 
+# Number of connections the engine keeps open and the number it may open on top of that when they are all in use. The
+# writers of the ingest and the exporting threads each take one
+DB_POOL_SIZE = 8
+DB_MAX_OVERFLOW = 4
+# Seconds a connection to an SQLite database file waits for the lock of another writer before it fails
+SQLITE_BUSY_TIMEOUT = 60
+
 DATA_FOLDER = "data"
+# ETag, Last-Modified and size of every downloaded file, used to skip downloads of unchanged files
+DOWNLOAD_STATE = "download_state.json"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1.0
 MIN_YEAR = 1940
 MAX_YEAR = 2020
+
+# Number of rows per executemany call when the database has no bulk load fast path
+BULK_BATCH_SIZE = 10000
+# Number of source rows per chunk when streaming the csv files into the database. Set to 0 to load all files at once
+CHUNK_SIZE = 100000
+# Number of worker processes that parse the part files in parallel. With 0 or 1 the files are streamed in chunks
+PARSE_WORKERS = 0
+# Number of writer threads that load the parsed chunks while the next ones are parsed, see
+# `main.pipeline_into_database`. With 0 parsing and loading take turns
+WRITE_WORKERS = 4
+# Number of chunk parts that can wait for every writer before the parsing waits for the writers
+WRITE_QUEUE_SIZE = 2
+# Approximate number of bytes of a part file that a worker process parses in one go
+PARSE_CHUNK_BYTES = 32 * 1024 * 1024
+# Every stage and sql statement of a run is appended to the json lines file, the textfile is read by the node exporter
+METRICS_JSONL = "metrics.jsonl"
+METRICS_TEXTFILE = "act_metrics.prom"
+# Statements that take longer than this are explained, see `metrics.Metrics.explain`
+SLOW_QUERY_SECONDS = 1.0
+# Comma separated names of the functions to profile, or "all", see `profiling.Profiler`. Profiling is off when unset
+PROFILE_ENV = "ACT_PROFILE"
+PROFILE_DIR = "profiles"
+# Seconds between two samples of the call stack of a profiled stage
+PROFILE_SAMPLE_INTERVAL = 0.005
+# Number of countries that are transformed at the same time, each in its own short transactions, see
+# `transform.TransformExecutor`. Always 1 on SQLite
+TRANSFORM_WORKERS = 4
+# Compute the scoreboard with "sql" queries or in one pass with the "numpy" engine, see `analytics.ScoreboardEngine`
+SCOREBOARD_ENGINE = "sql"
+# With the numpy engine, also compute the scoreboard with sql and fail the run if they differ
+SCOREBOARD_CROSS_CHECK = False
+# Build years of which the scoreboard is stored in the yearscoreboard table on every run, next to the one of 2016 in
+# pistoncup, with SCOREBOARD_DEPTH make/models per country. `scoreboard.get_scoreboard` serves these without ranking
+SCOREBOARD_YEARS = [2015, 2017, 2018]
+SCOREBOARD_DEPTH = 25
+# Number of scoreboard results kept in memory and the seconds they stay valid, see `scoreboard.ScoreboardCache`
+SCOREBOARD_CACHE_SIZE = 256
+SCOREBOARD_CACHE_TTL = 300
+# Name of the directory next to the part files where their parsed rows are cached, see `colcache.ColumnCache`
+COLUMN_CACHE_DIR = ".columns"
+# Read the part files from their column cache when they were parsed before, and build the cache otherwise
+COLUMN_CACHE = True
+# Where `export.py` writes its files, the number of rows it fetches at a time and the number of countries it exports
+# at the same time with --per-country
+EXPORT_FOLDER = "export"
+EXPORT_BATCH_SIZE = 10000
+EXPORT_WORKERS = 4
+# Spellings of the same make or model that are stored as one value in the dimension table. The keys are upper case
+# with single spaces, see `dimensions.canonical`
+DIMENSION_ALIASES = {
+    "make": {
+        "VW": "VOLKSWAGEN",
+        "MERCEDES": "MERCEDES-BENZ",
+        "MERCEDES BENZ": "MERCEDES-BENZ",
+    },
+    "model": {
+        "SERIES 3": "3 SERIES",
+        "3 SERIE": "3 SERIES",
+        "3-SERIES": "3 SERIES",
+        "3ER": "3 SERIES",
+    },
+}
+# Initial number of slots and maximum fill fraction of the fingerprint set of the deduplication before loading, and
+# the number of keys confirmed against the database per query, see `dedup.Deduplicator`
+DEDUP_INITIAL_CAPACITY = 1 << 16
+DEDUP_MAX_LOAD = 0.7
+DEDUP_CONFIRM_BATCH_SIZE = 500
+# Number of primary keys per delete when the rows of a changed file are replaced, see `main.forget_previous_rows`
+FORGET_BATCH_SIZE = 500
+# Directory that the streaming ingest watches for files of vehicle records, see `stream.iter_spool`. Files are read
+# once they have a name that doesn't start with a dot, and moved to its done subdirectory when their rows are loaded
+STREAM_SPOOL = f"{DATA_FOLDER}/spool"
+# Seconds between two scans of an empty spool directory
+STREAM_POLL_INTERVAL = 1.0
+# A micro-batch of the streaming ingest is loaded as soon as it has STREAM_BATCH_SIZE rows, or earlier when its first
+# row would otherwise not have its country's ranks updated within STREAM_LATENCY_TARGET seconds
+STREAM_BATCH_SIZE = 5000
+STREAM_LATENCY_TARGET = 5.0
+# Number of recent micro-batches the latency percentiles are computed over, and how often they are reported
+STREAM_LATENCY_WINDOW = 1000
+STREAM_REPORT_EVERY = 100
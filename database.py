@@ -1,19 +1,53 @@
-from typing import Any, Type
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
 
 from sqlalchemy import inspect
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy.sql.expression as sase
-from sqlalchemy.sql.schema import Column, PrimaryKeyConstraint
-from sqlalchemy.sql.sqltypes import Date, Integer, Numeric, String
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.schema import Column, Index, PrimaryKeyConstraint, UniqueConstraint
+from sqlalchemy.sql.sqltypes import BigInteger, Date, DateTime, Integer, Numeric, String
 
 import constants
 
+# Low-cardinality text columns of vehicles that are also stored as an id into the dimension table, in <field>_id
+DIMENSION_FIELDS = ["make", "model", "colour", "fueltype", "bodytype"]
+
+
+class TrueDivide(FunctionElement):
+    """
+    Division that keeps the fraction on every database. SQLite divides two integers as integers, and stores a Numeric
+    value without decimals as an integer, so there the numerator is cast to REAL first.
+    """
+    type = Numeric()
+    name = "true_divide"
+
+
+@compiles(TrueDivide)
+def _compile_true_divide(element: TrueDivide, compiler: Any, **kw: Any) -> str:
+    numerator, denominator = element.clauses
+    return f"({compiler.process(numerator, **kw)}) / ({compiler.process(denominator, **kw)})"
+
+
+@compiles(TrueDivide, "sqlite")
+def _compile_true_divide_sqlite(element: TrueDivide, compiler: Any, **kw: Any) -> str:
+    numerator, denominator = element.clauses
+    return f"CAST(({compiler.process(numerator, **kw)}) AS REAL) / ({compiler.process(denominator, **kw)})"
+
 
 class Vehicle(declarative_base()):
     __tablename__ = 'vehicles'
     __table_args__ = (
         PrimaryKeyConstraint('country', 'vehicle_id', 'licence'),
+        # The scoreboard of one year per country, also covering the averaged column so it never reads the table rows
+        Index('ix_vehicles_country_build_year_make_model',
+              'country', 'build_year_int', 'make_id', 'model_id', 'amount_damage_norm'),
+        # Minimum and maximum damage per country for the normalization
+        Index('ix_vehicles_country_amount_damage', 'country', 'amount_damage_num'),
+        # Build years outside of the MIN_YEAR - MAX_YEAR range
+        Index('ix_vehicles_build_year', 'build_year_int'),
     )
     country = Column(String(4))
     vehicle_id = Column(String(255))
@@ -52,61 +86,166 @@ class Vehicle(declarative_base()):
     has_leather_alcantara = Column(String(255))
     has_leather_upholstery = Column(String(255))
     amount_damage_norm = Column(Numeric(10, 9))
+    # Typed copies of build_year, amount_damage and firstuse, filled in at load time by `preprocess.typed_values`
+    build_year_int = Column(Integer)
+    amount_damage_num = Column(Numeric(14, 2))
+    firstuse_date = Column(Date)
+    # Ids of the canonical spelling of the DIMENSION_FIELDS in the dimension table, see `dimensions`. They come on top
+    # of the text columns, for grouping on integers, and make the table larger
+    make_id = Column(Integer)
+    model_id = Column(Integer)
+    colour_id = Column(Integer)
+    fueltype_id = Column(Integer)
+    bodytype_id = Column(Integer)
 
     @classmethod
-    def create_topx(cls, top: int = 10, filter_on_year: int = 2016) -> sase.select:
+    def create_topx(cls, top: int = 10, filter_on_year: int = 2016,
+                    countries: Optional[Iterable[str]] = None) -> sase.select:
+        """
+        Rank the make/models of every country on their average normalized damage. The rows are grouped on the integer
+        ids of make and model, so different spellings of the same make/model count as one. Only the ranked groups are
+        joined to the dimension table for their canonical names.
+
+        :param top: Number of make/models per country, ties included
+        :param filter_on_year: Build year of the cars
+        :param countries: Only rank these countries, all countries if None
+        :return: A sql statement selecting country, make, model, avg_dmg and rnk
+        """
         rank_avg_dmg_year = sase.select([
                 cls.country,
-                cls.make,
-                cls.model,
+                cls.make_id,
+                cls.model_id,
                 sase.func.avg(cls.amount_damage_norm).label("avg_dmg"),
                 sase.func.rank().over(
                     partition_by=cls.country,
                     order_by=sase.func.avg(cls.amount_damage_norm).desc()
                 ).label("rnk")]) \
-            .where(cls.build_year == str(filter_on_year)) \
-            .where(cls.make != "") \
-            .where(cls.model != "") \
-            .where(cls.amount_damage_norm != None) \
-            .group_by(
+            .where(cls.build_year_int == filter_on_year) \
+            .where(cls.make_id != None) \
+            .where(cls.model_id != None) \
+            .where(cls.amount_damage_norm != None)
+        if countries is not None:
+            rank_avg_dmg_year = rank_avg_dmg_year.where(cls.country.in_(countries))
+        rank_avg_dmg_year = rank_avg_dmg_year.group_by(
                 cls.country,
-                cls.make,
-                cls.model
+                cls.make_id,
+                cls.model_id
         ).alias("rank_dmg")
 
-        return sase.select(rank_avg_dmg_year.columns).where(rank_avg_dmg_year.c.rnk <= top).alias("top_x")
+        ranked = rank_avg_dmg_year
+        make = Dimension.__table__.alias("make")
+        model = Dimension.__table__.alias("model")
+        return sase.select([
+                ranked.c.country,
+                make.c.value.label("make"),
+                model.c.value.label("model"),
+                ranked.c.avg_dmg,
+                ranked.c.rnk]) \
+            .select_from(ranked
+                         .join(make, sase.and_(make.c.field == "make", make.c.id == ranked.c.make_id))
+                         .join(model, sase.and_(model.c.field == "model", model.c.id == ranked.c.model_id))) \
+            .where(ranked.c.rnk <= top).alias("top_x")
 
     @classmethod
-    def normalize_amount_damage(cls) -> sase.Update:
+    def damage_ranges(cls, countries: Optional[Iterable[str]] = None) -> sase.select:
         """
-        Apply feature normalization on the amount_damage in the table.
+        Compute the minimum and maximum amount damage per country. A maximum of 0 is replaced by 1. Both come back as
+        Decimals with 2 decimals, so they compare equal to the range stored in the damagerange table.
 
-        :return: A sql statement to update the amount_damage_norm column with normalized amount_damage per country/car
+        :param countries: Only compute the range for these countries, all countries if None
+        :return: A sql statement selecting country, max_dmg and min_dmg
         """
-        # First compute the minimum and maximum amount damage per country
+        damage = cls.amount_damage_num
+        max_dmg = sase.case([(sase.func.max(damage) == 0, 1)], else_=sase.func.max(damage))
         min_max = sase.select([
             cls.country,
-            sase.case([(sase.func.max(sase.cast(cls.amount_damage, Numeric(14, 2))) == 0, 1)],
-                      else_=sase.func.max(sase.cast(cls.amount_damage, Numeric(14, 2)))).label("max_dmg"),
-            sase.func.min(sase.cast(cls.amount_damage, Numeric(14, 2))).label("min_dmg")
-        ]).group_by(cls.country).alias("min_max")
-
-        # Second, use the min and max damage to normalize the damage per car per country and store in separate column
-        norm = sase.update(cls). \
-            where(min_max.c.country == cls.country). \
-            values(amount_damage_norm=(
-                (sase.cast(cls.amount_damage, Numeric(14, 2)) - min_max.c.min_dmg) /
-                (sase.case([(min_max.c.max_dmg == 0, 1)], else_=min_max.c.max_dmg) - min_max.c.min_dmg)
-            ))
+            sase.type_coerce(max_dmg, Numeric(14, 2)).label("max_dmg"),
+            sase.type_coerce(sase.func.min(damage), Numeric(14, 2)).label("min_dmg")
+        ])
+        if countries is not None:
+            min_max = min_max.where(cls.country.in_(countries))
+        return min_max.group_by(cls.country)
+
+    @classmethod
+    def normalize_amount_damage(cls, countries: Optional[Iterable[str]] = None, only_new: bool = False) -> sase.Update:
+        """
+        Apply feature normalization on the amount_damage in the table, with the minimum and maximum damage per country
+        that are stored in the damagerange table, see `damage_ranges`. When all damages of a country are the same its
+        range is 0, then they are all normalized to 0.
+
+        :param countries: Only normalize the damage of these countries, all countries if None
+        :param only_new: Only normalize rows that don't have a normalized damage yet
+        :return: A sql statement to update the amount_damage_norm column with normalized amount_damage per country/car
+        """
+        def range_value(column: Column) -> sase.ColumnElement:
+            return sase.select([column]).where(DamageRange.country == cls.country).as_scalar()
+
+        spread = range_value(DamageRange.max_dmg) - range_value(DamageRange.min_dmg)
+        norm = sase.update(cls).values(amount_damage_norm=TrueDivide(
+            cls.amount_damage_num - range_value(DamageRange.min_dmg),
+            sase.case([(spread == 0, 1)], else_=spread)
+        ))
+        if countries is not None:
+            norm = norm.where(cls.country.in_(countries))
+        if only_new:
+            norm = norm.where(cls.amount_damage_norm == None)
 
         return norm
 
+    @classmethod
+    def pending_countries(cls) -> sase.select:
+        """
+        Countries with rows that have an amount_damage but no normalized damage yet, i.e. that got new rows since the
+        last normalization. Only these countries can have a different damage range or scoreboard.
+
+        :return: A sql statement selecting the distinct countries
+        """
+        return sase.select([cls.country]).where(cls.amount_damage_norm == None).where(cls.amount_damage_num != None) \
+            .distinct()
+
+    @classmethod
+    def countries(cls) -> sase.select:
+        return sase.select([cls.country]).distinct()
+
+    @classmethod
+    def missing_dimension_ids(cls, field: str, countries: Optional[Iterable[str]] = None) -> sase.select:
+        """
+        The distinct values of a dimension field in rows that have no id for it yet, like rows that were loaded as
+        delimited text, see `dimensions.DimensionDictionary.fill_ids`
+
+        :param field: One of DIMENSION_FIELDS
+        :param countries: Only look at the rows of these countries, all countries if None
+        :return: A sql statement selecting the distinct values
+        """
+        value, dimension_id = cls.__table__.c[field], cls.__table__.c[f"{field}_id"]
+        stmt = sase.select([value]).where(dimension_id == None).where(value != None)
+        if countries is not None:
+            stmt = stmt.where(cls.country.in_(countries))
+        return stmt.distinct()
+
+    @classmethod
+    def set_dimension_ids(cls, field: str, countries: Optional[Iterable[str]] = None) -> sase.Update:
+        """
+        Statement to set the id of a dimension field in the rows without one, to be executed with a "raw" and an "id"
+        parameter for every value
+
+        :param field: One of DIMENSION_FIELDS
+        :param countries: Only update the rows of these countries, all countries if None
+        :return: update statement object that can be executed against the database
+        """
+        value, dimension_id = cls.__table__.c[field], cls.__table__.c[f"{field}_id"]
+        stmt = sase.update(cls).where(value == sase.bindparam("raw")).where(dimension_id == None)
+        if countries is not None:
+            stmt = stmt.where(cls.country.in_(countries))
+        return stmt.values({dimension_id: sase.bindparam("id")})
+
     @classmethod
     def nr_of_rows(cls):
         return sase.select([sase.func.count()]).select_from(cls)
 
     @classmethod
-    def null_empty_string(cls, session: Type[sessionmaker], field: Type[Any] = amount_damage) -> None:
+    def null_empty_string(cls, session: Type[sessionmaker], field: Type[Any] = amount_damage,
+                          countries: Optional[Iterable[str]] = None) -> None:
         """
         Fields to be case to Numeric need to be NULL first instead of an empty string because CAST works differently
         underwater in SELECT than it does in UPDATE queries. The UPDATE query raises a
@@ -115,12 +254,16 @@ class Vehicle(declarative_base()):
 
         :param session: sqlalchemy session object to talk to the database
         :param field: Field that needs to NULLed
+        :param countries: Only update the rows of these countries, all countries if None
         :return: None
         """
-        session.query(cls).filter(field == "").update({field: sase.null()}, synchronize_session=False)
+        query = session.query(cls).filter(field == "")
+        if countries is not None:
+            query = query.filter(cls.country.in_(countries))
+        query.update({field: sase.null()}, synchronize_session=False)
 
     @classmethod
-    def sanitize_build_year(cls) -> sase.Update:
+    def sanitize_build_year(cls, countries: Optional[Iterable[str]] = None) -> sase.Update:
         """
         Query to update build_year with the year in firstuse if build_year is lower than 1940 and higher than 2020.
         A quick scna of the data showed that 1940 is approximately the lowest build_year found that looks reasonable
@@ -128,16 +271,21 @@ class Vehicle(declarative_base()):
         optimistic.
         All "years" that fall outside of this range are overwritten with the year of firstuse. If firstuse has a
         diverging year that is not further remedied because there is not anything to quickly test or check against.
+        The typed build_year_int column is kept in step, the range check uses it so no string has to be cast.
 
+        :param countries: Only update the rows of these countries, all countries if None
         :return: A sql statement to update the build_year column with the firstuse year
         """
-
-        stmt = sase.update(cls).prefix_with("IGNORE").where(sase.or_(
-            sase.cast(cls.build_year, Integer) < constants.MIN_YEAR,
-            sase.cast(cls.build_year, Integer) > constants.MAX_YEAR)
+        firstuse_year = sase.extract('year', cls.firstuse_date)
+        stmt = sase.update(cls).where(sase.or_(
+            cls.build_year_int < constants.MIN_YEAR,
+            cls.build_year_int > constants.MAX_YEAR)
         ).values(
-            build_year=sase.cast(sase.extract('year', sase.cast(cls.firstuse, Date)), String)
+            build_year=sase.cast(firstuse_year, String),
+            build_year_int=firstuse_year
         )
+        if countries is not None:
+            stmt = stmt.where(cls.country.in_(countries))
         return stmt
 
 
@@ -188,6 +336,38 @@ class Mater(declarative_base()):
     col40 = Column(String(255))
 
 
+class Dimension(declarative_base()):
+    __tablename__ = 'dimension'
+    __table_args__ = (
+        PrimaryKeyConstraint('id'),
+        UniqueConstraint('field', 'value'),
+    )
+    id = Column(Integer, autoincrement=True)
+    field = Column(String(32))
+    value = Column(String(255))
+
+    def __repr__(self):
+        return f"dimension(id={self.id}; field={self.field}; value={self.value})"
+
+    @classmethod
+    def find(cls, field: Optional[str] = None) -> sase.select:
+        stmt = sase.select([cls.field, cls.id, cls.value])
+        if field is not None:
+            stmt = stmt.where(cls.field == field)
+        return stmt
+
+    @classmethod
+    def record(cls) -> sase.Insert:
+        """
+        Statement to add values to the table, to be executed with a "field" and a "value" per row. The database assigns
+        the ids. A value that is in the table already, like one that another process stored in the meantime, is
+        skipped; on SQLite with OR IGNORE.
+
+        :return: insert statement object that can be executed against the database
+        """
+        return sase.insert(cls).prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+
+
 class PistonCup(declarative_base()):
     __tablename__ = 'pistoncup'
     __table_args__ = (
@@ -204,13 +384,68 @@ class PistonCup(declarative_base()):
                f"amount_damage={self.amount_damage}; rank={self.rnk})"
 
     @classmethod
-    def wipe_slate(cls):
-        return sase.delete(cls)
+    def wipe_slate(cls, countries: Optional[Iterable[str]] = None) -> sase.Delete:
+        stmt = sase.delete(cls)
+        if countries is not None:
+            stmt = stmt.where(cls.country.in_(countries))
+        return stmt
 
     @classmethod
     def import_scoreboard(cls, top_x: sase.select) -> sase.insert:
         return sase.insert(cls).from_select(inspect(cls).columns.keys(), sase.select(top_x.columns))
 
+    @classmethod
+    def find(cls, top: int, country: Optional[str] = None) -> sase.select:
+        stmt = sase.select([cls.country, cls.make, cls.model, cls.amount_damage, cls.rnk]).where(cls.rnk <= top)
+        if country is not None:
+            stmt = stmt.where(cls.country == country)
+        return stmt
+
+
+class YearScoreboard(declarative_base()):
+    __tablename__ = 'yearscoreboard'
+    __table_args__ = (
+        PrimaryKeyConstraint('year', 'country', 'make', 'model'),
+    )
+    year = Column(Integer)
+    country = Column(String(4))
+    make = Column(String(255))
+    model = Column(String(255))
+    amount_damage = Column(String(255))
+    rnk = Column(Integer)
+
+    def __repr__(self):
+        return f"yearscoreboard(year={self.year}; country={self.country}; make={self.make}; model={self.model}; " \
+               f"amount_damage={self.amount_damage}; rank={self.rnk})"
+
+    @classmethod
+    def wipe_slate(cls, years: Iterable[int], countries: Optional[Iterable[str]] = None) -> sase.Delete:
+        stmt = sase.delete(cls).where(cls.year.in_(years))
+        if countries is not None:
+            stmt = stmt.where(cls.country.in_(countries))
+        return stmt
+
+    @classmethod
+    def import_scoreboard(cls, year: int, top_x: sase.select) -> sase.insert:
+        """
+        Statement to store the scoreboard of one build year, see `Vehicle.create_topx`
+
+        :param year: The build year the scoreboard was made for
+        :param top_x: The scoreboard of that year
+        :return: insert statement object that can be executed against the database
+        """
+        return sase.insert(cls).from_select(
+            inspect(cls).columns.keys(), sase.select([sase.literal(year)] + list(top_x.columns))
+        )
+
+    @classmethod
+    def find(cls, year: int, top: int, country: Optional[str] = None) -> sase.select:
+        stmt = sase.select([cls.country, cls.make, cls.model, cls.amount_damage, cls.rnk]) \
+            .where(cls.year == year).where(cls.rnk <= top)
+        if country is not None:
+            stmt = stmt.where(cls.country == country)
+        return stmt
+
 
 class WeirdYears(declarative_base()):
     __tablename__ = 'weirdyears'
@@ -226,38 +461,245 @@ class WeirdYears(declarative_base()):
         return f"weirdyears(country={self.country}; make={self.make}; model={self.model}; build_year={self.build_year})"
 
     @classmethod
-    def save_weird_years(cls, source_table: Type[declarative_base] = Vehicle) -> sase.Insert:
+    def save_weird_years(cls, source_table: Type[declarative_base] = Vehicle,
+                         countries: Optional[Iterable[str]] = None) -> sase.Insert:
         """
         This function generates the statement to insert weird build_years with accompanying primary keys to
         this table.
-        The `prefix_with("IGNORE")` is to run the query even though some strings cannot be converted to integers.
-        The result is still as expected.
+        The IGNORE prefix is to skip rows with a primary key that is already in this table, on SQLite it is OR IGNORE.
 
         :param source_table: Main table where all unsanitized data is stored, is. vehicles
+        :param countries: Only save the weird years of these countries, all countries if None
         :return: insert statement object that can be executed against the database
         """
-
-        stmt = sase.insert(cls).prefix_with("IGNORE").from_select(
-            inspect(cls).columns.keys(),
-            sase.select(
-                [source_table.country, source_table.vehicle_id, source_table.licence, source_table.build_year]
-            ).where(
-                sase.or_(
-                    sase.cast(source_table.build_year, Integer) < constants.MIN_YEAR,
-                    sase.cast(source_table.build_year, Integer) > constants.MAX_YEAR)
-            )
+        weird = sase.select(
+            [source_table.country, source_table.vehicle_id, source_table.licence, source_table.build_year]
+        ).where(
+            sase.or_(
+                source_table.build_year_int < constants.MIN_YEAR,
+                source_table.build_year_int > constants.MAX_YEAR)
         )
+        if countries is not None:
+            weird = weird.where(source_table.country.in_(countries))
+
+        stmt = sase.insert(cls).prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+        return stmt.from_select(inspect(cls).columns.keys(), weird)
+
+
+class DamageRange(declarative_base()):
+    __tablename__ = 'damagerange'
+    __table_args__ = (
+        PrimaryKeyConstraint('country'),
+    )
+    country = Column(String(4))
+    min_dmg = Column(Numeric(14, 2))
+    max_dmg = Column(Numeric(14, 2))
+
+    def __repr__(self):
+        return f"damagerange(country={self.country}; min_dmg={self.min_dmg}; max_dmg={self.max_dmg})"
+
+    @classmethod
+    def find(cls, countries: Optional[Iterable[str]] = None) -> sase.select:
+        stmt = sase.select([cls.country, cls.max_dmg, cls.min_dmg])
+        if countries is not None:
+            stmt = stmt.where(cls.country.in_(countries))
         return stmt
 
+    @classmethod
+    def forget(cls, countries: Iterable[str]) -> sase.Delete:
+        return sase.delete(cls).where(cls.country.in_(countries))
+
+    @classmethod
+    def record(cls) -> sase.Insert:
+        return sase.insert(cls)
+
+
+class IngestManifest(declarative_base()):
+    __tablename__ = 'ingestmanifest'
+    __table_args__ = (
+        PrimaryKeyConstraint('file_name'),
+    )
+    file_name = Column(String(255))
+    size = Column(BigInteger)
+    checksum = Column(String(64))
+    vehicles_rows = Column(Integer)
+    mater_rows = Column(Integer)
+    duplicate_rows = Column(Integer)
+    loaded_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"ingestmanifest(file_name={self.file_name}; size={self.size}; checksum={self.checksum}; " \
+               f"vehicles_rows={self.vehicles_rows}; mater_rows={self.mater_rows}; " \
+               f"duplicate_rows={self.duplicate_rows}; loaded_at={self.loaded_at})"
+
+    @classmethod
+    def find(cls, file_name: str) -> sase.select:
+        return sase.select([cls.size, cls.checksum]).where(cls.file_name == file_name)
+
+    @classmethod
+    def forget(cls, file_name: str) -> sase.Delete:
+        return sase.delete(cls).where(cls.file_name == file_name)
+
+    @classmethod
+    def record(cls, **values: Any) -> sase.Insert:
+        """
+        Statement to add a file to the manifest. Remove an older entry of the same file first with `forget`.
+
+        :param values: A value for every column of the table
+        :return: insert statement object that can be executed against the database
+        """
+        return sase.insert(cls).values(**values)
+
+
+class IngestCheckpoint(declarative_base()):
+    __tablename__ = 'ingestcheckpoint'
+    __table_args__ = (
+        PrimaryKeyConstraint('file_name'),
+    )
+    file_name = Column(String(255))
+    size = Column(BigInteger)
+    checksum = Column(String(64))
+    chunk_size = Column(Integer)
+    chunk_kind = Column(String(8))
+    chunks = Column(Integer)
+    vehicles_read = Column(Integer)
+    vehicles_rows = Column(Integer)
+    mater_read = Column(Integer)
+    mater_rows = Column(Integer)
+    updated_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"ingestcheckpoint(file_name={self.file_name}; size={self.size}; checksum={self.checksum}; " \
+               f"chunk_size={self.chunk_size}; chunk_kind={self.chunk_kind}; chunks={self.chunks}; " \
+               f"updated_at={self.updated_at})"
+
+    @classmethod
+    def find(cls, file_name: Optional[str] = None) -> sase.select:
+        stmt = sase.select([cls])
+        if file_name is not None:
+            stmt = stmt.where(cls.file_name == file_name)
+        return stmt
+
+    @classmethod
+    def forget(cls, file_name: Optional[str] = None) -> sase.Delete:
+        stmt = sase.delete(cls)
+        if file_name is not None:
+            stmt = stmt.where(cls.file_name == file_name)
+        return stmt
+
+    @classmethod
+    def record(cls, **values: Any) -> sase.Insert:
+        """
+        Statement to store how far the load of a file got, see `main.stream_into_database`. Remove the older
+        checkpoint of the same file first with `forget`.
+
+        :param values: A value for every column of the table
+        :return: insert statement object that can be executed against the database
+        """
+        return sase.insert(cls).values(**values)
+
+
+class TransformCheckpoint(declarative_base()):
+    __tablename__ = 'transformcheckpoint'
+    __table_args__ = (
+        PrimaryKeyConstraint('step', 'country'),
+    )
+    step = Column(String(32))
+    country = Column(String(4))
+    planned_at = Column(DateTime)
+    completed_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"transformcheckpoint(step={self.step}; country={self.country}; planned_at={self.planned_at}; " \
+               f"completed_at={self.completed_at})"
+
+    @classmethod
+    def find(cls) -> sase.select:
+        return sase.select([cls.step, cls.country, cls.completed_at])
+
+    @classmethod
+    def plan(cls) -> sase.Insert:
+        return sase.insert(cls)
+
+    @classmethod
+    def complete(cls, step: str, country: str, completed_at: datetime) -> sase.Update:
+        """
+        Statement to mark a batch of the transformation as done, see `transform.TransformExecutor`
+
+        :param step: Name of the step
+        :param country: The country the step was run for
+        :param completed_at: When the batch was done
+        :return: update statement object that can be executed against the database
+        """
+        return sase.update(cls).where(cls.step == step).where(cls.country == country) \
+            .values(completed_at=completed_at)
+
+    @classmethod
+    def wipe_slate(cls, steps: Optional[Iterable[str]] = None) -> sase.Delete:
+        stmt = sase.delete(cls)
+        if steps is not None:
+            stmt = stmt.where(cls.step.in_(steps))
+        return stmt
+
+
+TABLES = [Vehicle, Mater, Dimension, PistonCup, YearScoreboard, WeirdYears, DamageRange, IngestManifest,
+          IngestCheckpoint, TransformCheckpoint]
+
+
+def forget_keys(table: Type[declarative_base], keys: List[Tuple[str, ...]]) -> sase.Delete:
+    """
+    Statement to delete the rows with these primary keys from a table
+
+    :param table: sqlalchemy declarativeMeta class with a primary key of country, vehicle_id and licence
+    :param keys: The primary keys of the rows to delete
+    :return: delete statement object that can be executed against the database
+    """
+    return sase.delete(table).where(sase.tuple_(*table.__table__.primary_key.columns).in_(keys))
+
+
+def parsed_columns(table: Type[declarative_base]) -> List[Column]:
+    """
+    The columns of a table that are filled by parsing a part file, in the order of the values of a row as
+    `preprocess.route_row` returns it. The dimension ids of vehicles are only added when the rows are loaded.
+
+    :param table: sqlalchemy declarativeMeta class, Vehicle or Mater
+    :return: The columns
+    """
+    dimension_ids = {f"{field}_id" for field in DIMENSION_FIELDS} if table is Vehicle else set()
+    return [column for column in table.__table__.columns if column.name not in dimension_ids]
+
 
 def initialize_database(engine: Any) -> None:
-    Vehicle.__table__.create(bind=engine, checkfirst=True)
-    Mater.__table__.create(bind=engine, checkfirst=True)
-    PistonCup.__table__.create(bind=engine, checkfirst=True)
-    WeirdYears.__table__.create(bind=engine, checkfirst=True)
+    for table in TABLES:
+        table.__table__.create(bind=engine, checkfirst=True)
+
+
+def missing_columns(engine: Any) -> Dict[str, List[str]]:
+    """
+    Compare the tables in the database with their definition here. `initialize_database` only creates tables that
+    don't exist, a table that was created by an older version keeps the columns it had then.
+
+    :param engine: a Sqlalchemy engine object
+    :return: The names of the columns that are missing, per existing table that lacks any
+    """
+    inspector = inspect(engine)
+    table_names = inspector.get_table_names()
+    missing = dict()
+    for table in TABLES:
+        if table.__tablename__ in table_names:
+            columns = {column["name"] for column in inspector.get_columns(table.__tablename__)}
+            absent = [name for name in table.__table__.columns.keys() if name not in columns]
+            if absent:
+                missing[table.__tablename__] = absent
+    return missing
 
 
 def is_initialized(engine: Any) -> bool:
+    missing = missing_columns(engine)
+    if missing:
+        tables = "; ".join(f"{table} lacks {', '.join(columns)}" for table, columns in missing.items())
+        raise RuntimeError(f"The database was created by an older version of the pipeline: {tables}. Drop these "
+                           f"tables, or start with a fresh database, and load the part files again.")
     table_names = inspect(engine).get_table_names()
-    is_empty = table_names == []
-    return not is_empty
+    is_complete = all(table.__tablename__ in table_names for table in TABLES)
+    return is_complete
@@ -0,0 +1,178 @@
+from typing import Any, Callable, Dict, List, Set, Tuple, Type
+
+import numpy as np
+import sqlalchemy.sql.expression as sase
+
+import constants
+import database
+
+# The primary key of a vehicle or mater row: country, vehicle_id and licence
+Key = Tuple[str, str, str]
+# Function that gets keys whose fingerprint was seen in an earlier batch and returns the ones that really were
+Confirm = Callable[[List[Key]], Set[Key]]
+
+
+class FingerprintSet:
+    """
+    Set of 64 bit fingerprints in a numpy array with open addressing and linear probing. A batch of fingerprints is
+    looked up and added with a handful of vectorized passes, one per probe step, instead of one python call per key.
+    0 marks an empty slot, a fingerprint of 0 is stored as 1. The table doubles when it is more than max_load full.
+    """
+
+    def __init__(self, capacity: int = constants.DEDUP_INITIAL_CAPACITY, max_load: float = constants.DEDUP_MAX_LOAD):
+        """
+        :param capacity: Initial number of slots, rounded up to a power of 2
+        :param max_load: Fraction of the slots that may be used before the table grows
+        """
+        self.max_load = max_load
+        self.size = 0
+        self._table = np.zeros(1 << max(capacity - 1, 1).bit_length(), dtype=np.uint64)
+
+    @property
+    def nbytes(self) -> int:
+        return self._table.nbytes
+
+    def _grow(self, needed: int) -> None:
+        capacity = len(self._table)
+        while needed > capacity * self.max_load:
+            capacity *= 2
+        if capacity == len(self._table):
+            return
+        stored = self._table[self._table != 0]
+        self._table = np.zeros(capacity, dtype=np.uint64)
+        self.size = 0
+        self._insert(stored)
+
+    def _insert(self, fingerprints: np.ndarray) -> np.ndarray:
+        """
+        Add distinct fingerprints to the table
+
+        :param fingerprints: Fingerprints without duplicates and without 0
+        :return: For every fingerprint whether it was in the table already
+        """
+        mask = np.uint64(len(self._table) - 1)
+        found = np.zeros(len(fingerprints), dtype=bool)
+        pending = np.arange(len(fingerprints))
+        slots = fingerprints & mask
+        while pending.size:
+            current = self._table[slots[pending]]
+            hit = current == fingerprints[pending]
+            found[pending[hit]] = True
+            # Of several fingerprints that probe the same empty slot only the first takes it, the others see it taken
+            # on the next pass
+            empty = np.flatnonzero(current == 0)
+            _, first = np.unique(slots[pending[empty]], return_index=True)
+            winners = pending[empty[first]]
+            self._table[slots[winners]] = fingerprints[winners]
+            self.size += len(winners)
+
+            taken = (current != 0) & ~hit
+            slots[pending[taken]] = (slots[pending[taken]] + np.uint64(1)) & mask
+            done = hit.copy()
+            done[empty[first]] = True
+            pending = pending[~done]
+        return found
+
+    def add(self, fingerprints: np.ndarray) -> np.ndarray:
+        """
+        Add a batch of fingerprints
+
+        :param fingerprints: Fingerprints, in order
+        :return: For every fingerprint whether it was added before, by an earlier batch or earlier in this batch
+        """
+        fingerprints = np.where(fingerprints == 0, np.uint64(1), fingerprints)
+        distinct, first, inverse = np.unique(fingerprints, return_index=True, return_inverse=True)
+        self._grow(self.size + len(distinct))
+        seen_before = self._insert(distinct)[inverse]
+        return seen_before | (first[inverse] != np.arange(len(fingerprints)))
+
+
+class Deduplicator:
+    """
+    Streaming deduplication on the (country, vehicle_id, licence) primary key that keeps the first row of every key,
+    like the INSERT IGNORE of `loader.bulk_load`. Only an 8 byte fingerprint of every unique key is kept, in a
+    `FingerprintSet`, so memory grows with the number of unique keys instead of with the width of the rows.
+
+    A fingerprint that is found again is confirmed exactly before a row is dropped. Within a batch the keys themselves
+    are compared. A key whose fingerprint comes from an earlier batch is handed to confirm, which looks it up where
+    the kept rows went, like the database with `database_confirm`. Keys that turn out to be different are counted as
+    collisions and kept.
+    """
+
+    def __init__(self, confirm: Confirm, capacity: int = constants.DEDUP_INITIAL_CAPACITY,
+                 fingerprint: Callable[[Key], int] = hash):
+        """
+        :param confirm: Function that returns which of the keys are in the rows that were kept before
+        :param capacity: Initial number of slots of the fingerprint set
+        :param fingerprint: Function that turns a key into a 64 bit integer, the hash of python by default, which is
+            only stable within one process
+        """
+        self.confirm = confirm
+        self.fingerprint = fingerprint
+        self.fingerprints = FingerprintSet(capacity)
+        self.nr_of_rows = 0
+        self.duplicates = 0
+        self.collisions = 0
+
+    def drop_duplicates(self, rows: List[List[Any]]) -> List[List[Any]]:
+        """
+        :param rows: Rows as `preprocess.route_row` returns them, in load order
+        :return: The rows with a primary key that was not seen before, in the same order
+        """
+        self.nr_of_rows += len(rows)
+        if not rows:
+            return rows
+        keys: List[Key] = [(row[0], row[1], row[2]) for row in rows]
+        fingerprints = np.fromiter(map(self.fingerprint, keys), dtype=np.int64, count=len(keys)).view(np.uint64)
+        fingerprints[fingerprints == 0] = 1
+        seen = self.fingerprints.add(fingerprints)
+        if not seen.any():
+            return rows
+
+        # Every row of a suspected fingerprint is checked in order: the first row of a fingerprint that is new in this
+        # batch is kept, every later one is compared with the keys kept for it in this batch. When the fingerprint was
+        # in an earlier batch, all of its rows here are seen and their keys are confirmed.
+        positions = np.flatnonzero(np.isin(fingerprints, fingerprints[seen])).tolist()
+        suspected = fingerprints[positions].tolist()
+        was_seen = seen[positions].tolist()
+        from_earlier = set(suspected).difference(
+            fingerprint for fingerprint, is_seen in zip(suspected, was_seen) if not is_seen
+        )
+        confirmed = set()
+        if from_earlier:
+            confirmed = self.confirm(sorted({keys[position] for position, fingerprint in zip(positions, suspected)
+                                             if fingerprint in from_earlier}))
+
+        kept: Dict[int, Set[Key]] = dict()
+        dropped = set()
+        for position, fingerprint, is_seen in zip(positions, suspected, was_seen):
+            key, keys_in_batch = keys[position], kept.setdefault(fingerprint, set())
+            if key in keys_in_batch or key in confirmed:
+                dropped.add(position)
+            else:
+                keys_in_batch.add(key)
+                self.collisions += is_seen
+        self.duplicates += len(dropped)
+        return [row for position, row in enumerate(rows) if position not in dropped]
+
+
+def database_confirm(table: Type[database.declarative_base], engine: Any,
+                     batch_size: int = constants.DEDUP_CONFIRM_BATCH_SIZE) -> Confirm:
+    """
+    Confirm keys against the rows that are in a table already, for a `Deduplicator` of the rows loaded into it
+
+    :param table: sqlalchemy declarativeMeta class, Vehicle or Mater
+    :param engine: a Sqlalchemy engine object
+    :param batch_size: Number of keys looked up per query
+    :return: Function that returns which of the keys are in the table
+    """
+    key = sase.tuple_(*table.__table__.primary_key.columns)
+
+    def confirm(keys: List[Key]) -> Set[Key]:
+        found = set()
+        for start in range(0, len(keys), batch_size):
+            stmt = sase.select(list(key.clauses)).where(key.in_(keys[start:start + batch_size]))
+            found.update(tuple(row) for row in engine.execute(stmt))
+        return found
+
+    return confirm
@@ -0,0 +1,144 @@
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+from weakref import WeakKeyDictionary
+
+import constants
+import database
+
+# Runs of whitespace, collapsed to one space in a canonical value
+WHITESPACE = re.compile(r"\s+")
+
+
+def canonical(field: str, value: Optional[str]) -> Optional[str]:
+    """
+    The canonical spelling of a value of a dimension field: upper case, without surrounding whitespace and with single
+    spaces, then replaced by its alias in `constants.DIMENSION_ALIASES` if it has one. An empty value is None.
+
+    :param field: One of `database.DIMENSION_FIELDS`
+    :param value: The value as it was parsed
+    :return: The canonical spelling
+    """
+    if value is None:
+        return None
+    spelling = WHITESPACE.sub(" ", value).strip().upper()
+    if not spelling:
+        return None
+    return constants.DIMENSION_ALIASES.get(field, dict()).get(spelling, spelling)
+
+
+class DimensionDictionary:
+    """
+    Maps the raw values of the `database.DIMENSION_FIELDS` to the integer id of their canonical spelling in the
+    dimension table. All ids are read once, after that a raw value is looked up in memory. A canonical spelling that is
+    not in the table yet is stored right away, in a transaction of its own, so it can be used by rows that are written
+    over any connection. The database assigns its id: the ids of the field are read again afterwards, which also picks
+    up the values that other processes stored meanwhile.
+
+    One dictionary is shared by all threads that load into the same database, see `dictionary_for`.
+    """
+
+    def __init__(self, engine: Any):
+        """
+        :param engine: a Sqlalchemy engine object
+        """
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._ids: Optional[Dict[str, Dict[str, int]]] = None
+        self._raw: Dict[str, Dict[Optional[str], Optional[int]]] = {
+            field: dict() for field in database.DIMENSION_FIELDS
+        }
+
+    def _load(self) -> Dict[str, Dict[str, int]]:
+        if self._ids is None:
+            ids: Dict[str, Dict[str, int]] = {field: dict() for field in database.DIMENSION_FIELDS}
+            for row in self.engine.execute(database.Dimension.find()):
+                ids.setdefault(row.field, dict())[row.value] = row.id
+            self._ids = ids
+        return self._ids
+
+    def lookup(self, field: str, values: Iterable[Optional[str]]) -> List[Optional[int]]:
+        """
+        :param field: One of `database.DIMENSION_FIELDS`
+        :param values: Raw values of the field
+        :return: The id of every value, None for an empty value
+        """
+        values = list(values)
+        raw = self._raw[field]
+        missing = set(values).difference(raw)
+        if missing:
+            with self._lock:
+                ids = self._load()[field]
+                spellings = {value: canonical(field, value) for value in missing}
+                # In sorted order, so the same values get the same ids in every run
+                unknown = sorted(set(spellings.values()).difference(ids, [None]))
+                if unknown:
+                    with self.engine.begin() as connection:
+                        connection.execute(database.Dimension.record(),
+                                           [{"field": field, "value": spelling} for spelling in unknown])
+                        ids.update((row.value, row.id) for row in connection.execute(database.Dimension.find(field)))
+                raw.update({value: ids.get(spelling) for value, spelling in spellings.items()})
+        return list(map(raw.__getitem__, values))
+
+    def encode(self, rows: List[List[Any]]) -> List[List[Any]]:
+        """
+        Add the dimension ids to vehicle rows as `preprocess.route_row` returns them
+
+        :param rows: Vehicle rows
+        :return: The rows with the id of every dimension field appended, in the order of `database.DIMENSION_FIELDS`
+        """
+        if not rows:
+            return rows
+        names = [column.name for column in database.parsed_columns(database.Vehicle)]
+        width = len(names)
+        columns = list(zip(*rows))
+        ids = [self.lookup(field, columns[names.index(field)]) for field in database.DIMENSION_FIELDS]
+        return [row[:width] + list(row_ids) for row, row_ids in zip(rows, zip(*ids))]
+
+    def fill_ids(self, session: Any, countries: Optional[Iterable[str]] = None) -> int:
+        """
+        Set the dimension ids of vehicles that were stored without them, with one update per distinct value. Call it
+        before the session writes anything: new dimension values are stored over a connection of their own, so the ids
+        of all fields are looked up before the first update. Otherwise the store would wait for the write lock of the
+        session on SQLite.
+
+        :param session: sqlalchemy session object to talk to the database
+        :param countries: Only fill the rows of these countries, all countries if None
+        :return: The number of updated values
+        """
+        vehicles = database.Vehicle
+        countries = None if countries is None else list(countries)
+        updates = dict()
+        for field in database.DIMENSION_FIELDS:
+            values = [row[0] for row in session.execute(vehicles.missing_dimension_ids(field, countries))]
+            updates[field] = [{"raw": value, "id": key} for value, key in zip(values, self.lookup(field, values))
+                              if key is not None]
+        for field, ids in updates.items():
+            if ids:
+                session.execute(vehicles.set_dimension_ids(field, countries), ids)
+        return sum(map(len, updates.values()))
+
+
+_dictionaries: "WeakKeyDictionary[Any, DimensionDictionary]" = WeakKeyDictionary()
+_dictionaries_lock = threading.Lock()
+
+
+def dictionary_for(engine: Any) -> DimensionDictionary:
+    """
+    :param engine: a Sqlalchemy engine object
+    :return: The dimension dictionary of the database of engine, shared by all callers
+    """
+    with _dictionaries_lock:
+        dictionary = _dictionaries.get(engine)
+        if dictionary is None:
+            dictionary = _dictionaries[engine] = DimensionDictionary(engine)
+        return dictionary
+
+
+def fill_ids(session: Any, countries: Optional[Iterable[str]] = None) -> int:
+    """
+    Set the missing dimension ids of vehicles with the dictionary of the database of session, see
+    `DimensionDictionary.fill_ids`
+    """
+    return dictionary_for(session.get_bind()).fill_ids(session, countries)
+
@@ -0,0 +1,157 @@
+import argparse
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import csv
+import gzip
+import json
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import sqlalchemy.sql.expression as sase
+
+import constants
+import database
+
+# Tables that can be exported, by name
+EXPORT_TABLES = {
+    table.__tablename__: table
+    for table in (database.Vehicle, database.Mater, database.WeirdYears, database.PistonCup)
+}
+# File extension per export format, the files are always gzipped
+EXPORT_FORMATS = {
+    "csv": "csv.gz",
+    "jsonl": "jsonl.gz",
+}
+
+
+def iter_batches(engine: Any, table_name: str, country: Optional[str] = None,
+                 batch_size: int = constants.EXPORT_BATCH_SIZE) -> Iterator[List[Sequence[Any]]]:
+    """
+    Read a table in batches of batch_size rows, in primary key order. The rows are fetched from a server side cursor,
+    so the client never holds more than one batch, no matter how large the table is.
+
+    :param engine: a Sqlalchemy engine object
+    :param table_name: Name of the table, one of `EXPORT_TABLES`
+    :param country: Only read the rows of this country
+    :param batch_size: Number of rows per batch
+    :return: a generator yielding the batches of rows
+    """
+    table = EXPORT_TABLES[table_name].__table__
+    stmt = sase.select([table]).order_by(*table.primary_key.columns)
+    if country is not None:
+        stmt = stmt.where(table.c.country == country)
+
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(stmt)
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            yield batch
+
+
+def export_table(engine: Any, table_name: str, path: str, export_format: str = "csv", country: Optional[str] = None,
+                 batch_size: int = constants.EXPORT_BATCH_SIZE, stop: Optional[threading.Event] = None) -> int:
+    """
+    Stream a table into a gzipped csv or json lines file. The csv file starts with a header and has an empty field for
+    NULL. In the json lines file every row is an object, with dates and decimals as strings. The file is written under
+    a temporary name first, which is removed when the export fails, so it never leaves a half written file behind.
+
+    :param engine: a Sqlalchemy engine object
+    :param table_name: Name of the table, one of `EXPORT_TABLES`
+    :param path: Location of the file
+    :param export_format: csv or jsonl
+    :param country: Only export the rows of this country
+    :param batch_size: Number of rows fetched from the database at a time
+    :param stop: Event that makes the export fail before the next batch when it is set
+    :return: The number of exported rows
+    """
+    columns = EXPORT_TABLES[table_name].__table__.columns.keys()
+    nr_of_rows = 0
+    try:
+        with gzip.open(f"{path}.tmp", "wt", newline="", encoding="utf-8") as f:
+            if export_format == "csv":
+                writer = csv.writer(f)
+                writer.writerow(columns)
+            for batch in iter_batches(engine, table_name, country, batch_size):
+                if stop is not None and stop.is_set():
+                    raise RuntimeError(f"Export to {path} stopped")
+                if export_format == "csv":
+                    writer.writerows(batch)
+                else:
+                    f.writelines(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in batch)
+                nr_of_rows += len(batch)
+    except BaseException:
+        # Don't leave a half written file behind when the export fails
+        if os.path.exists(f"{path}.tmp"):
+            os.remove(f"{path}.tmp")
+        raise
+    os.replace(f"{path}.tmp", path)
+
+    print(f"Exported {nr_of_rows} rows of {table_name}{f' of {country}' if country else ''} to {path}")
+    return nr_of_rows
+
+
+def export_partitioned(engine: Any, table_name: str, destination: str, export_format: str = "csv",
+                       workers: int = constants.EXPORT_WORKERS,
+                       batch_size: int = constants.EXPORT_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Export a table into one file per country, <table>_<country>.<extension> in destination. The countries are exported
+    by a pool of threads, each over its own connection from the pool of engine. When one country fails the countries
+    that didn't start are cancelled and the running ones stop after their current batch, removing their temporary files.
+
+    :param engine: a Sqlalchemy engine object, with a connection pool of at least workers connections
+    :param table_name: Name of the table, one of `EXPORT_TABLES`
+    :param destination: Directory to write the files to
+    :param export_format: csv or jsonl
+    :param workers: Number of threads
+    :param batch_size: Number of rows fetched from the database at a time
+    :return: The number of exported rows per file
+    """
+    table = EXPORT_TABLES[table_name].__table__
+    countries = [row.country for row in engine.execute(sase.select([table.c.country]).distinct())]
+    paths = [os.path.join(destination, f"{table_name}_{country}.{EXPORT_FORMATS[export_format]}")
+             for country in countries]
+
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(export_table, engine, table_name, path, export_format, country, batch_size, stop)
+                   for country, path in zip(countries, paths)]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            stop.set()
+            for future in futures:
+                future.cancel()
+            raise
+    return {path: future.result() for path, future in zip(paths, futures)}
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Export a table to gzipped csv or json lines files")
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES), help="Table to export")
+    parser.add_argument("--format", dest="export_format", choices=sorted(EXPORT_FORMATS), default="csv",
+                        help="File format")
+    parser.add_argument("--destination", default=constants.EXPORT_FOLDER, help="Directory to write the files to")
+    parser.add_argument("--per-country", action="store_true", help="Write one file per country, in parallel")
+    parser.add_argument("--workers", type=int, default=constants.EXPORT_WORKERS,
+                        help="Number of countries exported at the same time")
+    parser.add_argument("--batch-size", type=int, default=constants.EXPORT_BATCH_SIZE,
+                        help="Number of rows fetched from the database at a time")
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    import utils
+
+    arguments = parse_args()
+    os.makedirs(arguments.destination, exist_ok=True)
+    engine = utils.get_db_engine(pool_size=max(arguments.workers, constants.DB_POOL_SIZE))
+    if arguments.per_country:
+        export_partitioned(engine, arguments.table, arguments.destination, arguments.export_format,
+                           arguments.workers, arguments.batch_size)
+    else:
+        file_name = f"{arguments.table}.{EXPORT_FORMATS[arguments.export_format]}"
+        export_table(engine, arguments.table, os.path.join(arguments.destination, file_name), arguments.export_format,
+                     batch_size=arguments.batch_size)
@@ -0,0 +1,295 @@
+import io
+from itertools import chain, islice, repeat
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Type, Union
+
+from sqlalchemy import MetaData
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.declarative import declarative_base
+import sqlalchemy.sql.expression as sase
+from sqlalchemy.sql.schema import Column, Table
+from sqlalchemy.sql.sqltypes import Integer
+
+import constants
+import database
+import dimensions
+import preprocess
+
+TableLike = Union[Table, Type[declarative_base]]
+
+
+def get_table(table: TableLike) -> Table:
+    """
+    Return the Table object of a declarative class, or the object itself if it already is a Table
+
+    :param table: sqlalchemy declarativeMeta class or Table object
+    :return: sqlalchemy Table object
+    """
+    return getattr(table, "__table__", table)
+
+
+def insert_ignore(table: TableLike, dialect_name: str) -> sase.Insert:
+    """
+    Insert statement that silently skips rows with a primary key that is already in the table. The first row with a
+    given primary key wins, just like `drop_duplicates(keep='first')`.
+
+    :param table: sqlalchemy declarativeMeta class or Table object to insert into
+    :param dialect_name: Name of the sqlalchemy dialect, like mysql, postgresql or sqlite
+    :return: insert statement object
+    """
+    table = get_table(table)
+    if dialect_name == "mysql":
+        return sase.insert(table).prefix_with("IGNORE")
+    elif dialect_name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect_name == "sqlite":
+        return sase.insert(table).prefix_with("OR IGNORE")
+    return sase.insert(table)
+
+
+def format_delimited(rows: Iterable[Sequence[Any]], width: int, null: str) -> str:
+    """
+    Format rows as comma separated lines in which every value is quoted, so only the unquoted null marker is read back
+    as NULL. Quotes inside values are doubled. Rows are padded with NULL or cut off to exactly width values.
+
+    :param rows: Rows to format
+    :param width: Number of values per line, the number of columns of the destination table
+    :param null: The marker for a NULL value, see `DELIMITED_NULLS`
+    :return: The formatted lines as one string
+    """
+    return "".join(
+        ",".join(null if value is None else '"' + str(value).replace('"', '""') + '"'
+                 for value in islice(chain(row, repeat(None)), width)) + "\n"
+        for row in rows
+    )
+
+
+def create_staging_table(table: TableLike, connection: Any) -> Table:
+    """
+    Create a temporary table with the same columns as table but without the primary key, plus a sequence column that
+    remembers the load order.
+
+    :param table: sqlalchemy declarativeMeta class or Table object to create a staging table for
+    :param connection: Sqlalchemy connection, the staging table only exists for this connection
+    :return: The staging Table object
+    """
+    table = get_table(table)
+    staging = Table(
+        f"{table.name}_staging",
+        MetaData(),
+        Column("load_seq", Integer, primary_key=True, autoincrement=True),
+        *[Column(column.name, column.type) for column in table.columns],
+        prefixes=["TEMPORARY"]
+    )
+    staging.create(bind=connection)
+    return staging
+
+
+def merge_staging_table(staging: Table, table: TableLike, connection: Any) -> int:
+    """
+    Move all rows from the staging table into table in load order, skipping primary keys that are already present.
+
+    :param staging: The staging Table object
+    :param table: sqlalchemy declarativeMeta class or Table object to merge into
+    :param connection: Sqlalchemy connection
+    :return: The number of inserted rows
+    """
+    columns = get_table(table).columns.keys()
+    stmt = insert_ignore(table, connection.dialect.name).from_select(
+        columns,
+        sase.select([staging.c[column] for column in columns]).order_by(staging.c.load_seq)
+    )
+    inserted = connection.execute(stmt).rowcount
+    staging.drop(bind=connection)
+    return inserted
+
+
+def load_data_infile(data: str, table: TableLike, connection: Any) -> int:
+    """
+    MySQL fast path: write the formatted rows to a temporary file and load it with LOAD DATA LOCAL INFILE into a staging
+    table. Requires local_infile on both the client (see `utils.get_db_engine`) and the server.
+
+    :param data: Rows formatted by `format_delimited`
+    :param table: sqlalchemy declarativeMeta class or Table object to load into
+    :param connection: Sqlalchemy connection to a MySQL database
+    :return: The number of inserted rows
+    """
+    staging = create_staging_table(table, connection)
+    columns = ", ".join(f"`{column}`" for column in get_table(table).columns.keys())
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", encoding="utf-8", delete=False) as f:
+        f.write(data)
+    try:
+        connection.execute(
+            sase.text(f"LOAD DATA LOCAL INFILE :path INTO TABLE `{staging.name}` CHARACTER SET utf8mb4 "
+                      f"FIELDS TERMINATED BY ',' ENCLOSED BY '\"' ESCAPED BY '' "
+                      f"LINES TERMINATED BY '\\n' ({columns})"),
+            path=f.name
+        )
+    finally:
+        os.remove(f.name)
+    return merge_staging_table(staging, table, connection)
+
+
+def copy_from_stdin(data: str, table: TableLike, connection: Any) -> int:
+    """
+    PostgreSQL fast path: stream the formatted rows with COPY ... FROM STDIN into a staging table.
+
+    :param data: Rows formatted by `format_delimited`
+    :param table: sqlalchemy declarativeMeta class or Table object to load into
+    :param connection: Sqlalchemy connection to a PostgreSQL database
+    :return: The number of inserted rows
+    """
+    staging = create_staging_table(table, connection)
+    columns = ", ".join(f'"{column}"' for column in get_table(table).columns.keys())
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f'COPY "{staging.name}" ({columns}) FROM STDIN WITH (FORMAT csv)', io.StringIO(data))
+    return merge_staging_table(staging, table, connection)
+
+
+def insert_many(rows: List[Sequence[Any]], table: TableLike, connection: Any,
+                batch_size: int = constants.BULK_BATCH_SIZE) -> int:
+    """
+    Default path for every other backend, like SQLite: multi-row executemany in batches of batch_size rows, skipping
+    primary keys that are already present. Rows are padded with NULL or cut off to the number of columns.
+
+    :param rows: Rows with one value for every column of table
+    :param table: sqlalchemy declarativeMeta class or Table object to load into
+    :param connection: Sqlalchemy connection
+    :param batch_size: Number of rows per executemany call
+    :return: The number of inserted rows
+    """
+    columns = get_table(table).columns.keys()
+    stmt = insert_ignore(table, connection.dialect.name)
+    inserted = 0
+    for start in range(0, len(rows), batch_size):
+        batch = [dict(zip(columns, chain(row, repeat(None)))) for row in rows[start:start + batch_size]]
+        inserted += connection.execute(stmt, batch).rowcount
+    return inserted
+
+
+# Fast path per backend, taking rows formatted by `format_delimited` with the null marker of that backend
+BULK_LOADERS: Dict[str, Callable[[str, TableLike, Any], int]] = {
+    "mysql": load_data_infile,
+    "postgresql": copy_from_stdin,
+}
+DELIMITED_NULLS = {
+    "mysql": "NULL",
+    "postgresql": "",
+}
+
+
+def delimited_null(engine: Any) -> Optional[str]:
+    """
+    Null marker to format rows with for `bulk_load_delimited`, if the database backend has a fast path that can take
+    formatted rows and the server allows it.
+
+    :param engine: a Sqlalchemy engine object
+    :return: The null marker, None if formatted rows can't be loaded
+    """
+    if engine.dialect.name == "mysql" and not engine.execute("SELECT @@GLOBAL.local_infile").scalar():
+        return None
+    return DELIMITED_NULLS.get(engine.dialect.name)
+
+
+def bulk_load_delimited(data: str, table: TableLike, engine: Any) -> int:
+    """
+    Load rows that were already formatted by `format_delimited`, with the null marker from `delimited_null`, through
+    the fast path of the database backend. This way the formatting can be done in another process.
+
+    :param data: Rows formatted by `format_delimited`
+    :param table: sqlalchemy declarativeMeta class or Table object to load into
+    :param engine: a Sqlalchemy engine object
+    :return: The number of inserted rows
+    """
+    if not data:
+        return 0
+
+    with engine.begin() as connection:
+        return BULK_LOADERS[engine.dialect.name](data, table, connection)
+
+
+def bulk_load(rows: List[Sequence[Any]], table: TableLike, engine: Any) -> int:
+    """
+    Load rows into table with the fastest method the database backend offers. Deduplication on the primary key is
+    left to the database: rows with a primary key that is already present, in the table or earlier in rows, are skipped.
+    If the fast path is refused by the server, for example because local_infile is disabled, the rows are loaded with
+    `insert_many` instead.
+
+    :param rows: Rows with one value for every column of table
+    :param table: sqlalchemy declarativeMeta class or Table object to load into
+    :param engine: a Sqlalchemy engine object
+    :return: The number of inserted rows
+    """
+    if not rows:
+        return 0
+
+    fast_path = BULK_LOADERS.get(engine.dialect.name)
+    if fast_path is not None:
+        data = format_delimited(rows, len(get_table(table).columns), DELIMITED_NULLS[engine.dialect.name])
+        try:
+            with engine.begin() as connection:
+                return fast_path(data, table, connection)
+        except DBAPIError as e:
+            print(f"Bulk load with {fast_path.__name__} failed ({e.orig}), falling back to executemany")
+
+    with engine.begin() as connection:
+        return insert_many(rows, table, connection)
+
+
+def benchmark_bulk_load(engine: Any, nr_of_rows: int = 100000) -> Dict[str, float]:
+    """
+    Compare the rows/sec of the pandas `to_sql` path that was used before with `bulk_load`, on a scratch copy of the
+    vehicles table filled with generated rows, 10% of which are duplicate primary keys. The rows are made like those
+    of a load: the parsed fields repaired by `preprocess.route_row`, followed by the ids of their dimension values.
+    The ids are numbered here instead of stored in the dimension table, so the benchmark leaves no values behind.
+
+    :param engine: a Sqlalchemy engine object
+    :param nr_of_rows: Number of rows to load with both methods
+    :return: A dictionary with the rows/sec per method
+    """
+    import pandas as pd
+
+    table = get_table(database.Vehicle).tometadata(MetaData(), name="bench_vehicles")
+    columns = table.columns.keys()
+    names = [column.name for column in database.parsed_columns(database.Vehicle)][:preprocess.NR_OF_FIELDS]
+    ids: Dict[str, Dict[Optional[str], int]] = {field: dict() for field in database.DIMENSION_FIELDS}
+    rows = list()
+    for nr in range(nr_of_rows):
+        fields = dict.fromkeys(names, str(nr))
+        fields.update(country="BNCH", vehicle_id=str(nr % (nr_of_rows - nr_of_rows // 10)), licence="LICENCE",
+                      make=f"make {nr % 20}", model=f"model {nr % 200}", colour=f"colour {nr % 12}",
+                      fueltype=f"fuel {nr % 3}", bodytype=f"body {nr % 8}", firstuse=f"{2000 + nr % 20}-01-01",
+                      build_year=str(1940 + nr % 80), amount_damage=str(nr % 10000))
+        _, row = preprocess.route_row([fields[name] for name in names])
+        for field in database.DIMENSION_FIELDS:
+            spelling = dimensions.canonical(field, fields[field])
+            row.append(ids[field].setdefault(spelling, len(ids[field]) + 1))
+        rows.append(row)
+
+    results = dict()
+    for method in ("to_sql", "bulk_load"):
+        table.drop(bind=engine, checkfirst=True)
+        table.create(bind=engine)
+        start = time.perf_counter()
+        if method == "to_sql":
+            df = pd.DataFrame(data=rows, columns=columns)
+            # pandas stores its object columns as text, which the sqlite driver can't do for decimals
+            df["amount_damage_num"] = df["amount_damage_num"].astype(float)
+            df.drop_duplicates(subset=[key.name for key in table.primary_key], inplace=True)
+            df.to_sql(name=table.name, con=engine, if_exists='append', index=False)
+        else:
+            bulk_load(rows, table, engine)
+        results[method] = nr_of_rows / (time.perf_counter() - start)
+        print(f"{method}: {results[method]:.0f} rows/sec")
+    table.drop(bind=engine)
+
+    return results
+
+
+if __name__ == '__main__':
+    import utils
+
+    benchmark_bulk_load(utils.get_db_engine())
@@ -1,98 +1,295 @@
-import csv
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from itertools import islice
+import gc
 import gzip
-from io import BytesIO
+import io
+import json
 import os
 import shutil
-from typing import Any, List, Tuple, Type
+import threading
+import time
+from typing import Any, BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple, Type, \
+    TYPE_CHECKING
 
-import pandas as pd
-import requests
-from sqlalchemy import inspect
 from sqlalchemy.orm import sessionmaker
+import sqlalchemy.sql.expression as sase
 
 import constants
 import database
+import dimensions
+import loader
+from metrics import METRICS, Stage
+import pipeline
+import preprocess
+from profiling import profiled
+from scoreboard import bump_generation
+import transform
 import utils
 
+if TYPE_CHECKING:
+    import analytics
+    import dedup
+    import requests
 
-def download_and_save_gzip_from_url(source: str, destination: str) -> None:
+# The row repairs moved to preprocess, they are still available here for existing callers
+fix_short_row = preprocess.fix_short_row
+make_long_enough = preprocess.make_long_enough
+# Stages of a run that can be selected on the command line, in the order they run
+STAGES = ["download", "ingest", "transform", "scoreboard"]
+# The stage every step of the sql transformation belongs to, see `transform_steps`
+STEP_STAGES = {
+    "dimensions": "transform",
+    "sanitize": "transform",
+    "normalize": "transform",
+    "scoreboard": "scoreboard",
+    "year_scoreboards": "scoreboard",
+}
+# How a file is cut into chunks: chunk_size lines of the csv file, or chunk_size rows per table of its column cache
+CHUNK_LINES, CHUNK_CACHE = "lines", "cache"
+
+
+def load_download_state(path: str = constants.DOWNLOAD_STATE) -> Dict[str, Dict[str, Any]]:
+    """
+    Read the ETag, Last-Modified and size that were stored for every downloaded file
+
+    :param path: Location of the json file with the download state
+    :return: A dictionary with the state per source URL, empty if nothing has been downloaded before
+    """
+    if not os.path.exists(path):
+        return dict()
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_download_state(state: Dict[str, Dict[str, Any]], path: str = constants.DOWNLOAD_STATE) -> None:
+    """
+    Store the download state, writing to a temporary file first so a crash never leaves a half written state file
+
+    :param state: A dictionary with the state per source URL
+    :param path: Location of the json file with the download state
+    :return: None
     """
-    Download a gzip file from source, decompress the archive and store it at the destination
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def conditional_headers(source: str, target_filename: str, state: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+    """
+    Build the headers for a conditional request. Conditions are only sent if the decompressed file from the previous
+    download is still on disk with the size that was recorded, otherwise the file is simply downloaded again.
+
+    :param source: The full URL of the gzipped file to download
+    :param target_filename: The location of the decompressed file
+    :param state: A dictionary with the state per source URL
+    :return: A dictionary with If-None-Match and/or If-Modified-Since headers
+    """
+    file_state = state.get(source)
+    if not file_state or not os.path.exists(target_filename) or \
+            os.path.getsize(target_filename) != file_state.get("size"):
+        return dict()
+
+    headers = dict()
+    if file_state.get("etag"):
+        headers["If-None-Match"] = file_state["etag"]
+    if file_state.get("last_modified"):
+        headers["If-Modified-Since"] = file_state["last_modified"]
+    return headers
+
+
+class DownloadProgress:
+    """
+    File-like wrapper around the raw response stream that reports the progress of a single download
+    """
+    def __init__(self, raw: Any, name: str, total: Optional[int], step: int = 25):
+        self.raw = raw
+        self.name = name
+        self.total = total
+        self.step = step
+        self.done = 0
+        self.reported = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.done += len(data)
+        if self.total:
+            percentage = self.done * 100 // self.total
+            if percentage >= self.reported + self.step:
+                self.reported = percentage - percentage % self.step
+                print(f"Downloading {self.name}: {self.reported}% of {self.total} bytes")
+        return data
+
+
+def target_filename_of(source: str, destination: str) -> str:
+    """
+    :param source: The full URL of a gzipped file
+    :param destination: The location where the downloaded files are stored
+    :return: The name of the decompressed file
+    """
+    return os.path.join(destination, source.rsplit("/", 1)[1]).rsplit(".", 1)[0]
+
+
+def download_and_save_gzip_from_url(source: str, destination: str,
+                                    state: Optional[Dict[str, Dict[str, Any]]] = None,
+                                    session: Optional["requests.Session"] = None) -> Optional[str]:
+    """
+    Download a gzip file from source, decompress the archive and store it at the destination.
+    The archive is decompressed chunk by chunk while it comes in, so it never has to fit in memory. When a state
+    dictionary is passed the request is made conditional on the ETag/Last-Modified of the previous download and the
+    state is updated with the new values.
 
     :param source: The full URL of the gzipped file to download
     :param destination: The location where the downloaded file will be stored
-    :return: The name of the
+    :param state: Optional dictionary with the download state per source URL, see `load_download_state`
+    :param session: Optional requests session to reuse pooled connections, see `utils.get_http_session`
+    :return: The name of the decompressed file, None if the source is not a gzipped archive
     """
+    import requests
 
-    # Get header to check file type
-    h = requests.head(source)
-    if h.headers.get("content-type") == "application/x-gzip":
-        # Download file if it is a gzip file
-        r = requests.get(source)
-        target_filename = os.path.join(destination, source.rsplit("/", 1)[1]).rsplit(".", 1)[0]
-        with gzip.open(BytesIO(r.content), "rb") as f_in:
-            with open(target_filename, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
+    target_filename = target_filename_of(source, destination)
+    headers = conditional_headers(source, target_filename, state) if state is not None else dict()
 
-        print(f"File saved as {target_filename}")
-    else:
-        print(f"Provided source {source} is not a gzipped archive. Source not downloaded.")
+    with (session or requests).get(source, headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            print(f"File {target_filename} is unchanged, skipping download")
+            return target_filename
+        r.raise_for_status()
 
+        # Check the header for the file type before reading the body
+        if r.headers.get("content-type") != "application/x-gzip":
+            print(f"Provided source {source} is not a gzipped archive. Source not downloaded.")
+            return None
 
-def read_data_from_csv(source: str) -> List[List[str]]:
+        # Decompress the raw byte stream ourselves, write to a temporary file so an interrupted download is never
+        # mistaken for a complete one
+        r.raw.decode_content = False
+        content_length = r.headers.get("Content-Length")
+        progress = DownloadProgress(r.raw, os.path.basename(target_filename), int(content_length or 0))
+        try:
+            with gzip.GzipFile(fileobj=progress, mode="rb") as f_in:
+                with open(f"{target_filename}.part", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out, constants.DOWNLOAD_CHUNK_SIZE)
+        except BaseException:
+            # Don't leave a half written file behind when the stream breaks off
+            if os.path.exists(f"{target_filename}.part"):
+                os.remove(f"{target_filename}.part")
+            raise
+        os.replace(f"{target_filename}.part", target_filename)
+
+        if state is not None:
+            state[source] = {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "size": os.path.getsize(target_filename)
+            }
+
+    print(f"File saved as {target_filename}")
+    return target_filename
+
+
+@profiled
+def download_with_retry(source: str, destination: str, state: Optional[Dict[str, Dict[str, Any]]] = None,
+                        session: Optional["requests.Session"] = None, retries: int = constants.DOWNLOAD_RETRIES,
+                        backoff: float = constants.DOWNLOAD_BACKOFF) -> Optional[str]:
     """
-    Reads in the csv files line by line because some processing needs to be done to make all entries same length.
+    Call `download_and_save_gzip_from_url` and retry with exponential backoff on connection errors, server errors and
+    archives that were cut off halfway. Client errors like a 404 are not retried.
 
-    :param source: Path to the csv file to be read in
-    :return: a list containing all the rows of the csv as lists
+    :param source: The full URL of the gzipped file to download
+    :param destination: The location where the downloaded file will be stored
+    :param state: Optional dictionary with the download state per source URL
+    :param session: Optional requests session to reuse pooled connections
+    :param retries: Number of retries after the first attempt
+    :param backoff: Seconds to wait before the first retry, doubled for every next retry
+    :return: The name of the decompressed file, None if the source is not a gzipped archive
     """
-    data_list = list()
-    print(f"Reading csv file {source}")
-    with open(source, "r") as f:
-        reader = csv.reader(f, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, skipinitialspace=True)
-        # skip the header
-        next(reader)
-        for row in reader:
-            # Make all PK fields upper case for deduplication later
-            row[:3] = [x.upper() for x in row[:3]]
-            data_list.append(row)
+    import requests
 
-    print(f"Read {len(data_list)} entries")
-    return data_list
+    with METRICS.stage("download", file=os.path.basename(source)):
+        for attempt in range(retries + 1):
+            try:
+                return download_and_save_gzip_from_url(source=source, destination=destination, state=state,
+                                                       session=session)
+            except (requests.RequestException, EOFError, OSError) as e:
+                response = getattr(e, "response", None)
+                if attempt == retries or (response is not None and response.status_code < 500):
+                    raise
+                wait = backoff * 2 ** attempt
+                print(f"Download of {source} failed ({e}), retrying in {wait} seconds")
+                time.sleep(wait)
 
 
-def fix_short_row(row: List[str]) -> List[str]:
+def download_all(sources: List[str], destination: str, state: Optional[Dict[str, Dict[str, Any]]] = None,
+                 workers: int = constants.DOWNLOAD_WORKERS) -> Iterator[str]:
     """
-    All short rows (less than 36 fields) contain an extra " in a field value. This is either due to typos in the colour
-    field (example: Pure White",sedan") or because of wheel sizes in inches in the type field (example: 1.5d N-TEC 17")
+    Download all sources concurrently over one pooled session, with at most `workers` downloads at the same time.
+    The decompressed files are handed out in the order of sources as soon as they are complete, so the caller can start
+    parsing the first parts while the later parts are still coming in. The download state is saved after every file.
 
-    :param row: a list containing less than 36 items
-    :return: A list containing 36 items
+    :param sources: The full URLs of the gzipped files to download
+    :param destination: The location where the downloaded files will be stored
+    :param state: Optional dictionary with the download state per source URL
+    :param workers: Maximum number of parallel downloads
+    :return: A generator yielding the names of the decompressed files, sources that are not gzipped are left out
     """
-    new_row = list()
-    for item in row:
-        new_row.extend(item.split('",'))
-    return new_row
+    session = utils.get_http_session(pool_size=workers)
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_with_retry, source=source, destination=destination, state=state,
+                                   session=session)
+                   for source in sources]
+        for future in futures:
+            target_filename = future.result()
+            if state is not None:
+                save_download_state(state)
+            if target_filename:
+                yield target_filename
 
 
-def make_long_enough(row: List[str]) -> List[str]:
-    if len(row) > 40:
-        row = row[:40]
-    else:
-        for i in range(40-len(row)):
-            row.append(None)
+@contextmanager
+def open_gzip_stream(source: str) -> Iterator[TextIO]:
+    """
+    Open a gzipped file on a URL as a text stream that is decompressed while it is read. This can be fed straight into
+    `preprocess.iter_rows_from_csv` so no intermediate file is needed.
+
+    :param source: The full URL of the gzipped file to download
+    :return: A context manager yielding the decompressed text stream
+    """
+    import requests
 
-    return row
+    with requests.get(source, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = False
+        with gzip.GzipFile(fileobj=r.raw, mode="rb") as f_in:
+            yield io.TextIOWrapper(f_in)
 
 
+@profiled
+def read_data_from_csv(source: str) -> List[List[str]]:
+    """
+    Reads in the csv files line by line because some processing needs to be done to make all entries same length.
+
+    :param source: Path to the csv file to be read in
+    :return: a list containing all the rows of the csv as lists
+    """
+    print(f"Reading csv file {source}")
+    with open(source, "r") as f:
+        data_list = list(preprocess.iter_rows_from_csv(f))
+
+    print(f"Read {len(data_list)} entries")
+    return data_list
+
+
+@profiled
 def split_into_long_and_normal_lists(data_list: List[List[str]], mater: List[List[str]], vehicles: List[List[str]]) -> \
         Tuple[List[List[str]], List[List[str]]]:
     """
     Because the actual data load first changes the data list of list to a pandas DataFrame the length of all rows need
-    to be equal. This function splits rows based on their length into two data sets.
-    The assumption here is that rows of length 36 are read in correctly, shorter rows just have 1 or 2 easily rectified
-    errors and longer rows are kept separate.
-    The 36 long rows are extended with an extra empty field because the destination table has 37 columns.
+    to be equal. This function splits rows based on their length into two data sets, see `preprocess.route_row`.
 
     :param data_list: new set of data to be split
     :param mater: the list of rows that are too long
@@ -100,56 +297,656 @@ def split_into_long_and_normal_lists(data_list: List[List[str]], mater: List[Lis
     :return: The list of too-long rows and the list of correct length rows
     """
     for row in data_list:
-        if len(row) > 36:
-            # Know too little about long_rows to pull erroneous fields together therefore
-            # make every mater row exactly 40 long to fit mater table
-            row = make_long_enough(row)
+        is_long, row = preprocess.route_row(row)
+        if is_long:
             mater.append(row)
-            continue
-        elif len(row) < 36:
-            # explanation on short_row cause and fix in fix_short_row
-            row = fix_short_row(row)
-            # All rows with 36 fields can be appended to vehicles after receiving an empty column for insertion
-        row.append(None)
-        vehicles.append(row)
+        else:
+            vehicles.append(row)
 
     return mater, vehicles
 
 
-def insert_into_table(data_list: List[List[str]], table: Type[database.declarative_base], engine: Any) -> None:
+def iter_chunks(rows: Iterable[List[str]], chunk_size: int) -> Iterator[Tuple[List[List[str]], List[List[str]]]]:
+    """
+    Streaming counterpart of `split_into_long_and_normal_lists`. Rows are repaired and routed as they come in and
+    handed out in chunks, so only chunk_size rows are kept in memory at any time.
+
+    :param rows: iterable of rows as returned by `preprocess.iter_rows_from_csv`
+    :param chunk_size: number of source rows per chunk
+    :return: a generator yielding the mater rows and vehicle rows of every chunk
     """
-    This function uploads the data into the database, leveraging the power of pandas dataframe for deduplication and
-    talking to the database backend for quick dataload. Duplication is checked on the primary key, duplicate rows are
-    dropped.
+    mater: List[List[str]] = list()
+    vehicles: List[List[str]] = list()
+    for row in rows:
+        is_long, row = preprocess.route_row(row)
+        if is_long:
+            mater.append(row)
+        else:
+            vehicles.append(row)
+
+        if len(mater) + len(vehicles) >= chunk_size:
+            yield mater, vehicles
+            mater, vehicles = list(), list()
+
+    if mater or vehicles:
+        yield mater, vehicles
+
+
+def ends_record(f: BinaryIO, position: int) -> bool:
+    """
+    Whether a record of a part file ends at a position just after a newline: the line before it closes its last field
+    with a quote and the line after it opens a new record with one, or the file ends there. A newline inside a quoted
+    field, like in `"Sport\nLine"`, is not a record boundary.
+
+    :param f: The part file, opened in binary mode
+    :param position: Offset just after a newline, or the size of the file
+    :return: True if a range may end at this position
+    """
+    f.seek(max(position - 3, 0))
+    before = f.read(position - f.tell())
+    after = f.read(1)
+    f.seek(position)
+    return after == b"" or (before.rstrip(b"\r\n").endswith(b'"') and after == b'"')
+
+
+def plan_file_ranges(source: str, chunk_bytes: int = constants.PARSE_CHUNK_BYTES) -> List[Tuple[str, int, int]]:
+    """
+    Cut a csv file into byte ranges of roughly chunk_bytes that start and end on a record boundary, so every range can
+    be parsed on its own. A range ends on a newline, but not on one inside a quoted field, see `ends_record`.
+
+    :param source: Path to the csv file
+    :param chunk_bytes: Approximate size of a range in bytes
+    :return: A list with the path, start offset and end offset of every range, in file order
+    """
+    size = os.path.getsize(source)
+    ranges = list()
+    with open(source, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            # Move on to the end of the line the seek ended up in, and on to the end of the record it belongs to
+            f.readline()
+            while not ends_record(f, min(f.tell(), size)):
+                f.readline()
+            end = min(f.tell(), size)
+            ranges.append((source, start, end))
+            start = end
+
+    return ranges
+
+
+def parse_file_range(source: str, start: int, end: int) -> Tuple[List[List[str]], List[List[str]]]:
+    """
+    Read, repair and route the rows in one byte range of a part file with `preprocess.split_lines`. This is the unit of
+    work of a worker process in `parse_files_parallel`. Only the range starting at offset 0 contains the header. A range
+    ends on a record boundary, so a record with a quoted newline is in one range, where `preprocess.iter_records` puts
+    its lines back together.
+
+    :param source: Path to the csv file to be read in
+    :param start: Offset of the first byte of the range
+    :param end: Offset just after the last byte of the range
+    :return: The list of too-long rows and the list of correct length rows of this range
+    """
+    with open(source, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    return preprocess.split_lines(io.TextIOWrapper(io.BytesIO(data)), skip_header=start == 0)
+
+
+def encode_file_range(source: str, start: int, end: int, null: str) -> Tuple[str, int, str, int]:
+    """
+    Parse one byte range of a part file like `parse_file_range` and format the rows for `loader.bulk_load_delimited`.
+    Handing a worker's result back as two strings is far cheaper than as lists of rows, that would have to be pickled
+    and unpickled field by field. The vehicles are stored without dimension ids, the transformation sets them.
+
+    :param source: Path to the csv file to be read in
+    :param start: Offset of the first byte of the range
+    :param end: Offset just after the last byte of the range
+    :param null: The null marker of the database backend, see `loader.delimited_null`
+    :return: The formatted too-long rows, their number, the formatted correct length rows and their number
+    """
+    mater, vehicles = parse_file_range(source=source, start=start, end=end)
+    return (loader.format_delimited(mater, len(database.Mater.__table__.columns), null), len(mater),
+            loader.format_delimited(vehicles, len(database.Vehicle.__table__.columns), null), len(vehicles))
+
+
+def parse_files_parallel(sources: Iterable[str], workers: int = constants.PARSE_WORKERS,
+                         task: Callable[[str, int, int], Any] = parse_file_range) -> Iterator[Tuple[str, Any]]:
+    """
+    Parse the part files with a pool of worker processes, every worker handling one range of a file at a time (see
+    `plan_file_ranges`). The results are handed out in file order and range order within a file, no matter which
+    worker finishes first, so a first-wins deduplication downstream always keeps the same rows. At most workers + 1
+    parsed ranges are held at any time.
+
+    :param sources: Paths to the csv files to be parsed, in load order
+    :param workers: Number of worker processes
+    :param task: Function that is called with the path, start and end offset of every range in a worker process
+    :return: A generator yielding the path and the result of task for every range
+    """
+    # The workers only build lists of strings, which can't form reference cycles, so the cyclic garbage collector is
+    # switched off there. It otherwise takes up a large part of the parse time.
+    with ProcessPoolExecutor(max_workers=workers, initializer=gc.disable) as executor:
+        pending: Deque[Tuple[str, Future]] = deque()
+        for source in sources:
+            for file_range in plan_file_ranges(source):
+                pending.append((source, executor.submit(task, *file_range)))
+                if len(pending) > workers:
+                    done_source, future = pending.popleft()
+                    yield done_source, future.result()
+
+        while pending:
+            done_source, future = pending.popleft()
+            yield done_source, future.result()
+
+
+def load_rows(rows: List[List[Any]], table: Type[database.declarative_base], engine: Any) -> int:
+    """
+    Load parsed rows with `loader.bulk_load`. Vehicle rows get the ids of their make, model and other dimension fields
+    first, see `dimensions.DimensionDictionary.encode`.
+
+    :param rows: Rows as `preprocess.route_row` returns them
+    :param table: sqlalchemy declarativeMeta class of the table to load the rows into
+    :param engine: a Sqlalchemy engine object
+    :return: The number of rows that were inserted
+    """
+    if table is database.Vehicle:
+        rows = dimensions.dictionary_for(engine).encode(rows)
+    return loader.bulk_load(rows=rows, table=table, engine=engine)
+
+
+@profiled
+def insert_into_table(data_list: List[List[str]], table: Type[database.declarative_base], engine: Any,
+                      deduplicator: Optional["dedup.Deduplicator"] = None) -> int:
+    """
+    This function uploads the data into the database with the bulk loader of the database backend, see
+    `load_rows`. Duplication is checked on the primary key by the database itself, duplicate rows are dropped
+    and the first occurrence is kept. With a deduplicator the duplicates are mostly dropped before loading already.
 
     :param data_list: A list containing same length rows (as list) from the 7 different csv's
     :param table: sqlalchemy declarativeMeta class of the table to upload the data to
     :param engine: a Sqlalchemy engine object
+    :param deduplicator: Optional deduplicator of the rows loaded into table, see `dedup.Deduplicator`
+    :return: The number of rows that were inserted
+    """
+    pre_size = len(data_list)
+    print(f"Loading {pre_size} rows into {table.__table__.name}")
+
+    if deduplicator is not None:
+        data_list = deduplicator.drop_duplicates(data_list)
+        print(f"Dropped {pre_size - len(data_list)} non-unique primary key entries before loading")
+    unique_size = load_rows(rows=data_list, table=table, engine=engine)
+    print(f"Table received {unique_size} unique primary key entries")
+    print(f"Dropped {pre_size - unique_size} non-unique primary key entries")
+    print("loaded data into table")
+    return unique_size
+
+
+def table_deduplicators(engine: Any) -> Dict[Type[database.declarative_base], "dedup.Deduplicator"]:
+    """
+    :param engine: a Sqlalchemy engine object
+    :return: A deduplicator per table that confirms fingerprint matches against the table, see `dedup.Deduplicator`
+    """
+    import dedup
+
+    return {table: dedup.Deduplicator(dedup.database_confirm(table, engine))
+            for table in (database.Vehicle, database.Mater)}
+
+
+def report_deduplicators(deduplicators: Dict[Type[database.declarative_base], "dedup.Deduplicator"]) -> None:
+    for table, deduplicator in deduplicators.items():
+        print(f"Dropped {deduplicator.duplicates} of {deduplicator.nr_of_rows} {table.__tablename__} rows before "
+              f"loading, {deduplicator.collisions} fingerprint collisions, "
+              f"{deduplicator.fingerprints.nbytes / 2 ** 20:.1f} MB of fingerprints")
+
+
+def needs_ingest(source: str, engine: Any) -> bool:
+    """
+    Check the manifest to see if a file is new or changed since it was loaded
+
+    :param source: Path to the csv file
+    :param engine: a Sqlalchemy engine object
+    :return: Boolean indicating whether the file needs to be loaded
+    """
+    manifest = database.IngestManifest
+
+    entry = engine.execute(manifest.find(os.path.basename(source))).first()
+    if entry is None:
+        return True
+    return (entry.size, entry.checksum) != (os.path.getsize(source), utils.file_checksum(source))
+
+
+def forget_previous_rows(source: str, engine: Any, batch_size: int = constants.FORGET_BATCH_SIZE) -> int:
+    """
+    Make room for the new version of a file that was loaded before. Rows with a primary key that is already in the
+    database are skipped on insert, so the rows with the keys of the new version are deleted first, along with the
+    weird years saved for them and the manifest entry of the old version. In one transaction, so a load that is
+    interrupted afterwards resumes like that of a new file.
+
+    :param source: Path to the csv file
+    :param engine: a Sqlalchemy engine object
+    :param batch_size: Number of primary keys per delete
+    :return: The number of deleted vehicle and mater rows
+    """
+    deleted = 0
+    with open(source, "r") as f, engine.begin() as connection:
+        keys = (tuple(row[:3]) for row in preprocess.iter_rows_from_csv(f))
+        for batch in iter(lambda: list(islice(keys, batch_size)), list()):
+            for table in (database.Vehicle, database.Mater):
+                deleted += connection.execute(database.forget_keys(table, batch)).rowcount
+            connection.execute(database.forget_keys(database.WeirdYears, batch))
+        connection.execute(database.IngestManifest.forget(os.path.basename(source)))
+    print(f"File {source} has changed, deleted the {deleted} rows of its previous version")
+    return deleted
+
+
+def select_files_to_ingest(sources: Iterable[str], engine: Any) -> Iterator[str]:
+    """
+    Leave out all files that are in the manifest with the same size and checksum. The rows of a changed file are
+    replaced by those of its new version, see `forget_previous_rows`.
+
+    :param sources: Paths to the csv files
+    :param engine: a Sqlalchemy engine object
+    :return: a generator yielding the paths of the new and changed files
+    """
+    for source in sources:
+        if needs_ingest(source=source, engine=engine):
+            if engine.execute(database.IngestManifest.find(os.path.basename(source))).first() is not None:
+                forget_previous_rows(source=source, engine=engine)
+            yield source
+        else:
+            print(f"File {source} is already loaded, skipping")
+
+
+def record_ingest(source: str, totals: Dict[Type[database.declarative_base], List[int]], engine: Any) -> \
+        Tuple[int, int]:
+    """
+    Add a loaded file to the manifest, replacing an older entry of the same file, and remove its checkpoint
+
+    :param source: Path to the csv file
+    :param totals: The number of rows read and the number of rows inserted, per table
+    :param engine: a Sqlalchemy engine object
+    :return: The number of rows read and the number of rows inserted, over all tables
+    """
+    manifest = database.IngestManifest
+
+    vehicles_rows = totals[database.Vehicle][1]
+    mater_rows = totals[database.Mater][1]
+    duplicate_rows = sum(read - inserted for read, inserted in totals.values())
+    with engine.begin() as connection:
+        connection.execute(database.IngestCheckpoint.forget(os.path.basename(source)))
+        connection.execute(manifest.forget(os.path.basename(source)))
+        connection.execute(manifest.record(
+            file_name=os.path.basename(source),
+            size=os.path.getsize(source),
+            checksum=utils.file_checksum(source),
+            vehicles_rows=vehicles_rows,
+            mater_rows=mater_rows,
+            duplicate_rows=duplicate_rows,
+            loaded_at=datetime.now()
+        ))
+    # Cached scoreboards may be based on the rows before this file
+    bump_generation()
+    print(f"Loaded {vehicles_rows} vehicle and {mater_rows} mater rows from {source}, "
+          f"dropped {duplicate_rows} non-unique primary key entries")
+    return vehicles_rows + mater_rows + duplicate_rows, vehicles_rows + mater_rows
+
+
+def batch_into_database(sources: Iterable[str], engine: Any) -> None:
+    """
+    Load the csv files into the database one whole file at a time
+
+    :param sources: Paths to the csv files to be loaded, in load order
+    :param engine: a Sqlalchemy engine object
     :return: None
     """
-    print(f"Transform data for {table.__table__.name} into dataframe")
+    deduplicators = table_deduplicators(engine)
+    for source in sources:
+        with METRICS.stage("ingest", file=os.path.basename(source)) as stage:
+            mater, vehicles = split_into_long_and_normal_lists(read_data_from_csv(source=source), list(), list())
 
-    df = pd.DataFrame(data=data_list, columns=inspect(table).columns.keys())
-    pre_size = len(df.index)
-    print(f"Created dataframe with {pre_size} rows")
+            totals = dict()
+            for table, data_list in ((database.Vehicle, vehicles), (database.Mater, mater)):
+                totals[table] = [len(data_list), insert_into_table(data_list=data_list, table=table, engine=engine,
+                                                                   deduplicator=deduplicators[table])]
+            stage.count(*record_ingest(source=source, totals=totals, engine=engine))
+    report_deduplicators(deduplicators)
 
-    df.drop_duplicates(subset=[key.name for key in inspect(table).primary_key], inplace=True)
-    unique_size = len(df.index)
-    print(f"Dataframa contains {unique_size} unique primary key entries")
-    print(f"Dropped {pre_size - unique_size} non-unique primary key entries")
 
-    df.to_sql(name=table.__table__.name,
-              con=engine,
-              schema=constants.CONFIG.get("database"),
-              if_exists='append',
-              index=False)
-    print("loaded data into table")
+def chunk_kind(source: str, column_cache: bool = constants.COLUMN_CACHE) -> str:
+    """
+    How `iter_source_chunks` cuts a file into chunks. A chunk of the column cache has chunk_size rows per table, which
+    are not the rows of chunk_size lines, so a checkpoint only counts for chunks of the same kind.
+
+    :param source: Path to the csv file
+    :param column_cache: Whether the rows are read from the column cache when it is up to date
+    :return: CHUNK_CACHE if the rows come from the column cache, CHUNK_LINES if the csv file is parsed
+    """
+    if column_cache:
+        import colcache
+        if colcache.ColumnCache(source).is_valid():
+            return CHUNK_CACHE
+    return CHUNK_LINES
+
+
+def iter_source_chunks(source: str, chunk_size: int, column_cache: bool = constants.COLUMN_CACHE,
+                       skip_chunks: int = 0, kind: Optional[str] = None) -> \
+        Iterator[Tuple[List[List[str]], List[List[Any]]]]:
+    """
+    Hand out the repaired rows of a csv file in chunks, through its column cache if column_cache is set, see
+    `colcache.ColumnCache`
+
+    :param source: Path to the csv file
+    :param chunk_size: number of source records per chunk
+    :param column_cache: Read the rows from the column cache, building it if it is missing or outdated
+    :param skip_chunks: Number of chunks to leave out, that were loaded before. Their lines are skipped without
+        parsing, a cache is not built then because it needs every line.
+    :param kind: How to cut the file into chunks, the one that was checkpointed, see `chunk_kind`
+    :return: a generator yielding the mater rows and vehicle rows of every chunk
+    """
+    kind = kind or chunk_kind(source, column_cache)
+    if kind == CHUNK_CACHE:
+        import colcache
+        cache = colcache.ColumnCache(source)
+        print(f"Reading the parsed rows of {source} from column cache {cache.directory}")
+        yield from islice(cache.iter_chunks(chunk_size), skip_chunks, None)
+        return
+    if column_cache and not skip_chunks:
+        import colcache
+        yield from colcache.ColumnCache(source).build(chunk_size)
+        return
+    with open(source, "r") as f:
+        records = preprocess.iter_records(f)
+        # The header and the records of the skipped chunks
+        for _ in islice(records, 1 + skip_chunks * chunk_size):
+            pass
+        yield from preprocess.iter_split_chunks(records, chunk_size, skip_header=False)
+
+
+def find_checkpoint(source: str, chunk_size: int, engine: Any, kind: str = CHUNK_LINES) -> \
+        Tuple[int, Dict[Type[database.declarative_base], List[int]]]:
+    """
+    Look up how far an earlier, interrupted load of a file got. The checkpoint only counts if the file didn't change
+    and is read in chunks of the same size and kind.
+
+    :param source: Path to the csv file
+    :param chunk_size: number of source lines per chunk
+    :param engine: a Sqlalchemy engine object
+    :param kind: How the file is cut into chunks now, see `chunk_kind`
+    :return: The number of chunks that were loaded and the number of rows read and inserted per table up to there
+    """
+    totals = {database.Vehicle: [0, 0], database.Mater: [0, 0]}
+    checkpoint = engine.execute(database.IngestCheckpoint.find(os.path.basename(source))).first()
+    if checkpoint is None or (checkpoint.size, checkpoint.checksum, checkpoint.chunk_size, checkpoint.chunk_kind) != \
+            (os.path.getsize(source), utils.file_checksum(source), chunk_size, kind):
+        return 0, totals
+    totals[database.Vehicle] = [checkpoint.vehicles_read, checkpoint.vehicles_rows]
+    totals[database.Mater] = [checkpoint.mater_read, checkpoint.mater_rows]
+    return checkpoint.chunks, totals
+
+
+def save_checkpoint(source: str, chunk_size: int, chunks: int, totals: Dict[Type[database.declarative_base], List[int]],
+                    engine: Any, size: int, checksum: str, kind: str = CHUNK_LINES) -> None:
+    """
+    Store that the first chunks of a file are loaded, see `find_checkpoint`
+
+    :param source: Path to the csv file
+    :param chunk_size: number of source lines per chunk
+    :param chunks: Number of chunks that are loaded
+    :param totals: The number of rows read and the number of rows inserted so far, per table
+    :param engine: a Sqlalchemy engine object
+    :param size: Size of the file
+    :param checksum: Checksum of the file, see `utils.file_checksum`
+    :param kind: How the file is cut into chunks, see `chunk_kind`
+    :return: None
+    """
+    checkpoint = database.IngestCheckpoint
+    with engine.begin() as connection:
+        connection.execute(checkpoint.forget(os.path.basename(source)))
+        connection.execute(checkpoint.record(
+            file_name=os.path.basename(source),
+            size=size,
+            checksum=checksum,
+            chunk_size=chunk_size,
+            chunk_kind=kind,
+            chunks=chunks,
+            vehicles_read=totals[database.Vehicle][0],
+            vehicles_rows=totals[database.Vehicle][1],
+            mater_read=totals[database.Mater][0],
+            mater_rows=totals[database.Mater][1],
+            updated_at=datetime.now()
+        ))
+
+
+@profiled
+def stream_into_database(sources: Iterable[str], engine: Any, chunk_size: int = constants.CHUNK_SIZE,
+                         on_vehicles: Optional[Callable[[List[List[Any]]], None]] = None,
+                         column_cache: bool = constants.COLUMN_CACHE) -> None:
+    """
+    Load the csv files into the database one chunk at a time. Every chunk is repaired, routed and written before the
+    next one is read, so peak memory is determined by chunk_size instead of by the size of the data set. Every chunk is
+    handled as a batch by `preprocess.split_lines`, or read from the column cache of a file that was parsed before.
+    Duplicate rows are dropped before loading by a deduplicator per table that only keeps a fingerprint of every
+    primary key, see `dedup.Deduplicator`. Duplicates of rows of an earlier run are dropped by the database.
+    After every chunk a checkpoint of the file is stored. When a load is interrupted, the next one skips the chunks
+    that were loaded already. A chunk that was written but not checkpointed is loaded again, its rows are dropped as
+    duplicates.
+
+    :param sources: Paths to the csv files to be loaded, in load order
+    :param engine: a Sqlalchemy engine object
+    :param chunk_size: number of source lines per chunk
+    :param on_vehicles: Optional function that gets the vehicle rows of every chunk, like
+        `analytics.ScoreboardEngine.add`
+    :param column_cache: Read and build the column caches of the files, see `colcache.ColumnCache`
+    :return: None
+    """
+    deduplicators = table_deduplicators(engine)
+    for source in sources:
+        print(f"Reading csv file {source}")
+        size, checksum = os.path.getsize(source), utils.file_checksum(source)
+        kind = chunk_kind(source, column_cache)
+        done, totals = find_checkpoint(source, chunk_size, engine, kind)
+        if done:
+            print(f"Resuming {source} after chunk {done}")
+        with METRICS.stage("ingest", file=os.path.basename(source)) as stage:
+            chunks = iter_source_chunks(source, chunk_size, column_cache, skip_chunks=done, kind=kind)
+            for nr, (mater, vehicles) in enumerate(chunks, start=done + 1):
+                for table, data_list in ((database.Vehicle, vehicles), (database.Mater, mater)):
+                    totals[table][0] += len(data_list)
+                    unique = deduplicators[table].drop_duplicates(data_list)
+                    totals[table][1] += load_rows(rows=unique, table=table, engine=engine)
+                save_checkpoint(source, chunk_size, nr, totals, engine, size, checksum, kind)
+                if on_vehicles is not None:
+                    on_vehicles(vehicles)
+                print(f"Loaded chunk {nr} with {len(vehicles)} vehicle and {len(mater)} mater rows")
+            stage.count(*record_ingest(source=source, totals=totals, engine=engine))
+    report_deduplicators(deduplicators)
+
+
+@profiled
+def parallel_into_database(sources: Iterable[str], engine: Any, workers: int = constants.PARSE_WORKERS) -> None:
+    """
+    Parse the csv files with a pool of worker processes and load the results, in the order of sources, from this single
+    process into the database. When the database backend can load formatted rows the workers do the formatting as
+    well, see `encode_file_range`.
+
+    :param sources: Paths to the csv files to be loaded, in load order
+    :param engine: a Sqlalchemy engine object
+    :param workers: Number of worker processes
+    :return: None
+    """
+    vehicle_table = database.Vehicle
+    mater_table = database.Mater
+
+    null = loader.delimited_null(engine)
+    task = parse_file_range if null is None else partial(encode_file_range, null=null)
+
+    current_source = None
+    stage = None
+    totals: Dict[Type[database.declarative_base], List[int]] = dict()
+    for source, result in parse_files_parallel(sources=sources, workers=workers, task=task):
+        # The ranges of a file come in one after the other, so a new source means the previous file is complete
+        if source != current_source:
+            if current_source is not None:
+                stage.count(*record_ingest(source=current_source, totals=totals, engine=engine))
+                stage.finish()
+            current_source, totals = source, {vehicle_table: [0, 0], mater_table: [0, 0]}
+            stage = METRICS.start_stage("ingest", file=os.path.basename(source))
+
+        if null is None:
+            mater, vehicles = result
+            for table, data_list in ((vehicle_table, vehicles), (mater_table, mater)):
+                totals[table][0] += len(data_list)
+                totals[table][1] += load_rows(rows=data_list, table=table, engine=engine)
+        else:
+            mater, nr_mater, vehicles, nr_vehicles = result
+            for table, data, nr_rows in ((vehicle_table, vehicles, nr_vehicles), (mater_table, mater, nr_mater)):
+                totals[table][0] += nr_rows
+                totals[table][1] += loader.bulk_load_delimited(data=data, table=table, engine=engine)
+
+    if current_source is not None:
+        stage.count(*record_ingest(source=current_source, totals=totals, engine=engine))
+        stage.finish()
+
+
+def iter_parsed_chunks(sources: Iterable[str], chunk_size: int, workers: int = constants.PARSE_WORKERS,
+                       column_cache: bool = constants.COLUMN_CACHE,
+                       resume_at: Optional[Callable[[str, str], int]] = None) -> \
+        Iterator[Tuple[str, int, List[List[str]], List[List[Any]]]]:
+    """
+    Hand out the repaired rows of the csv files in chunks, in load order. With more than one worker the files are
+    parsed by a pool of worker processes, see `parse_files_parallel`, otherwise they are streamed chunk by chunk.
+
+    :param sources: Paths to the csv files, in load order
+    :param chunk_size: number of source lines per chunk when streaming
+    :param workers: Number of worker processes
+    :param column_cache: Read the rows from the column caches when streaming, see `iter_source_chunks`
+    :param resume_at: Optional function that gets the path of a file and how it is cut into chunks, see `chunk_kind`,
+        and returns the number of chunks to skip, when streaming
+    :return: a generator yielding the path, the number of the chunk within its file, the mater rows and the vehicle
+        rows of every chunk
+    """
+    if workers > 1:
+        current_source, nr = None, 0
+        for source, (mater, vehicles) in parse_files_parallel(sources=sources, workers=workers):
+            nr = nr + 1 if source == current_source else 1
+            current_source = source
+            yield source, nr, mater, vehicles
+    else:
+        for source in sources:
+            print(f"Reading csv file {source}")
+            kind = chunk_kind(source, column_cache)
+            done = 0 if resume_at is None else resume_at(source, kind)
+            chunks = iter_source_chunks(source, chunk_size, column_cache, skip_chunks=done, kind=kind)
+            for nr, (mater, vehicles) in enumerate(chunks, start=done + 1):
+                yield source, nr, mater, vehicles
+
+
+@profiled
+def pipeline_into_database(sources: Iterable[str], engine: Any, chunk_size: int = constants.CHUNK_SIZE,
+                           writers: int = constants.WRITE_WORKERS, queue_size: int = constants.WRITE_QUEUE_SIZE,
+                           parse_workers: int = constants.PARSE_WORKERS,
+                           on_vehicles: Optional[Callable[[List[List[Any]]], None]] = None,
+                           column_cache: bool = constants.COLUMN_CACHE) -> None:
+    """
+    Load the csv files into the database with parsing and writing overlapped. This thread parses the chunks, or
+    collects them from the parse worker processes, and hands them to a pool of writer threads through bounded queues,
+    see `pipeline.WriterPool`. Every writer loads its rows over its own connection from the pool of engine. The rows of
+    a chunk are spread over the writers on their primary key, so all rows with the same key are written by one writer
+    in load order and the database keeps the same first occurrence as when the files are loaded one after the other.
+    Rows with a primary key that was loaded before are dropped by this thread, before the rows are spread, see
+    `dedup.Deduplicator`. A file is added to the manifest once all of its rows are written.
+    When the files are streamed, a checkpoint is stored as soon as every part of a chunk is written, and a load that
+    was interrupted resumes after the last checkpointed chunk, like `stream_into_database`.
+
+    :param sources: Paths to the csv files to be loaded, in load order
+    :param engine: a Sqlalchemy engine object, with a connection pool of at least writers connections
+    :param chunk_size: number of source lines per chunk when streaming
+    :param writers: Number of writer threads
+    :param queue_size: Number of chunk parts that can wait for every writer
+    :param parse_workers: Number of worker processes that parse the files, see `iter_parsed_chunks`
+    :param on_vehicles: Optional function that gets the vehicle rows of every chunk, like
+        `analytics.ScoreboardEngine.add`
+    :param column_cache: Read and build the column caches of the files when streaming, see `colcache.ColumnCache`
+    :return: None
+    """
+    tables = (database.Vehicle, database.Mater)
+    checkpoints = parse_workers <= 1
+    # Rows read and inserted per file of the chunks that are completely written, and per chunk that is being written
+    totals: Dict[str, Dict[Type[database.declarative_base], List[int]]] = dict()
+    written: Dict[Tuple[str, int], Dict[Type[database.declarative_base], List[int]]] = dict()
+    files: Dict[str, Tuple[int, str, str]] = dict()
+    lock = threading.Lock()
+    deduplicators = table_deduplicators(engine)
+
+    def resume_at(source: str, kind: str) -> int:
+        done, totals[source] = find_checkpoint(source, chunk_size, engine, kind)
+        files[source] = (os.path.getsize(source), utils.file_checksum(source), kind)
+        if done:
+            print(f"Resuming {source} after chunk {done}")
+        return done
+
+    def write(item: Tuple[str, int, Type[database.declarative_base], List[List[Any]]]) -> None:
+        source, chunk, table, data_list = item
+        with METRICS.stage("write", file=os.path.basename(source), table=table.__tablename__) as write_stage:
+            inserted = loader.bulk_load(rows=data_list, table=table, engine=engine)
+            write_stage.count(len(data_list), inserted)
+        with lock:
+            written[(source, chunk)][table][0] += len(data_list)
+            written[(source, chunk)][table][1] += inserted
+
+    def finish_chunk(source: str, chunk: int) -> None:
+        with lock:
+            for table, (read, inserted) in written.pop((source, chunk)).items():
+                totals[source][table][0] += read
+                totals[source][table][1] += inserted
+        if checkpoints:
+            save_checkpoint(source, chunk_size, chunk, totals[source], engine, *files[source])
+
+    def finish_file(source: str, ingest_stage: Stage) -> None:
+        ingest_stage.count(*record_ingest(source=source, totals=totals.pop(source), engine=engine))
+        ingest_stage.finish()
+
+    with METRICS.stage("pipeline"), pipeline.WriterPool(write, workers=writers, queue_size=queue_size) as pool:
+        current_source, stage = None, None
+        chunks = iter_parsed_chunks(sources, chunk_size, parse_workers, column_cache,
+                                    resume_at=resume_at if checkpoints else None)
+        for nr, (source, chunk, mater, vehicles) in enumerate(chunks, start=1):
+            if source != current_source:
+                if current_source is not None:
+                    pool.barrier(partial(finish_file, current_source, stage))
+                current_source = source
+                totals.setdefault(source, {table: [0, 0] for table in tables})
+                # Finished by a writer thread, so it is not one of the open stages of this thread
+                stage = Stage(METRICS, "ingest", {"file": os.path.basename(source)})
+
+            if on_vehicles is not None:
+                on_vehicles(vehicles)
+            # Encoded here, in load order, so the dimension ids don't depend on which writer is first
+            vehicles = dimensions.dictionary_for(engine).encode(vehicles)
+            with lock:
+                written[(source, chunk)] = {table: [0, 0] for table in tables}
+            for table, data_list in zip(tables, (vehicles, mater)):
+                unique = deduplicators[table].drop_duplicates(data_list)
+                # The dropped rows were read but not inserted, the writers count the others
+                with lock:
+                    written[(source, chunk)][table][0] += len(data_list) - len(unique)
+                for writer, part in enumerate(pipeline.partition(unique, writers)):
+                    if part:
+                        pool.put(writer, (source, chunk, table, part))
+            pool.barrier(partial(finish_chunk, source, chunk))
+            print(f"Queued chunk {nr} with {len(vehicles)} vehicle and {len(mater)} mater rows")
+
+        if current_source is not None:
+            pool.barrier(partial(finish_file, current_source, stage))
+    report_deduplicators(deduplicators)
 
 
 def check_db_filled(engine: Any) -> bool:
     """
     Check if there is data in the database
-    This is not a very extensive check. But the data load either hasn't been done or is complete
+    This is not a very extensive check. A load that was interrupted leaves a checkpoint behind, then the data is not
+    complete.
 
     :param engine: a Sqlalchemy engine object
     :return: Boolean indicating whether the database contains data or not
@@ -157,42 +954,227 @@ def check_db_filled(engine: Any) -> bool:
     vehicles = database.Vehicle
 
     cnt = engine.execute(vehicles.nr_of_rows())
-    if cnt.scalar() == 0:
+    if cnt.scalar() == 0 or engine.execute(database.IngestCheckpoint.find()).first() is not None:
         return False
     else:
         return True
 
 
-def run_db_updates(engine: Any) -> None:
+def update_normalized_damage(session: Any, countries: Optional[Set[str]] = None, force: bool = False) -> Set[str]:
+    """
+    Recompute the damage range of the given countries and normalize their damage. Only the countries of which the
+    minimum or maximum damage changed are normalized completely, in the other countries only the rows without a
+    normalized damage are normalized.
+
+    :param session: sqlalchemy session object to talk to the database
+    :param countries: The countries to update, all countries if None
+    :param force: Normalize all rows of the countries, even if their damage range did not change
+    :return: The countries that were updated
+    """
+    vehicles = database.Vehicle
+    damagerange = database.DamageRange
+
+    new_ranges = {row.country: (row.min_dmg, row.max_dmg) for row in session.execute(vehicles.damage_ranges(countries))}
+    old_ranges = {row.country: (row.min_dmg, row.max_dmg) for row in session.execute(damagerange.find(countries))}
+    changed = {country for country, dmg_range in new_ranges.items() if force or dmg_range != old_ranges.get(country)}
+    unchanged = set(new_ranges) - changed
+
+    if changed:
+        print(f"Damage range changed for {len(changed)} countries, normalizing all their rows")
+        session.execute(damagerange.forget(changed))
+        session.execute(damagerange.record(), [
+            {"country": country, "min_dmg": new_ranges[country][0], "max_dmg": new_ranges[country][1]}
+            for country in changed
+        ])
+        session.execute(vehicles.normalize_amount_damage(countries=changed))
+    if unchanged:
+        print(f"Damage range unchanged for {len(unchanged)} countries, normalizing only their new rows")
+        session.execute(vehicles.normalize_amount_damage(countries=unchanged, only_new=True))
+
+    return set(new_ranges)
+
+
+def update_scoreboard(session: Any, countries: Optional[Set[str]] = None) -> None:
     """
-    Execute all data transformation queries on the database.
+    Replace the pistoncup rows of the given countries with a freshly computed top 10
+
+    :param session: sqlalchemy session object to talk to the database
+    :param countries: The countries to update, all countries if None
+    :return: None
+    """
+    vehicles = database.Vehicle
+    pistoncup = database.PistonCup
+
+    session.execute(pistoncup.wipe_slate(countries=countries))
+    session.execute(pistoncup.import_scoreboard(vehicles.create_topx(countries=countries)))
+
+
+def update_year_scoreboards(session: Any, years: Iterable[int], countries: Optional[Set[str]] = None,
+                            top: int = constants.SCOREBOARD_DEPTH) -> None:
+    """
+    Replace the yearscoreboard rows of the given build years and countries with a freshly computed top
+
+    :param session: sqlalchemy session object to talk to the database
+    :param years: The build years to store a scoreboard of
+    :param countries: The countries to update, all countries if None
+    :param top: Number of make/models per country to store
+    :return: None
+    """
+    vehicles = database.Vehicle
+    yearscoreboard = database.YearScoreboard
+
+    session.execute(yearscoreboard.wipe_slate(years=years, countries=countries))
+    for year in years:
+        session.execute(yearscoreboard.import_scoreboard(
+            year, vehicles.create_topx(top=top, filter_on_year=year, countries=countries)
+        ))
+
+
+def transform_steps(force: bool = False) -> List[Tuple[str, transform.Step]]:
+    """
+    The steps of the sql transformation for one country, in the order they have to run, see
+    `transform.TransformExecutor`
+
+    :param force: Normalize all rows of a country, even if its damage range did not change
+    :return: The name and function of every step
+    """
+    vehicles = database.Vehicle
+    weirdyears = database.WeirdYears
+
+    def sanitize(session: Any, country: str) -> int:
+        session.execute(weirdyears.save_weird_years(source_table=vehicles, countries=[country]))
+        sanitized = session.execute(vehicles.sanitize_build_year(countries=[country])).rowcount
+        vehicles.null_empty_string(session, countries=[country])
+        return sanitized
+
+    def dimension_ids(session: Any, country: str) -> int:
+        return dimensions.fill_ids(session, countries=[country])
+
+    def normalize(session: Any, country: str) -> None:
+        update_normalized_damage(session, countries={country}, force=force)
+
+    def scoreboard(session: Any, country: str) -> None:
+        update_scoreboard(session, countries={country})
+
+    def year_scoreboards(session: Any, country: str) -> None:
+        update_year_scoreboards(session, years=constants.SCOREBOARD_YEARS, countries={country})
+
+    steps = [("dimensions", dimension_ids), ("sanitize", sanitize), ("normalize", normalize),
+             ("scoreboard", scoreboard)]
+    if constants.SCOREBOARD_YEARS:
+        steps.append(("year_scoreboards", year_scoreboards))
+    return steps
+
+
+def run_transforms(engine: Any, incremental: bool = True, workers: Optional[int] = None,
+                   stages: Iterable[str] = ("transform", "scoreboard"),
+                   countries: Optional[Iterable[str]] = None) -> None:
+    """
+    Run the sql transformation per country with short transactions, see `transform.TransformExecutor`. The missing
+    dimension ids are set and the build years are sanitized in every country, in incremental mode the normalization and
+    the scoreboards are only updated for countries that got new rows since the last run. The scoreboards are stored
+    for every country when they run without the transform stage, that already normalized the new rows.
+
+    :param engine: a Sqlalchemy engine object
+    :param incremental: Only update countries with new rows, otherwise recompute everything
+    :param workers: Number of countries transformed at the same time, see `transform.transform_workers`
+    :param stages: Run the steps of these stages, transform and/or scoreboard, see `STEP_STAGES`
+    :param countries: Only transform these countries, like the ones a batch of `stream.StreamIngest` loaded rows for,
+        all countries if None
+    :return: None
+    """
+    vehicles = database.Vehicle
+
+    selected = None if countries is None else set(countries)
+    countries = sorted(row.country for row in engine.execute(vehicles.countries())
+                       if selected is None or row.country in selected)
+    updated = countries
+    if incremental and "transform" in stages:
+        updated = sorted(row.country for row in engine.execute(vehicles.pending_countries())
+                         if selected is None or row.country in selected)
+        print(f"Found new rows for {len(updated)} countries")
+
+    steps = [(name, step) for name, step in transform_steps(force=not incremental) if STEP_STAGES[name] in stages]
+    batches = {name: updated for name, _ in steps}
+    for name in ("dimensions", "sanitize"):
+        if name in batches:
+            batches[name] = countries
+    print(f"Transforming {len(countries)} countries: {', '.join(batches)}")
+    transform.TransformExecutor(engine, steps, transform.transform_workers(engine, workers)).run(batches)
+
+
+@profiled
+def run_db_updates(engine: Any, incremental: bool = True, scoreboard: Optional["analytics.ScoreboardEngine"] = None,
+                   cross_check: bool = False, stages: Iterable[str] = ("transform", "scoreboard")) -> None:
+    """
+    Execute all data transformation queries on the database. Without a scoreboard engine they run per country in short
+    transactions, see `run_transforms`. In incremental mode the normalization and the scoreboard are only updated for
+    countries that got new rows since the last run.
+    When a scoreboard engine is passed, it computed the scoreboard already and only the result is written. The other
+    steps still run, over all countries in one transaction: empty damages are made NULL and the damage is normalized
+    per row like in the sql path. The scoreboards of the SCOREBOARD_YEARS are ranked with sql on the normalized damage
+    of every row, on both paths, so `scoreboard.get_scoreboard` never serves them from before the new rows.
 
     :param engine: a Sqlalchemy engine object
+    :param incremental: Only update countries with new rows, otherwise recompute everything
+    :param scoreboard: Optional scoreboard engine that has seen all vehicles, see `analytics.ScoreboardEngine`
+    :param cross_check: Also compute the scoreboard with sql and raise an error if it differs from the engine's
+    :param stages: Only run the sql steps of these stages, transform and/or scoreboard, see `run_transforms`
     :return: None
     """
+    import analytics
+
+    pistoncup = database.PistonCup
+
+    if scoreboard is None:
+        try:
+            run_transforms(engine, incremental=incremental, stages=stages)
+        finally:
+            # Every completed country is committed, cached scoreboards may be outdated even if others failed
+            bump_generation()
+        print(f"All update done. Result can be found in table {pistoncup.__table__.name}.")
+        return
+
     Session = sessionmaker(bind=engine)
     session = Session()
 
     vehicles = database.Vehicle
     weirdyears = database.WeirdYears
-    pistoncup = database.PistonCup
 
     try:
-        print("Sanitizing build_year")
-        session.execute(weirdyears.save_weird_years(source_table=vehicles))
-        session.execute(vehicles.sanitize_build_year())
+        # Before anything is written, new dimension values are stored over a connection of their own
+        with METRICS.stage("dimensions") as stage:
+            stage.count(rows_out=dimensions.fill_ids(session))
 
-        print("Change empty string to NULL")
-        vehicles.null_empty_string(session)
+        with METRICS.stage("sanitize") as stage:
+            print("Sanitizing build_year")
+            session.execute(weirdyears.save_weird_years(source_table=vehicles))
+            stage.count(rows_out=session.execute(vehicles.sanitize_build_year()).rowcount)
+            vehicles.null_empty_string(session)
 
-        print("Calculate normalized damage")
-        session.execute(vehicles.normalize_amount_damage())
+        # Before the scoreboard engine stores its damage ranges, so the ranges of the last run are compared
+        with METRICS.stage("normalize"):
+            print("Normalizing amount_damage")
+            update_normalized_damage(session, force=not incremental)
 
-        print("Storing top 10 avg dmg per make-model per country")
-        top_x = vehicles.create_topx()
-        session.execute(pistoncup.import_scoreboard(top_x))
+        with METRICS.stage("scoreboard"):
+            print("Storing top 10 avg dmg per make-model per country computed in one pass")
+            scoreboard.write(session)
+        if constants.SCOREBOARD_YEARS:
+            with METRICS.stage("year_scoreboards"):
+                print(f"Storing the scoreboards of build years {', '.join(map(str, constants.SCOREBOARD_YEARS))}")
+                update_year_scoreboards(session, years=constants.SCOREBOARD_YEARS)
+        if cross_check:
+            with METRICS.stage("cross_check"):
+                print("Cross-checking the scoreboard with sql")
+                differences = analytics.compare_scoreboards(
+                    session.execute(sase.select(vehicles.create_topx().columns)), scoreboard.scoreboard()
+                )
+            if differences:
+                raise ValueError(f"Scoreboard differs from the sql path: {differences}")
 
         session.commit()
+        bump_generation()
     except:
         session.rollback()
         raise
@@ -201,30 +1183,102 @@ def run_db_updates(engine: Any) -> None:
         session.close()
 
 
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Download the part files, load them and compute the scoreboards")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES,
+                        help="Stages to run, in the order of the choices")
+    parser.add_argument("--full", action="store_true",
+                        help="Transform and rank all countries, not only the ones with new rows")
+    parser.add_argument("--restart", action="store_true",
+                        help="Forget the checkpoints of interrupted loads and transformations and start those over")
+    parser.add_argument("--sqlite", metavar="PATH",
+                        help="Run on an embedded SQLite database file instead of MySQL, :memory: for one in memory")
+    return parser.parse_args(args)
+
+
+def local_files(sources: Iterable[str], destination: str) -> List[str]:
+    """
+    The part files that were downloaded before, for a run without the download stage
+
+    :param sources: The full URLs of the gzipped files
+    :param destination: The location where the downloaded files are stored
+    :return: The names of the decompressed files that exist, in the order of sources
+    """
+    files = [target_filename_of(source, destination) for source in sources]
+    missing = [file for file in files if not os.path.exists(file)]
+    if missing:
+        print(f"Not downloaded yet, skipping: {', '.join(missing)}")
+    return [file for file in files if os.path.exists(file)]
+
+
 if __name__ == '__main__':
-    # Download, extract and save the data files to disk
-    utils.mkdir(directory=constants.DATA_FOLDER)
-    for file in constants.FILES:
-        download_and_save_gzip_from_url(source=file, destination=constants.DATA_FOLDER)
+    arguments = parse_args()
 
-    # initialize objects to talk to database
-    engine = utils.get_db_engine()
+    # initialize objects to talk to database, every statement is timed
+    engine = utils.get_db_engine(sqlite_database=arguments.sqlite)
+    METRICS.instrument(engine)
     if not database.is_initialized(engine):
         database.initialize_database(engine)
+    if arguments.restart:
+        with engine.begin() as connection:
+            connection.execute(database.IngestCheckpoint.forget())
+            connection.execute(database.TransformCheckpoint.wipe_slate())
+
+    try:
+        # Download, extract and save the data files to disk, the downloads run in the background
+        utils.mkdir(directory=constants.DATA_FOLDER)
+        if "download" in arguments.stages:
+            sources = download_all(sources=constants.FILES, destination=constants.DATA_FOLDER,
+                                   state=load_download_state())
+        else:
+            sources = local_files(sources=constants.FILES, destination=constants.DATA_FOLDER)
 
-    if not check_db_filled(engine):
-        vehicle_table = database.Vehicle
-        mater_table = database.Mater
+        # Threads can't write over a connection they all share, like the one of an in-memory SQLite database, then the
+        # files are streamed from this thread
+        writers = 0 if utils.single_connection(engine) else constants.WRITE_WORKERS
 
-        # Read csv files into lists
-        mater: List[List[str]] = list()
-        vehicles: List[List[str]] = list()
-        for file in os.listdir(constants.DATA_FOLDER):
-            file_vehicle_list = read_data_from_csv(source=os.path.join(constants.DATA_FOLDER, file))
-            mater, vehicles = split_into_long_and_normal_lists(file_vehicle_list, mater, vehicles)
+        # The one pass scoreboard engine sees the rows while they are loaded, if the table starts out empty and the
+        # files are streamed. Otherwise it reads the table once after loading.
+        scoreboard, on_vehicles = None, None
+        if constants.SCOREBOARD_ENGINE == "numpy" and "scoreboard" in arguments.stages:
+            from analytics import ScoreboardEngine
+            scoreboard = ScoreboardEngine()
+            if "ingest" in arguments.stages and (writers or constants.PARSE_WORKERS <= 1) and \
+                    constants.CHUNK_SIZE and engine.execute(database.Vehicle.nr_of_rows()).scalar() == 0:
+                on_vehicles = scoreboard.add
 
-        # Load data lists into database tables
-        insert_into_table(data_list=vehicles, table=vehicle_table, engine=engine)
-        insert_into_table(data_list=mater, table=mater_table, engine=engine)
+        if "ingest" in arguments.stages:
+            # Only files that are not in the manifest with the same checksum are loaded, every file as soon as it is
+            # downloaded
+            new_sources = select_files_to_ingest(sources=sources, engine=engine)
+            if writers and constants.CHUNK_SIZE:
+                # Parse the next chunks while the writer threads load the previous ones
+                pipeline_into_database(sources=new_sources, engine=engine, chunk_size=constants.CHUNK_SIZE,
+                                       writers=writers, parse_workers=constants.PARSE_WORKERS,
+                                       on_vehicles=on_vehicles)
+            elif constants.PARSE_WORKERS > 1:
+                # Parse the csv files in parallel
+                parallel_into_database(sources=new_sources, engine=engine, workers=constants.PARSE_WORKERS)
+            elif constants.CHUNK_SIZE:
+                # Stream the csv files into the database chunk by chunk, resuming at the last loaded chunk
+                stream_into_database(sources=new_sources, engine=engine, chunk_size=constants.CHUNK_SIZE,
+                                     on_vehicles=on_vehicles)
+            else:
+                # Read the csv files into lists one file at a time
+                batch_into_database(sources=new_sources, engine=engine)
+        else:
+            # Wait for the downloads
+            list(sources)
 
-    run_db_updates(engine)
+        if scoreboard is not None:
+            if on_vehicles is None:
+                scoreboard.scan(engine)
+            run_db_updates(engine, incremental=not arguments.full, scoreboard=scoreboard,
+                           cross_check=constants.SCOREBOARD_CROSS_CHECK)
+        elif "transform" in arguments.stages or "scoreboard" in arguments.stages:
+            run_db_updates(engine, incremental=not arguments.full, stages=arguments.stages)
+    finally:
+        # Written even if the run fails, that is when they are needed most
+        METRICS.write_jsonl()
+        METRICS.write_prometheus()
+        print(f"Metrics written to {constants.METRICS_JSONL} and {constants.METRICS_TEXTFILE}")
@@ -0,0 +1,292 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import re
+import resource
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+import uuid
+
+from sqlalchemy import event
+
+import constants
+
+# EXPLAIN prefix per database backend, the default is plain EXPLAIN
+EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+}
+EXPLAINABLE = re.compile(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+
+
+def peak_rss_bytes() -> int:
+    """
+    The peak resident memory of this process so far
+
+    :return: Peak memory in bytes
+    """
+    # Linux reports the maximum resident set size in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stage:
+    """
+    One timed stage of a run, like the download or the ingest of one file. Set the number of rows that went in and
+    came out with `count` before the stage is finished.
+    """
+
+    def __init__(self, collector: "Metrics", name: str, labels: Dict[str, str]):
+        self.collector = collector
+        self.name = name
+        self.labels = labels
+        self.started_at = datetime.now()
+        self.rows_in: Optional[int] = None
+        self.rows_out: Optional[int] = None
+        self._start = time.perf_counter()
+
+    def count(self, rows_in: Optional[int] = None, rows_out: Optional[int] = None) -> None:
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+
+    def finish(self) -> Dict[str, Any]:
+        """
+        Stop the clock and hand the stage over to the collector
+
+        :return: The record of the stage
+        """
+        seconds = time.perf_counter() - self._start
+        rows = self.rows_in if self.rows_in is not None else self.rows_out
+        return self.collector.finish_stage(self, {
+            "type": "stage",
+            "stage": self.name,
+            **self.labels,
+            "started_at": self.started_at.isoformat(),
+            "seconds": round(seconds, 6),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rows_per_sec": round(rows / seconds, 1) if rows is not None and seconds > 0 else None,
+            "peak_rss_bytes": peak_rss_bytes(),
+        })
+
+
+class Metrics:
+    """
+    Collects the stage and query records of one run and writes them out as json lines and as a Prometheus textfile.
+    Stages can run in several threads at once, every thread keeps track of its own open stages so every query is
+    attributed to the stage of the thread that issued it.
+    """
+
+    def __init__(self, slow_query_seconds: float = constants.SLOW_QUERY_SECONDS):
+        self.run_id = uuid.uuid4().hex
+        self.slow_query_seconds = slow_query_seconds
+        self.records: List[Dict[str, Any]] = list()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _open_stages(self) -> List[Stage]:
+        if not hasattr(self._local, "stages"):
+            self._local.stages = list()
+        return self._local.stages
+
+    def current_stage(self) -> Optional[str]:
+        stages = self._open_stages()
+        return stages[-1].name if stages else None
+
+    def start_stage(self, name: str, **labels: str) -> Stage:
+        """
+        Start timing a stage that is finished elsewhere, see `Stage.finish`. Use `stage` where possible.
+
+        :param name: Name of the stage
+        :param labels: Extra fields of the record, like the file name
+        :return: The running stage
+        """
+        stage = Stage(self, name, labels)
+        self._open_stages().append(stage)
+        return stage
+
+    def finish_stage(self, stage: Stage, record: Dict[str, Any]) -> Dict[str, Any]:
+        stages = self._open_stages()
+        if stage in stages:
+            stages.remove(stage)
+        self.add(record)
+        return record
+
+    @contextmanager
+    def stage(self, name: str, **labels: str) -> Iterator[Stage]:
+        """
+        Time the code in the with block as a stage. The stage is recorded even if the block raises an error.
+
+        :param name: Name of the stage
+        :param labels: Extra fields of the record, like the file name
+        :return: A context manager yielding the running stage
+        """
+        stage = self.start_stage(name, **labels)
+        try:
+            yield stage
+        finally:
+            stage.finish()
+
+    def add(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def instrument(self, engine: Any) -> None:
+        """
+        Time every statement that is executed on engine. Statements that take longer than slow_query_seconds are run
+        again with EXPLAIN in front, on the same connection, and the plan is added to their record.
+
+        :param engine: a Sqlalchemy engine object
+        :return: None
+        """
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn: Any, cursor: Any, statement: str, parameters: Any, context: Any,
+                               executemany: bool) -> None:
+        conn.info.setdefault("query_start", list()).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn: Any, cursor: Any, statement: str, parameters: Any, context: Any,
+                              executemany: bool) -> None:
+        seconds = time.perf_counter() - conn.info["query_start"].pop()
+        record = {
+            "type": "query",
+            "stage": self.current_stage(),
+            "statement": " ".join(statement.split())[:1000],
+            "seconds": round(seconds, 6),
+            "rowcount": cursor.rowcount,
+            "executemany": executemany,
+        }
+        if seconds >= self.slow_query_seconds and not executemany and EXPLAINABLE.match(statement):
+            record["explain"] = self.explain(conn, statement, parameters)
+        self.add(record)
+
+    @staticmethod
+    def explain(conn: Any, statement: str, parameters: Any) -> List[List[str]]:
+        """
+        Get the query plan of a statement. This goes straight to the database driver, so it doesn't trigger the
+        execute events again.
+
+        :param conn: Sqlalchemy connection the statement was executed on
+        :param statement: The statement as it was sent to the driver
+        :param parameters: The parameters as they were sent to the driver
+        :return: The rows of the query plan as lists of strings, or the error if the plan couldn't be made
+        """
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(EXPLAIN_PREFIXES.get(conn.dialect.name, "EXPLAIN ") + statement, parameters)
+            return [[str(value) for value in row] for row in cursor.fetchall()]
+        except Exception as e:
+            return [[f"EXPLAIN failed: {e}"]]
+        finally:
+            cursor.close()
+
+    def write_jsonl(self, path: str = constants.METRICS_JSONL, clear: bool = False) -> None:
+        """
+        Append all records of this run to a json lines file, every record tagged with the id of the run
+
+        :param path: Location of the json lines file
+        :param clear: Forget the records once they are written, for a long run that writes them now and then
+        :return: None
+        """
+        with self._lock, open(path, "a") as f:
+            for record in self.records:
+                f.write(json.dumps({"run_id": self.run_id, **record}, default=str) + "\n")
+            if clear:
+                self.records = list()
+
+    def prometheus_lines(self) -> List[str]:
+        """
+        Summarize the records per stage, the depth and wait times of every queue and the last latency percentiles of
+        the streaming ingest in the Prometheus text format
+
+        :return: The lines of the textfile
+        """
+        with self._lock:
+            records = list(self.records)
+
+        stages: Dict[str, Dict[str, float]] = dict()
+        queues = [record for record in records if record["type"] == "queue"]
+        latencies = [record for record in records if record["type"] == "latency"]
+        for record in records:
+            if record["type"] in ("queue", "latency"):
+                continue
+            summary = stages.setdefault(record["stage"] or "none", {
+                "seconds": 0.0, "rows_in": 0, "rows_out": 0, "runs": 0, "peak_rss_bytes": 0,
+                "query_seconds": 0.0, "queries": 0, "slow_queries": 0
+            })
+            if record["type"] == "stage":
+                summary["seconds"] += record["seconds"]
+                summary["rows_in"] += record["rows_in"] or 0
+                summary["rows_out"] += record["rows_out"] or 0
+                summary["runs"] += 1
+                summary["peak_rss_bytes"] = max(summary["peak_rss_bytes"], record["peak_rss_bytes"])
+            else:
+                summary["query_seconds"] += record["seconds"]
+                summary["queries"] += 1
+                summary["slow_queries"] += record["seconds"] >= self.slow_query_seconds
+
+        metrics = [
+            ("act_stage_seconds", "gauge", "Wall time of the stage in seconds", "seconds"),
+            ("act_stage_rows_in", "gauge", "Rows that went into the stage", "rows_in"),
+            ("act_stage_rows_out", "gauge", "Rows that came out of the stage", "rows_out"),
+            ("act_stage_runs", "gauge", "Number of times the stage ran, like once per file", "runs"),
+            ("act_stage_peak_rss_bytes", "gauge", "Peak resident memory of the process so far, at the end of the stage",
+             "peak_rss_bytes"),
+            ("act_query_seconds", "gauge", "Time spent in sql statements issued during the stage", "query_seconds"),
+            ("act_queries", "gauge", "Number of sql statements issued during the stage", "queries"),
+            ("act_slow_queries", "gauge", "Number of sql statements slower than the slow query threshold",
+             "slow_queries"),
+        ]
+        lines = list()
+        for name, kind, description, key in metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, summary in sorted(stages.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {summary[key]}')
+        queue_metrics = [
+            ("act_queue_max_depth", "Largest number of items that waited in the queue", "max_depth"),
+            ("act_queue_mean_depth", "Average number of items in the queue right after a put", "mean_depth"),
+            ("act_queue_put_wait_seconds", "Time the producer waited for room in the queue, the consumer is slower",
+             "put_wait_seconds"),
+            ("act_queue_get_wait_seconds", "Time the consumer waited for work, the producer is slower",
+             "get_wait_seconds"),
+        ]
+        for name, description, key in queue_metrics if queues else list():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            for record in queues:
+                lines.append(f'{name}{{stage="{record["stage"] or "none"}",queue="{record["queue"]}"}} {record[key]}')
+        if latencies:
+            latency = latencies[-1]
+            lines.append("# HELP act_stream_latency_seconds Seconds from the arrival of a record until the ranks "
+                         "of its country were updated, over the recent batches")
+            lines.append("# TYPE act_stream_latency_seconds summary")
+            for quantile in ("50", "95", "99"):
+                lines.append(f'act_stream_latency_seconds{{quantile="0.{quantile}"}} {latency[f"p{quantile}_seconds"]}')
+            lines.append(f"act_stream_latency_seconds_count {latency['batches']}")
+            lines.append("# HELP act_stream_latency_target_seconds Latency the streaming ingest aims for")
+            lines.append("# TYPE act_stream_latency_target_seconds gauge")
+            lines.append(f"act_stream_latency_target_seconds {latency['target_seconds']}")
+            lines.append("# HELP act_stream_batches_over_target Batches with a latency over the target")
+            lines.append("# TYPE act_stream_batches_over_target gauge")
+            lines.append(f"act_stream_batches_over_target {latency['over_target']}")
+        lines.append("# HELP act_last_run_timestamp_seconds Time the metrics of the last run were written")
+        lines.append("# TYPE act_last_run_timestamp_seconds gauge")
+        lines.append(f"act_last_run_timestamp_seconds {time.time():.0f}")
+        return lines
+
+    def write_prometheus(self, path: str = constants.METRICS_TEXTFILE) -> None:
+        """
+        Write the Prometheus textfile. The file is replaced in one go, so the node exporter never reads half a file.
+
+        :param path: Location of the textfile, normally in the textfile collector directory of the node exporter
+        :return: None
+        """
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(self.prometheus_lines()) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+# The collector of this process, used by main.py
+METRICS = Metrics()
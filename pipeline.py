@@ -0,0 +1,194 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from metrics import METRICS
+
+# Tells a writer thread that no more work will come
+STOP = object()
+
+
+class MonitoredQueue(queue.Queue):
+    """
+    Bounded queue that keeps track of how full it was and of how long was waited on it. A producer that waits long to
+    put means the consumers are the bottleneck, consumers that wait long to get mean the producer is.
+    """
+
+    def __init__(self, name: str, maxsize: int):
+        super().__init__(maxsize)
+        self.name = name
+        self.puts = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None) -> None:
+        start = time.perf_counter()
+        super().put(item, block, timeout)
+        waited = time.perf_counter() - start
+        with self.mutex:
+            depth = self._qsize()
+            self.puts += 1
+            self.depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+            self.put_wait += waited
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        start = time.perf_counter()
+        item = super().get(block, timeout)
+        waited = time.perf_counter() - start
+        with self.mutex:
+            self.get_wait += waited
+        return item
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        The depth and wait times of the queue so far, as a metrics record
+
+        :return: The record of the queue
+        """
+        with self.mutex:
+            return {
+                "type": "queue",
+                "stage": METRICS.current_stage(),
+                "queue": self.name,
+                "maxsize": self.maxsize,
+                "puts": self.puts,
+                "mean_depth": round(self.depth_total / self.puts, 2) if self.puts else 0.0,
+                "max_depth": self.max_depth,
+                "put_wait_seconds": round(self.put_wait, 6),
+                "get_wait_seconds": round(self.get_wait, 6),
+            }
+
+
+class Barrier:
+    """
+    Work item that is put into the queue of every writer. The writer that reaches it last calls the callback, at that
+    point all work that was put before the barrier is done.
+    """
+
+    def __init__(self, callback: Callable[[], None], parties: int):
+        self.callback = callback
+        self.remaining = parties
+        self._lock = threading.Lock()
+
+    def arrive(self) -> None:
+        with self._lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last:
+            self.callback()
+
+
+def partition(rows: Sequence[Sequence[Any]], parts: int, key_size: int = 3) -> List[List[Sequence[Any]]]:
+    """
+    Spread rows over parts on a hash of their primary key, the first key_size values. All rows with the same key end up
+    in the same part in their original order, so a first-wins deduplication per part keeps the same rows as one over
+    all rows.
+
+    :param rows: Rows to spread
+    :param parts: Number of parts
+    :param key_size: Number of leading values that form the primary key
+    :return: A list of rows for every part
+    """
+    if parts == 1:
+        return [list(rows)]
+    result: List[List[Sequence[Any]]] = [list() for _ in range(parts)]
+    for row in rows:
+        result[hash(tuple(row[:key_size])) % parts].append(row)
+    return result
+
+
+class WriterPool:
+    """
+    Writer threads that each drain their own bounded queue with the write function, so the producer can carry on with
+    the next chunk while earlier ones are written. A full queue blocks the producer, which keeps it from racing ahead of
+    the writers and bounds the memory to about workers * queue_size work items. Every queue is drained in order.
+
+    The first error of a writer is raised to the producer on its next put, or when the pool is closed. The other
+    writers keep draining their queues without writing, so the producer never blocks for good.
+    """
+
+    def __init__(self, write: Callable[[Any], None], workers: int, queue_size: int, name: str = "writer"):
+        """
+        :param write: Function that is called with every work item in a writer thread
+        :param workers: Number of writer threads
+        :param queue_size: Number of work items that can wait in the queue of a writer
+        :param name: Prefix of the names of the queues and threads
+        """
+        self.write = write
+        self.queues = [MonitoredQueue(f"{name}_{nr}", queue_size) for nr in range(workers)]
+        self.errors: List[BaseException] = list()
+        self.threads = [threading.Thread(target=self._drain, args=(work,), name=work.name, daemon=True)
+                        for work in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self) -> "WriterPool":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close(raise_errors=exc_info[0] is None)
+
+    def _drain(self, work: MonitoredQueue) -> None:
+        while True:
+            item = work.get()
+            if item is STOP:
+                return
+            try:
+                if isinstance(item, Barrier):
+                    if not self.errors:
+                        item.arrive()
+                elif not self.errors:
+                    self.write(item)
+            except BaseException as e:
+                self.errors.append(e)
+
+    def put(self, worker: int, item: Any) -> None:
+        """
+        Hand a work item to one of the writers, waiting for room in its queue
+
+        :param worker: Number of the writer
+        :param item: The work item
+        :return: None
+        """
+        if self.errors:
+            raise self.errors[0]
+        self.queues[worker].put(item)
+
+    def barrier(self, callback: Callable[[], None]) -> None:
+        """
+        Call callback in a writer thread as soon as all work items that were put so far are written
+
+        :param callback: Function without arguments
+        :return: None
+        """
+        barrier = Barrier(callback, len(self.queues))
+        for worker in range(len(self.queues)):
+            self.put(worker, barrier)
+
+    def close(self, raise_errors: bool = True) -> None:
+        """
+        Wait until the writers have drained their queues and add the statistics of every queue to the metrics
+
+        :param raise_errors: Raise the first error of a writer
+        :return: None
+        """
+        for work in self.queues:
+            work.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+        put_wait = get_wait = 0.0
+        for work in self.queues:
+            record = work.stats()
+            METRICS.add(record)
+            put_wait += record["put_wait_seconds"]
+            get_wait += record["get_wait_seconds"]
+        print(f"Producer waited {put_wait:.2f} sec for room in the queues, the {len(self.queues)} writers waited "
+              f"{get_wait:.2f} sec in total for work")
+
+        if raise_errors and self.errors:
+            raise self.errors[0]
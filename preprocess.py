@@ -0,0 +1,469 @@
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP
+from itertools import islice, repeat
+from operator import itemgetter, methodcaller
+import csv
+import gc
+import re
+import time
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import constants
+
+# Options of the csv reader for the part files
+CSV_FORMAT = dict(quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+INT_PREFIX = re.compile(r"\s*[-+]?\d+")
+DECIMAL_PREFIX = re.compile(r"\s*[-+]?(\d+\.?\d*|\.\d+)")
+# Largest value that fits in a DECIMAL(14, 2) column
+MAX_DECIMAL = Decimal("999999999999.99")
+# Number of fields of a correct row of a part file
+NR_OF_FIELDS = 36
+# Outcomes of `tokenize_line`
+TOKEN_CLEAN, TOKEN_REPAIRED, TOKEN_FALLBACK = 0, 1, 2
+# Number of lines tokenized at once when the rows are handed out one at a time
+TOKENIZE_BATCH_SIZE = 10000
+
+
+def iter_records(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Put a record back together that the file splits over several lines, because a quoted field contains a newline like
+    in `"Sport\nLine"`. A line with an odd number of quotes may leave a field open, the lines after it are added to it
+    up to a record boundary: a line that ends on a quote followed by one that starts with one, see `main.ends_record`.
+    A line with the stray quote of an inch mark is followed by such a boundary, so it is handed out as it is.
+
+    :param lines: Any iterable of csv lines, like an open file object
+    :return: a generator yielding every record as a single string, with the newlines inside its fields
+    """
+    record = None
+    for line in lines:
+        if record is not None:
+            if record.rstrip("\r\n").endswith('"') and line.startswith('"'):
+                yield record
+                record = None
+            else:
+                record += line
+                continue
+        if line.endswith('"\n') and not line.endswith(',"\n') or line.count('"') % 2 == 0:
+            yield line
+        else:
+            record = line
+    if record is not None:
+        yield record
+
+
+def tokenize_line(line: str) -> Tuple[List[str], int]:
+    """
+    Split a line of a part file into its fields in one go. In the part files every field is quoted and nothing is
+    escaped, so the fields are simply what is between the '","' separators. A stray quote inside a field, like the
+    inch mark in `"Sport Line 16""` or `15" SXGA displej`, stays part of the field, where the csv reader would end the
+    field on it and split or merge the fields around it. What is left to repair:
+    - extra fields after the 36th that are all empty are dropped
+    - in a row with less than 36 fields a field that lacks the opening quote of the next one, like `Pure White",sedan`,
+      is split in two, see `fix_short_row`
+    Lines that are not quoted from start to end are left to the csv reader.
+
+    :param line: One line of a part file
+    :return: The fields and TOKEN_CLEAN, TOKEN_REPAIRED if there was a stray quote or a repair, or TOKEN_FALLBACK if the
+        row still doesn't have 36 fields
+    """
+    line = line.rstrip("\r\n")
+    if len(line) < 2 or line[0] != '"' or line[-1] != '"':
+        fields = next(csv.reader([line], **CSV_FORMAT), list())
+        return fields, TOKEN_CLEAN if len(fields) == NR_OF_FIELDS else TOKEN_FALLBACK
+
+    fields = line[1:-1].split('","')
+    if len(fields) == NR_OF_FIELDS:
+        return fields, TOKEN_CLEAN if line.count('"') == 2 * NR_OF_FIELDS else TOKEN_REPAIRED
+    elif len(fields) > NR_OF_FIELDS:
+        while len(fields) > NR_OF_FIELDS and fields[-1] == "":
+            fields.pop()
+    else:
+        fields = fix_short_row(fields)
+    return fields, TOKEN_REPAIRED if len(fields) == NR_OF_FIELDS else TOKEN_FALLBACK
+
+
+def tokenize_lines(lines: Iterable[str], outcomes: Optional[Counter] = None) -> List[List[str]]:
+    """
+    Batched counterpart of `tokenize_line`. Nearly every line consists of 36 quoted fields and a newline, those are
+    split in one list comprehension and picked out on their field count and their first and last character. Only the
+    other lines go through `tokenize_line` one by one. A record that spans several lines has to be joined by
+    `iter_records` first.
+
+    :param lines: Records of a part file, without the header
+    :param outcomes: Optional counter that gets the number of rows per outcome of `tokenize_line`
+    :return: The fields of every line
+    """
+    import numpy as np
+
+    lines = lines if isinstance(lines, list) else list(lines)
+    rows = [line[1:-2].split('","') for line in lines]
+    regular = (np.fromiter(map(len, rows), dtype=np.int64, count=len(rows)) == NR_OF_FIELDS) & \
+        np.fromiter(map(methodcaller("startswith", '"'), lines), dtype=bool, count=len(lines)) & \
+        np.fromiter(map(methodcaller("endswith", '"\n'), lines), dtype=bool, count=len(lines))
+    if outcomes is not None:
+        stray_quotes = np.fromiter(map(methodcaller("count", '"'), lines), dtype=np.int64, count=len(lines)) != \
+            2 * NR_OF_FIELDS
+        outcomes[TOKEN_CLEAN] += int(np.count_nonzero(regular & ~stray_quotes))
+        outcomes[TOKEN_REPAIRED] += int(np.count_nonzero(regular & stray_quotes))
+
+    for position in np.flatnonzero(~regular).tolist():
+        rows[position], outcome = tokenize_line(lines[position])
+        if outcomes is not None:
+            outcomes[outcome] += 1
+    return rows
+
+
+def iter_rows_from_csv(lines: Iterable[str], skip_header: bool = True, tokenize: bool = True,
+                       outcomes: Optional[Counter] = None) -> Iterator[List[str]]:
+    """
+    Parse csv lines one row at a time, skipping the header and making the primary key fields upper case.
+
+    :param lines: Any iterable of csv lines, like an open file object
+    :param skip_header: Whether the first line is the header
+    :param tokenize: Split the lines with `tokenize_lines`, in batches, otherwise with the csv reader as before
+    :param outcomes: Optional counter that gets the number of rows per outcome of `tokenize_line`
+    :return: a generator yielding every row of the csv as a list
+    """
+    if tokenize:
+        lines = iter_records(lines)
+        if skip_header:
+            next(lines, None)
+        reader = (row for batch in iter(lambda: list(islice(lines, TOKENIZE_BATCH_SIZE)), list())
+                  for row in tokenize_lines(batch, outcomes))
+    else:
+        reader = csv.reader(lines, **CSV_FORMAT)
+        if skip_header:
+            next(reader, None)
+    for row in reader:
+        # Make all PK fields upper case for deduplication later
+        row[:3] = [x.upper() for x in row[:3]]
+        yield row
+
+
+def fix_short_row(row: List[str]) -> List[str]:
+    """
+    All short rows (less than 36 fields) contain an extra " in a field value. This is either due to typos in the colour
+    field (example: Pure White",sedan") or because of wheel sizes in inches in the type field (example: 1.5d N-TEC 17")
+
+    :param row: a list containing less than 36 items
+    :return: A list containing 36 items
+    """
+    new_row = list()
+    for item in row:
+        new_row.extend(item.split('",'))
+    return new_row
+
+
+def make_long_enough(row: List[str]) -> List[str]:
+    if len(row) > 40:
+        row = row[:40]
+    else:
+        for i in range(40-len(row)):
+            row.append(None)
+
+    return row
+
+
+def parse_int_prefix(value: Optional[str]) -> Optional[int]:
+    """
+    Read the integer a string starts with, the way MySQL casts a string to an integer: leading spaces are skipped and
+    a string that doesn't start with a number counts as 0.
+
+    :param value: The string to convert
+    :return: The integer, None if value is None
+    """
+    if value is None:
+        return None
+    match = INT_PREFIX.match(value)
+    return int(match.group()) if match else 0
+
+
+def parse_decimal_prefix(value: Optional[str]) -> Optional[Decimal]:
+    """
+    Read the number a string starts with as a decimal with 2 decimals, the way MySQL casts a string to DECIMAL(14, 2).
+    Empty strings are treated as missing, like `database.Vehicle.null_empty_string` does.
+
+    :param value: The string to convert
+    :return: The rounded decimal, None if value is None or empty
+    """
+    if value is None or value == "":
+        return None
+    match = DECIMAL_PREFIX.match(value)
+    number = Decimal(match.group()) if match else Decimal(0)
+    return max(min(number, MAX_DECIMAL), -MAX_DECIMAL).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def parse_date(value: Optional[str]) -> Optional[date]:
+    """
+    Read a YYYY-MM-DD date like the firstuse field
+
+    :param value: The string to convert
+    :return: The date, None if value is not a valid date
+    """
+    try:
+        return date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+def typed_values(row: List[str]) -> List[Any]:
+    """
+    Convert the build_year, amount_damage and firstuse fields of a vehicle row once, at load time, for the typed
+    columns of `database.Vehicle`. The transform queries filter and aggregate on these instead of casting the text
+    columns on every row of every query.
+
+    :param row: a vehicle row with 36 fields
+    :return: The integer build year, the decimal amount damage and the date of first use
+    """
+    return [parse_int_prefix(row[25]), parse_decimal_prefix(row[26]), parse_date(row[24])]
+
+
+def route_row(row: List[str]) -> Tuple[bool, List[str]]:
+    """
+    Repair a single row and decide which table it belongs to.
+    The assumption here is that rows of length 36 are read in correctly, shorter rows just have 1 or 2 easily rectified
+    errors and longer rows are kept separate.
+    The 36 long rows are extended with an empty field for the normalized damage and with the typed columns, see
+    `typed_values`.
+
+    :param row: a row as returned by the csv reader
+    :return: A tuple with a boolean that is True for mater rows and the repaired row
+    """
+    if len(row) > 36:
+        # Know too little about long_rows to pull erroneous fields together therefore
+        # make every mater row exactly 40 long to fit mater table
+        return True, make_long_enough(row)
+    elif len(row) < 36:
+        # explanation on short_row cause and fix in fix_short_row
+        row = fix_short_row(row)
+        if len(row) != 36:
+            # Splitting on the stray quotes made too many fields or too few were repaired, keep these apart like the
+            # long rows instead of shifting or padding the fields of vehicles
+            return True, make_long_enough(row)
+    # All rows with 36 fields can be appended to vehicles after receiving an empty column for insertion
+    row.append(None)
+    row.extend(typed_values(row))
+    return False, row
+
+
+@contextmanager
+def paused_gc() -> Iterator[None]:
+    """
+    Switch off the cyclic garbage collector while a batch is built. A batch consists of lists of strings, which can't
+    form reference cycles, yet every few hundred new lists the collector scans all of them again, which takes up more
+    time than the repair itself.
+
+    :return: A context manager during which the collector is off
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def take(rows: Sequence[Any], positions: Any) -> List[Any]:
+    """
+    Pick the items at the given positions out of a list in one call, instead of one index lookup at a time
+
+    :param rows: The list to pick from
+    :param positions: numpy array of the positions to pick
+    :return: A list with the picked items in the order of positions
+    """
+    if len(positions) == 0:
+        return list()
+    elif len(positions) == 1:
+        return [rows[positions[0]]]
+    return list(itemgetter(*positions.tolist())(rows))
+
+
+def map_distinct(function: Callable[[Hashable], Any], column: Sequence[Hashable]) -> List[Any]:
+    """
+    Apply function to every value of a column, but call it only once per distinct value. Columns like build_year and
+    firstuse have far fewer distinct values than rows.
+
+    :param function: Function converting a single value
+    :param column: The values of one column
+    :return: The converted values in the order of column
+    """
+    lookup = {value: function(value) for value in set(column)}
+    return list(map(lookup.__getitem__, column))
+
+
+def repair_vehicle_rows(rows: List[List[str]]) -> List[List[Any]]:
+    """
+    Batched counterpart of `route_row` for rows with exactly 36 fields. The rows are turned into columns, the primary
+    key columns are made upper case and the typed columns are converted column by column, see `typed_values`. Then
+    the columns are zipped back into rows.
+
+    :param rows: Rows with 36 fields as returned by the csv reader
+    :return: The rows as `route_row` returns them
+    """
+    if not rows:
+        return list()
+
+    columns: List[Sequence[Any]] = list(zip(*rows))
+    # Make all PK fields upper case for deduplication later
+    columns[:3] = [list(map(str.upper, column)) for column in columns[:3]]
+    build_year_int = map_distinct(parse_int_prefix, columns[25])
+    amount_damage_num = map_distinct(parse_decimal_prefix, columns[26])
+    firstuse_date = map_distinct(parse_date, columns[24])
+    return list(map(list, zip(*columns, repeat(None), build_year_int, amount_damage_num, firstuse_date)))
+
+
+def split_lines(lines: Iterable[str], skip_header: bool = True) -> Tuple[List[List[str]], List[List[Any]]]:
+    """
+    Parse, repair and route a batch of csv lines at once, joined into records by `iter_records` and split by
+    `tokenize_lines`. The output is exactly that of `main.split_into_long_and_normal_lists` on the rows of
+    `iter_rows_from_csv`, but the rows with the expected 36 fields, nearly all of them, are not handled one by one:
+    they are picked out on their field count and repaired as columns in `repair_vehicle_rows`. Only the short and long
+    rows go through `route_row`, after which the short ones that were repaired are put back in their original place
+    among the vehicle rows. The garbage collector is paused meanwhile, see `paused_gc`.
+
+    :param lines: A batch of csv lines, like an open file object or a list of lines
+    :param skip_header: Whether the first line is the header
+    :return: The list of too-long rows and the list of correct length rows
+    """
+    with paused_gc():
+        return _split_lines(lines, skip_header)
+
+
+def _split_lines(lines: Iterable[str], skip_header: bool) -> Tuple[List[List[str]], List[List[Any]]]:
+    lines = iter_records(lines)
+    if skip_header:
+        next(lines, None)
+    return split_rows(tokenize_lines(list(lines)))
+
+
+def split_rows(rows: List[List[str]]) -> Tuple[List[List[str]], List[List[Any]]]:
+    """
+    Repair and route rows that are split into fields already, like the rows of `tokenize_lines` or records that came
+    in as json, see `split_lines`
+
+    :param rows: The fields of every row, the primary key fields are made upper case in place
+    :return: The list of too-long rows and the list of correct length rows
+    """
+    import numpy as np
+
+    field_counts = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    regular = np.flatnonzero(field_counts == 36)
+    irregular = np.flatnonzero(field_counts != 36)
+    if len(irregular) == 0:
+        return list(), repair_vehicle_rows(rows)
+
+    mater = list()
+    short_rows = list()
+    short_positions = list()
+    for position in irregular.tolist():
+        row = rows[position]
+        # Make all PK fields upper case for deduplication later
+        row[:3] = [x.upper() for x in row[:3]]
+        is_long, row = route_row(row)
+        if is_long:
+            mater.append(row)
+        else:
+            short_rows.append(row)
+            short_positions.append(position)
+
+    vehicles = repair_vehicle_rows(take(rows, regular))
+    if short_rows:
+        order = np.argsort(np.concatenate([regular, np.array(short_positions, dtype=np.int64)]), kind="stable")
+        vehicles = take(vehicles + short_rows, order)
+
+    return mater, vehicles
+
+
+def iter_split_chunks(lines: Iterable[str], chunk_size: int, skip_header: bool = True) -> \
+        Iterator[Tuple[List[List[str]], List[List[Any]]]]:
+    """
+    Streaming use of `split_lines`: hand out the too-long rows and the correct length rows of every chunk_size records.
+    A record that spans several lines is kept in one chunk, see `iter_records`.
+
+    :param lines: Any iterable of csv lines, like an open file object
+    :param chunk_size: Number of records per chunk
+    :param skip_header: Whether the first line is the header
+    :return: a generator yielding the mater rows and vehicle rows of every chunk
+    """
+    lines = iter_records(lines)
+    if skip_header:
+        next(lines, None)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield split_lines(chunk, skip_header=False)
+
+
+def synthetic_lines(nr_of_rows: int) -> Iterator[str]:
+    """
+    Generate csv lines that look like the part files: mostly rows with 36 fields, 1% short rows with a stray '",'
+    and 1% long rows.
+
+    :param nr_of_rows: Number of lines to generate, a header line comes on top
+    :return: a generator yielding the lines
+    """
+    yield ",".join(f'"field{nr}"' for nr in range(36)) + "\n"
+    for nr in range(nr_of_rows):
+        fields = [f"lpa{nr % 7}", str(nr), f"lic{nr % 1000}", "make", "model", "type", "trim", "colour"] + \
+                 ["x"] * 16 + [f"20{nr % 20:02d}-0{nr % 9 + 1}-1{nr % 10}", str(1990 + nr % 35), str(nr % 5000)] + \
+                 [""] * 9
+        if nr % 100 == 1:
+            fields[7] = 'Pure White",sedan'
+            del fields[8]
+        elif nr % 100 == 2:
+            fields += ["extra"] * 3
+        yield ",".join('"' + field + '"' for field in fields) + "\n"
+
+
+def benchmark_split_lines(nr_of_rows: int = 1000000, chunk_size: int = constants.CHUNK_SIZE) -> Dict[str, float]:
+    """
+    Compare the seconds per million rows of the row by row repair with the csv reader as it was done before,
+    `iter_rows_from_csv(tokenize=False)` and `route_row`, the row by row repair with the tokenizer and `split_lines` on
+    synthetic lines, checking on the way that the last two give the same output. The number of rows that end up in
+    mater is printed per method as well.
+
+    :param nr_of_rows: Number of rows to repair with every method
+    :param chunk_size: Number of lines per batch
+    :return: A dictionary with the seconds per million rows per method
+    """
+    chunks = list()
+    lines = synthetic_lines(nr_of_rows)
+    next(lines)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            break
+        chunks.append(chunk)
+
+    timings = {"csv_reader": 0.0, "row_by_row": 0.0, "split_lines": 0.0}
+    nr_of_mater = dict.fromkeys(timings, 0)
+    for chunk in chunks:
+        for method, tokenize in (("csv_reader", False), ("row_by_row", True)):
+            start = time.perf_counter()
+            mater, vehicles = list(), list()
+            for row in iter_rows_from_csv(chunk, skip_header=False, tokenize=tokenize):
+                is_long, row = route_row(row)
+                (mater if is_long else vehicles).append(row)
+            timings[method] += time.perf_counter() - start
+            nr_of_mater[method] += len(mater)
+
+        start = time.perf_counter()
+        result = split_lines(chunk, skip_header=False)
+        timings["split_lines"] += time.perf_counter() - start
+        nr_of_mater["split_lines"] += len(result[0])
+        assert result == (mater, vehicles), "split_lines differs from the row by row repair"
+
+    results = {method: seconds * 1000000 / nr_of_rows for method, seconds in timings.items()}
+    for method, seconds in results.items():
+        print(f"{method}: {seconds:.2f} sec per million rows, {nr_of_mater[method]} rows to mater")
+    print(f"Speedup: {results['csv_reader'] / results['split_lines']:.2f}x")
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_split_lines()
@@ -0,0 +1,178 @@
+from collections import Counter
+from functools import wraps
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Optional, Set
+
+import constants
+
+
+def selected_stages(value: Optional[str] = None) -> Set[str]:
+    """
+    Read which stages to profile from the ACT_PROFILE environment variable, a comma separated list of stage names or
+    "all". The stage names are the names of the decorated functions, like read_data_from_csv or run_db_updates.
+
+    :param value: The value to parse instead of the environment variable
+    :return: The names of the stages to profile, empty if profiling is off
+    """
+    if value is None:
+        value = os.environ.get(constants.PROFILE_ENV, "")
+    return {stage.strip() for stage in value.split(",") if stage.strip()}
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    """
+    Snapshot of the traced memory, without the allocations of the profiler itself
+
+    :return: The filtered snapshot
+    """
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+
+
+class StackSampler(threading.Thread):
+    """
+    Sample the call stack of one thread at a fixed interval and count every distinct stack, for a flame graph. Unlike
+    cProfile this shows the full path to every hot spot, not only the direct callers.
+    """
+
+    def __init__(self, thread_id: int, interval: float = constants.PROFILE_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+class Profiler:
+    """
+    Profile the selected stages with cProfile, a stack sampler and tracemalloc. The results of all calls of a stage are
+    added up and written to the output directory after every call:
+    - <stage>.pstats, to be read with `pstats` or a viewer like snakeviz
+    - <stage>.collapsed, the sampled stacks in the collapsed format of flamegraph.pl and speedscope
+    - <stage>.alloc.txt, the peak traced memory of every call and the sites that allocated the most memory that was
+      still in use when the call returned
+    """
+
+    def __init__(self, stages: Set[str], output_dir: str = constants.PROFILE_DIR, top_allocations: int = 25):
+        self.stages = stages
+        self.output_dir = output_dir
+        self.top_allocations = top_allocations
+        self._stats: Dict[str, pstats.Stats] = dict()
+        self._stacks: Dict[str, Counter] = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._tracing = 0
+
+    def enabled(self, stage: str) -> bool:
+        return "all" in self.stages or stage in self.stages
+
+    def profiled(self, function: Callable) -> Callable:
+        """
+        Decorator that profiles every call of function as the stage with the name of the function. When the stage is
+        not selected the function itself is returned, so there is no overhead at all.
+
+        :param function: The function to profile
+        :return: The wrapped function, or function itself
+        """
+        stage = function.__name__
+        if not self.enabled(stage):
+            return function
+
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            # Only one cProfile can be active per thread, a stage called from within another stage is part of the
+            # profile of the outer one
+            if getattr(self._local, "active", False):
+                return function(*args, **kwargs)
+            self._local.active = True
+            try:
+                return self._run(stage, function, *args, **kwargs)
+            finally:
+                self._local.active = False
+
+        return wrapper
+
+    def _start_tracing(self) -> None:
+        with self._lock:
+            if self._tracing == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._tracing += 1
+
+    def _stop_tracing(self) -> None:
+        with self._lock:
+            self._tracing -= 1
+            if self._tracing == 0:
+                tracemalloc.stop()
+
+    def _run(self, stage: str, function: Callable, *args: Any, **kwargs: Any) -> Any:
+        self._start_tracing()
+        if hasattr(tracemalloc, "reset_peak"):
+            # Python 3.9 and up, before that the peak is the one since tracing started
+            tracemalloc.reset_peak()
+        before = take_snapshot()
+        sampler = StackSampler(threading.get_ident())
+        profile = cProfile.Profile()
+        sampler.start()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start
+            stacks = sampler.stop()
+            after = take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            self._stop_tracing()
+            self._write(stage, profile, stacks, after.compare_to(before, "lineno"), peak, seconds)
+
+    def _write(self, stage: str, profile: cProfile.Profile, stacks: Counter, allocations: list, peak: int,
+               seconds: float) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, stage)
+        with self._lock:
+            first_call = stage not in self._stats
+            if first_call:
+                self._stats[stage] = pstats.Stats(profile)
+                self._stacks[stage] = stacks
+            else:
+                self._stats[stage].add(profile)
+                self._stacks[stage].update(stacks)
+            self._stats[stage].dump_stats(f"{path}.pstats")
+            with open(f"{path}.collapsed", "w") as f:
+                for stack, count in self._stacks[stage].most_common():
+                    f.write(f"{stack} {count}\n")
+            with open(f"{path}.alloc.txt", "w" if first_call else "a") as f:
+                f.write(f"# {stage}: {seconds:.2f} sec, peak traced memory {peak / 1024 ** 2:.1f} MB\n")
+                for allocation in allocations[:self.top_allocations]:
+                    f.write(f"{allocation}\n")
+        print(f"Profile of {stage} written to {path}.pstats, .collapsed and .alloc.txt")
+
+
+# The profiler of this process, configured from the environment when the module is imported
+PROFILER = Profiler(selected_stages())
+profiled = PROFILER.profiled
@@ -0,0 +1,148 @@
+from collections import OrderedDict
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import sqlalchemy.sql.expression as sase
+
+import constants
+import database
+
+# The cut that `main.run_db_updates` stores in the pistoncup table, the defaults of `database.Vehicle.create_topx`
+PISTONCUP_YEAR = 2016
+PISTONCUP_TOP = 10
+
+
+class ScoreboardCache:
+    """
+    Least recently used cache of scoreboard results, in memory of this process. An entry expires after ttl seconds and
+    all entries are dropped when the generation is bumped, which happens every time the vehicles table changes. The
+    ttl catches changes made by other processes, which can't bump the generation of this one.
+    """
+
+    def __init__(self, max_size: int = constants.SCOREBOARD_CACHE_SIZE, ttl: float = constants.SCOREBOARD_CACHE_TTL,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        :param key: The parameters of the result
+        :return: The cached result, None if it is not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any, generation: int) -> None:
+        """
+        Cache a result, unless the generation was bumped while it was computed because then it may be stale already
+
+        :param key: The parameters of the result
+        :param value: The result
+        :param generation: The generation at the moment the computation started
+        :return: None
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def bump(self) -> int:
+        """
+        Start a new generation, which invalidates all cached results
+
+        :return: The new generation
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            return self.generation
+
+
+# The cache of this process, bumped by `main` after every ingest and every run of the transformations
+CACHE = ScoreboardCache()
+
+
+def bump_generation() -> int:
+    return CACHE.bump()
+
+
+def precomputed_scoreboard(year: int, top: int, country: Optional[str] = None) -> Optional[sase.select]:
+    """
+    Find a stored scoreboard that contains the requested one: the rank of a make/model doesn't depend on how many are
+    kept, so a scoreboard of the same year that is at least as deep only needs its lower ranks cut off.
+
+    :param year: Build year of the cars
+    :param top: Number of make/models per country, ties included
+    :param country: Only this country, all countries if None
+    :return: A sql statement selecting the scoreboard, None if it isn't stored
+    """
+    if year == PISTONCUP_YEAR and top <= PISTONCUP_TOP:
+        return database.PistonCup.find(top=top, country=country)
+    if year in constants.SCOREBOARD_YEARS and top <= constants.SCOREBOARD_DEPTH:
+        return database.YearScoreboard.find(year=year, top=top, country=country)
+    return None
+
+
+def query_scoreboard(engine: Any, country: Optional[str] = None, year: int = PISTONCUP_YEAR,
+                     top: int = PISTONCUP_TOP) -> List[Dict[str, Any]]:
+    """
+    Get a scoreboard from the database, from a stored scoreboard if there is one and ranked on the fly otherwise
+
+    :param engine: a Sqlalchemy engine object
+    :param country: Only this country, all countries if None
+    :param year: Build year of the cars
+    :param top: Number of make/models per country, ties included
+    :return: The scoreboard rows ordered by country and rank
+    """
+    stmt = precomputed_scoreboard(year=year, top=top, country=country)
+    if stmt is None:
+        top_x = database.Vehicle.create_topx(top=top, filter_on_year=year,
+                                             countries=None if country is None else [country])
+        stmt = sase.select(top_x.columns)
+
+    rows = [
+        {"country": row[0], "make": row[1], "model": row[2], "amount_damage": float(row[3]), "rnk": int(row[4])}
+        for row in engine.execute(stmt)
+    ]
+    return sorted(rows, key=lambda row: (row["country"], row["rnk"], row["make"], row["model"]))
+
+
+def get_scoreboard(engine: Any, country: Optional[str] = None, year: int = PISTONCUP_YEAR, top: int = PISTONCUP_TOP,
+                   cache: ScoreboardCache = CACHE) -> List[Dict[str, Any]]:
+    """
+    Get the make/models with the highest average normalized damage per country, for any build year and any number of
+    make/models. Results are cached per set of parameters, so repeated calls don't reach the database until the cache
+    entry expires or the vehicles table changes.
+
+    :param engine: a Sqlalchemy engine object
+    :param country: Only this country, all countries if None
+    :param year: Build year of the cars
+    :param top: Number of make/models per country, ties included
+    :param cache: The cache to use, the one of this process by default
+    :return: The scoreboard rows with country, make, model, amount_damage and rnk, ordered by country and rank
+    """
+    key = (country, year, top)
+    rows = cache.get(key)
+    if rows is None:
+        generation = cache.generation
+        rows = query_scoreboard(engine, country=country, year=year, top=top)
+        cache.put(key, rows, generation)
+    # Copies, so a caller changing a row doesn't change the cache
+    return [dict(row) for row in rows]
@@ -0,0 +1,367 @@
+import argparse
+from collections import deque
+import gzip
+import json
+import math
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import constants
+import database
+import main
+from metrics import METRICS
+import pipeline
+import preprocess
+from scoreboard import bump_generation
+import utils
+
+# Start of the header line of the part files, header lines are skipped
+HEADER = '"country",'
+# The fields of a part file in their order, the keys of a record that comes in as a json object
+FIELDS = [column.name for column in database.Vehicle.__table__.columns][:preprocess.NR_OF_FIELDS]
+# Weight of the last batch in the estimate of how long it takes to load a batch and update the ranks
+PROCESSING_WEIGHT = 0.2
+
+
+class SpoolFile:
+    """
+    Marks the end of the records of a file in the spool directory. The file is moved to the done directory once the
+    micro-batch with its last records is loaded, see `StreamIngest.run`.
+    """
+
+    def __init__(self, path: str, done: str):
+        """
+        :param path: Path to the file in the spool directory
+        :param done: Directory the file is moved to
+        """
+        self.path = path
+        self.done = done
+
+    def finish(self) -> None:
+        os.replace(self.path, os.path.join(self.done, os.path.basename(self.path)))
+
+
+# A line with one record, or the end of a file in the spool directory
+Record = Union[str, SpoolFile]
+
+
+def iter_spool(directory: str, poll_interval: float = constants.STREAM_POLL_INTERVAL,
+               stop: Optional[threading.Event] = None) -> Iterator[Record]:
+    """
+    Watch a spool directory and hand out the lines of every file that appears in it, in the order of the file names,
+    each file followed by a `SpoolFile`. Files have to be complete when they get their name: write them under a name
+    that starts with a dot, those are skipped, and rename them afterwards. Files ending in .gz are decompressed.
+
+    :param directory: The spool directory, its done subdirectory is created if it doesn't exist
+    :param poll_interval: Seconds to wait for new files when there were none
+    :param stop: The watch ends when this is set, it is endless if None
+    :return: A generator yielding the lines and the end of every file
+    """
+    done = os.path.join(directory, "done")
+    os.makedirs(done, exist_ok=True)
+    handed_out: Set[str] = set()
+    while stop is None or not stop.is_set():
+        names = sorted(name for name in os.listdir(directory)
+                       if not name.startswith(".") and os.path.isfile(os.path.join(directory, name)))
+        # A file stays in the spool until its rows are loaded, but it is read only once
+        handed_out.intersection_update(names)
+        new = [name for name in names if name not in handed_out]
+        for name in new:
+            path = os.path.join(directory, name)
+            with (gzip.open(path, "rt") if name.endswith(".gz") else open(path, "r")) as f:
+                yield from f
+            handed_out.add(name)
+            yield SpoolFile(path, done)
+        if not new:
+            if stop is None:
+                time.sleep(poll_interval)
+            else:
+                stop.wait(poll_interval)
+
+
+def json_field(value: Any) -> str:
+    """
+    :param value: A field of a json record
+    :return: The field as it would be in a part file
+    """
+    if value is None:
+        return ""
+    elif isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+
+def parse_records(lines: Iterable[str],
+                  rejected: Optional[List[str]] = None) -> Tuple[List[List[str]], List[List[Any]]]:
+    """
+    Repair and route records that come in as lines, like the lines of a part file do in `preprocess.split_lines`. A
+    line is a csv line in the format of the part files, or a json object with the FIELDS as keys or a json array of
+    the fields. Header lines and empty lines are skipped, lines that are not valid json are skipped with a message.
+
+    :param lines: The lines of the records, in the order they came in
+    :param rejected: A list to add the skipped invalid lines to
+    :return: The list of too-long rows and the list of correct length rows
+    """
+    rows: List[Optional[List[str]]] = list()
+    csv_lines = list()
+    csv_positions = list()
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.startswith(HEADER):
+            continue
+        elif line.lstrip()[0] in "{[":
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print(f"Rejected a record that is not valid json ({e}): {line[:80]}")
+                if rejected is not None:
+                    rejected.append(line)
+                continue
+            values = [record.get(field) for field in FIELDS] if isinstance(record, dict) else record
+            rows.append(list(map(json_field, values)))
+        else:
+            csv_positions.append(len(rows))
+            csv_lines.append(line + "\n")
+            rows.append(None)
+
+    for position, row in zip(csv_positions, preprocess.tokenize_lines(csv_lines)):
+        rows[position] = row
+    with preprocess.paused_gc():
+        return preprocess.split_rows(rows)
+
+
+def percentile(values: Iterable[float], fraction: float) -> float:
+    """
+    :param values: Any numbers
+    :param fraction: The fraction of the values that is at most the result, like 0.95
+    :return: The nearest rank percentile of the values, 0 if there are none
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class StreamIngest:
+    """
+    Long running ingest of vehicle records that keep coming in. The records are grouped into micro-batches that are
+    loaded like the chunks of a part file: repaired and routed by `parse_records`, deduplicated and loaded with
+    `main.load_rows`. After every batch the countries it loaded rows for are transformed incrementally with
+    `main.run_transforms`, which normalizes their new rows and updates their ranks in pistoncup.
+
+    The latency of a row is the time from its arrival until the ranks of its country are updated. A batch is loaded
+    when it has batch_size rows, or earlier when its first row would otherwise miss the latency target. How long the
+    load and the update take is estimated from the batches before. Percentiles of the latency are reported every
+    STREAM_REPORT_EVERY batches and at the end.
+
+    Rows with a primary key that was loaded before are dropped like in a batch load, so a file that is read again after
+    an interruption does not change the tables.
+    """
+
+    def __init__(self, engine: Any, batch_size: int = constants.STREAM_BATCH_SIZE,
+                 latency_target: float = constants.STREAM_LATENCY_TARGET, window: int = constants.STREAM_LATENCY_WINDOW,
+                 write_metrics: bool = False):
+        """
+        :param engine: a Sqlalchemy engine object
+        :param batch_size: Largest number of records per batch
+        :param latency_target: Seconds from the arrival of a row until its country's ranks are updated to aim for
+        :param window: Number of recent batches the latency percentiles are computed over
+        :param write_metrics: Write the metrics files at every report, see `report`
+        """
+        self.engine = engine
+        self.batch_size = batch_size
+        self.latency_target = latency_target
+        self.write_metrics = write_metrics
+        self.deduplicators = main.table_deduplicators(engine)
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.processing_seconds = 0.0
+        self.nr_of_batches = 0
+        self.nr_of_records = 0
+        self.over_target = 0
+        self.nr_of_rejected = 0
+        self.reader_error: Optional[BaseException] = None
+
+    def deadline(self, first_arrival: float) -> float:
+        """
+        :param first_arrival: The `time.monotonic` at which the first record of the open batch arrived
+        :return: The `time.monotonic` at which the batch has to be loaded to meet the latency target
+        """
+        return first_arrival + max(self.latency_target - self.processing_seconds, 0.0)
+
+    def load_batch(self, lines: List[str]) -> Set[str]:
+        """
+        Load the records of a batch and update the normalization and the ranks of their countries
+
+        :param lines: The lines of the records
+        :return: The countries that got new rows
+        """
+        rejected: List[str] = list()
+        mater, vehicles = parse_records(lines, rejected)
+        self.nr_of_rejected += len(rejected)
+        vehicles = self.deduplicators[database.Vehicle].drop_duplicates(vehicles)
+        mater = self.deduplicators[database.Mater].drop_duplicates(mater)
+        for table, rows in ((database.Vehicle, vehicles), (database.Mater, mater)):
+            if rows:
+                main.load_rows(rows=rows, table=table, engine=self.engine)
+
+        countries = {row[0] for row in vehicles}
+        if countries:
+            try:
+                main.run_transforms(self.engine, incremental=True, countries=countries)
+            finally:
+                bump_generation()
+        return countries
+
+    def flush(self, lines: List[str], first_arrival: Optional[float], files: List[SpoolFile]) -> None:
+        """
+        Load a batch, then move the spool files that ended in it to the done directory
+
+        :param lines: The lines of the records
+        :param first_arrival: The `time.monotonic` at which the first record arrived, None if there are no records
+        :param files: The spool files whose last record is in this batch or an earlier one
+        :return: None
+        """
+        start = time.monotonic()
+        countries = self.load_batch(lines) if lines else set()
+        for file in files:
+            file.finish()
+        if first_arrival is None:
+            return
+
+        end = time.monotonic()
+        latency = end - first_arrival
+        self.latencies.append(latency)
+        if self.nr_of_batches:
+            self.processing_seconds += PROCESSING_WEIGHT * (end - start - self.processing_seconds)
+        else:
+            self.processing_seconds = end - start
+        self.nr_of_batches += 1
+        self.nr_of_records += len(lines)
+        self.over_target += latency > self.latency_target
+        print(f"Loaded a batch of {len(lines)} records for {len(countries)} countries, ranks updated {latency:.2f} "
+              f"sec after the first record arrived")
+        if self.nr_of_batches % constants.STREAM_REPORT_EVERY == 0:
+            self.report()
+
+    def latency_record(self) -> Dict[str, Any]:
+        """
+        :return: The latency percentiles over the recent batches and the totals so far, as a metrics record
+        """
+        return {
+            "type": "latency",
+            "stage": "stream",
+            "batches": self.nr_of_batches,
+            "records": self.nr_of_records,
+            "target_seconds": self.latency_target,
+            "over_target": self.over_target,
+            "rejected": self.nr_of_rejected,
+            "p50_seconds": round(percentile(self.latencies, 0.5), 6),
+            "p95_seconds": round(percentile(self.latencies, 0.95), 6),
+            "p99_seconds": round(percentile(self.latencies, 0.99), 6),
+            "max_seconds": round(max(self.latencies, default=0.0), 6),
+        }
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Print the latency percentiles and add them to the metrics. With write_metrics the metrics files are written
+        and the records written to the json lines file are forgotten, so a long run doesn't keep them all in memory.
+
+        :return: The latency record, see `latency_record`
+        """
+        record = self.latency_record()
+        print(f"Loaded {record['records']} records in {record['batches']} batches, latency p50 "
+              f"{record['p50_seconds']:.2f} p95 {record['p95_seconds']:.2f} p99 {record['p99_seconds']:.2f} sec, "
+              f"{record['over_target']} batches over the target of {self.latency_target} sec, "
+              f"{record['rejected']} invalid records rejected")
+        METRICS.add(record)
+        if self.write_metrics:
+            METRICS.write_prometheus()
+            METRICS.write_jsonl(clear=True)
+        return record
+
+    def read(self, records: Iterable[Record], incoming: pipeline.MonitoredQueue) -> None:
+        """
+        Put the records on the queue with the time they arrived, followed by STOP when they run out
+        """
+        try:
+            for record in records:
+                incoming.put((time.monotonic(), record))
+        except BaseException as e:
+            self.reader_error = e
+        finally:
+            incoming.put((time.monotonic(), pipeline.STOP))
+
+    def run(self, records: Iterable[Record]) -> None:
+        """
+        Read the records in a thread of their own and load them in micro-batches until they run out or the process is
+        interrupted. The open batch is loaded before returning.
+
+        :param records: The lines of the records, and the ends of the spool files they came from, see `iter_spool`
+        :return: None
+        """
+        incoming = pipeline.MonitoredQueue("stream", maxsize=2 * self.batch_size)
+        threading.Thread(target=self.read, args=(records, incoming), daemon=True).start()
+
+        lines: List[str] = list()
+        files: List[SpoolFile] = list()
+        first_arrival: Optional[float] = None
+        try:
+            while True:
+                timeout = None if first_arrival is None else max(self.deadline(first_arrival) - time.monotonic(), 0)
+                try:
+                    arrival, record = incoming.get(timeout=timeout)
+                except queue.Empty:
+                    arrival, record = None, None
+                if record is pipeline.STOP:
+                    break
+                elif isinstance(record, SpoolFile):
+                    files.append(record)
+                elif record is not None:
+                    if first_arrival is None:
+                        first_arrival = arrival
+                    lines.append(record)
+
+                due = first_arrival is not None and \
+                    (len(lines) >= self.batch_size or time.monotonic() >= self.deadline(first_arrival))
+                if due or (files and not lines):
+                    self.flush(lines, first_arrival, files)
+                    lines, files, first_arrival = list(), list(), None
+        except KeyboardInterrupt:
+            print("Interrupted, loading the open batch")
+
+        self.flush(lines, first_arrival, files)
+        METRICS.add(incoming.stats())
+        self.report()
+        if self.reader_error is not None:
+            raise self.reader_error
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load vehicle records that keep coming in, in micro-batches")
+    parser.add_argument("source", nargs="?", default=constants.STREAM_SPOOL,
+                        help="Spool directory to watch for files of records, - to read the records from stdin")
+    parser.add_argument("--batch-size", type=int, default=constants.STREAM_BATCH_SIZE,
+                        help="Largest number of records per batch")
+    parser.add_argument("--latency-target", type=float, default=constants.STREAM_LATENCY_TARGET,
+                        help="Seconds from the arrival of a record until the ranks of its country are updated")
+    parser.add_argument("--sqlite", metavar="PATH",
+                        help="Load into an embedded SQLite database file instead of MySQL, see `utils.get_db_engine`")
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+
+    engine = utils.get_db_engine(sqlite_database=arguments.sqlite)
+    if not database.is_initialized(engine):
+        database.initialize_database(engine)
+    if arguments.source == "-":
+        source = iter(sys.stdin.readline, "")
+    else:
+        print(f"Watching {arguments.source} for files of records")
+        source = iter_spool(arguments.source)
+    StreamIngest(engine, arguments.batch_size, arguments.latency_target, write_metrics=True).run(source)
@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import sessionmaker
+
+import constants
+import database
+from metrics import METRICS
+
+# A step of the transformation, called with a session and the country to transform. It may return the number of rows
+# it changed
+Step = Callable[[Any, str], Optional[int]]
+
+
+class TransformExecutor:
+    """
+    Runs the steps of the transformation one country at a time instead of on the whole vehicles table at once. Every
+    step of every country is a batch in its own short transaction, so locks are held and undo is kept for the rows of
+    one country only. Countries are independent of each other, they are transformed in parallel by a pool of threads,
+    each over its own connection. Within a country the steps run in order.
+
+    Every batch is planned in the transformcheckpoint table before the first one runs, and marked as completed in the
+    transaction of the batch itself. When a batch fails the other countries carry on, and the next run resumes the plan
+    with the batches that did not complete instead of starting over. The plan of the steps of the executor is removed
+    once every batch completed.
+    """
+
+    def __init__(self, engine: Any, steps: List[Tuple[str, Step]], workers: int = constants.TRANSFORM_WORKERS):
+        """
+        :param engine: a Sqlalchemy engine object, with a connection pool of at least workers connections
+        :param steps: Name and function of every step, in the order they run for a country
+        :param workers: Number of countries transformed at the same time
+        """
+        self.engine = engine
+        self.steps = steps
+        self.workers = workers
+        self.Session = sessionmaker(bind=engine)
+
+    def plan(self, batches: Dict[str, Iterable[str]]) -> Dict[str, List[str]]:
+        """
+        Store the batches to run, on top of the batches of an earlier run that did not complete
+
+        :param batches: The countries to run every step for, by step name
+        :return: The steps that still have to run, by country, in the order of the steps
+        """
+        checkpoint = database.TransformCheckpoint
+        with self.engine.begin() as connection:
+            planned = {(row.step, row.country): row.completed_at for row in connection.execute(checkpoint.find())}
+            if planned:
+                print(f"Resuming the transformation, {sum(done is None for done in planned.values())} of "
+                      f"{len(planned)} batches did not complete")
+            new = [{"step": step, "country": country, "planned_at": datetime.now()}
+                   for step, countries in batches.items() for country in countries if (step, country) not in planned]
+            if new:
+                connection.execute(checkpoint.plan(), new)
+                planned.update({(row["step"], row["country"]): None for row in new})
+
+        pending: Dict[str, List[str]] = dict()
+        for name, _ in self.steps:
+            for (step, country), completed_at in sorted(planned.items()):
+                if step == name and completed_at is None:
+                    pending.setdefault(country, list()).append(step)
+        return pending
+
+    def run_batch(self, name: str, step: Step, country: str) -> None:
+        """
+        Run one step for one country and mark it completed, in one transaction
+
+        :param name: Name of the step
+        :param step: Function of the step
+        :param country: The country to run it for
+        :return: None
+        """
+        session = self.Session()
+        try:
+            with METRICS.stage(name, country=country) as stage:
+                stage.count(rows_out=step(session, country))
+                session.execute(database.TransformCheckpoint.complete(name, country, datetime.now()))
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def run_country(self, country: str, names: List[str]) -> None:
+        steps = dict(self.steps)
+        for name in names:
+            self.run_batch(name, steps[name], country)
+        print(f"Transformed {country}: {', '.join(names)}")
+
+    def run(self, batches: Dict[str, Iterable[str]]) -> None:
+        """
+        Plan and run the batches. The first error is raised after all other countries are done.
+
+        :param batches: The countries to run every step for, by step name
+        :return: None
+        """
+        pending = self.plan(batches)
+        errors: List[BaseException] = list()
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self.run_country, country, names) for country, names in pending.items()]
+            errors = [future.exception() for future in futures if future.exception() is not None]
+        else:
+            for country, names in pending.items():
+                try:
+                    self.run_country(country, names)
+                except Exception as e:
+                    errors.append(e)
+
+        if errors:
+            print(f"Transformation failed for {len(errors)} countries, the next run resumes with them")
+            raise errors[0]
+        with self.engine.begin() as connection:
+            connection.execute(database.TransformCheckpoint.wipe_slate(steps=[name for name, _ in self.steps]))
+
+
+def transform_workers(engine: Any, workers: Optional[int] = None) -> int:
+    """
+    Number of countries to transform at the same time on the database of engine. SQLite allows only one writer at a
+    time, and an in-memory SQLite database is only visible to the thread that created it, so there it is always 1.
+
+    :param engine: a Sqlalchemy engine object
+    :param workers: The number of workers that is asked for, TRANSFORM_WORKERS if None
+    :return: The number of workers
+    """
+    if engine.dialect.name == "sqlite":
+        return 1
+    return constants.TRANSFORM_WORKERS if workers is None else workers
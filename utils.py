@@ -1,10 +1,13 @@
-from typing import Any
+from functools import lru_cache
+import hashlib
+from typing import Any, Optional, TYPE_CHECKING
 import os
 
-import sqlalchemy
-
 import constants
 
+if TYPE_CHECKING:
+    import requests
+
 
 def mkdir(directory: str):
     """
@@ -20,7 +23,24 @@ def mkdir(directory: str):
         print(f"Created directory {directory}")
 
 
-def get_db_engine() -> Any:
+def get_db_engine(pool_size: int = constants.DB_POOL_SIZE, max_overflow: int = constants.DB_MAX_OVERFLOW,
+                  sqlite_database: Optional[str] = None) -> Any:
+    """
+    Create the engine for the database in the CONFIG, or on the host in the MYSQL_HOST environment variable. When
+    sqlite_database or the SQLITE_DATABASE environment variable is set an embedded SQLite database is used instead,
+    see `get_sqlite_engine`.
+
+    :param pool_size: Number of connections to keep open
+    :param max_overflow: Number of connections that may be opened on top of pool_size when they are all in use
+    :param sqlite_database: Path to an SQLite database file, or ":memory:"
+    :return: a Sqlalchemy engine object
+    """
+    import sqlalchemy
+
+    sqlite_database = sqlite_database or os.environ.get("SQLITE_DATABASE")
+    if sqlite_database:
+        return get_sqlite_engine(sqlite_database)
+
     db_type = constants.CONFIG.get('type')
     db_driver = constants.CONFIG.get("driver")
     db_user = constants.CONFIG.get('user')
@@ -35,4 +55,74 @@ def get_db_engine() -> Any:
 
     conn_string = f"{db_type}+{db_driver}://{db_user}:{db_pwd}@{db_host}:{db_port}/{db_name}"
 
-    return sqlalchemy.create_engine(conn_string)
+    # LOAD DATA LOCAL INFILE needs to be allowed on the client side for the MySQL bulk load
+    connect_args = {"local_infile": True} if db_type == "mysql" else dict()
+
+    return sqlalchemy.create_engine(conn_string, connect_args=connect_args, pool_size=pool_size,
+                                    max_overflow=max_overflow)
+
+
+def get_sqlite_engine(path: str) -> Any:
+    """
+    Create the engine for an embedded SQLite database, which needs no database server. A file is opened by a new
+    connection for every checkout that waits SQLITE_BUSY_TIMEOUT seconds for other writers. An in-memory database only
+    lives as long as its connection, so all threads share one, see `single_connection`.
+
+    :param path: Path to the database file, created if it doesn't exist, or ":memory:"
+    :return: a Sqlalchemy engine object
+    """
+    import sqlalchemy
+    from sqlalchemy.pool import StaticPool
+
+    if path == ":memory:":
+        return sqlalchemy.create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    return sqlalchemy.create_engine(f"sqlite:///{path}", connect_args={"timeout": constants.SQLITE_BUSY_TIMEOUT})
+
+
+def single_connection(engine: Any) -> bool:
+    """
+    :param engine: a Sqlalchemy engine object
+    :return: Whether all threads share one connection, like for an in-memory SQLite database, so they can't each run
+        their own transaction
+    """
+    from sqlalchemy.pool import StaticPool
+
+    return isinstance(engine.pool, StaticPool)
+
+
+def get_http_session(pool_size: int = constants.DOWNLOAD_WORKERS) -> "requests.Session":
+    """
+    Create a requests session with a connection pool large enough to keep a connection alive for every parallel
+    download
+
+    :param pool_size: Number of connections to keep alive per host
+    :return: A requests session object
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def file_checksum(path: str) -> str:
+    """
+    Compute the sha256 checksum of a file. The result is cached for as long as the size and modification time of the
+    file stay the same.
+
+    :param path: Path to the file
+    :return: The hexadecimal sha256 digest of the file contents
+    """
+    return _file_checksum(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path))
+
+
+@lru_cache(maxsize=None)
+def _file_checksum(path: str, size: int, mtime: float) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()